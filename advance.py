@@ -0,0 +1,130 @@
+from models import db, ParkingSpot, AdvanceBooking
+from sqlalchemy import insert, literal, select, update
+from datetime import datetime, timedelta
+
+
+#------------------------------------------ Advance bookings ---------------------------------------
+# A driver can book a spot of a lot for a time window ahead. Two windows of a spot overlap when
+# each starts before the other ends. Windows are at most MAX_WINDOW long, so only the windows
+# of the spot that start in (start - MAX_WINDOW, end) can overlap [start, end): the check is a
+# range read on the (spot_id, start_time, end_time) index that touches the few windows around
+# the asked range, however long the booking history of the spot grows. A free spot of a lot is
+# the first spot without such a window, found by one query that stops at the first match.
+#
+# Windows are stored with a conditional INSERT ... SELECT ... WHERE NOT EXISTS (overlap), so of
+# two concurrent bookings of the same window exactly one is stored, like claim_spot() does for
+# walk-in bookings. Walk-ins are not seated on a spot booked within WALKIN_HORIZON (allocator.py),
+# and windows starting that soon skip the spots that are occupied now.
+
+MAX_WINDOW = timedelta(hours=24)        # never lower it below the longest stored window
+MIN_WINDOW = timedelta(minutes=30)
+MAX_DAYS_AHEAD = 30
+WALKIN_HORIZON = timedelta(hours=2)
+CHECKIN_EARLY = timedelta(minutes=15)   # how long before its start a window can be checked in
+MAX_BOOK_ATTEMPTS = 10
+
+# windows still holding their spot
+HOLDING = ('booked', 'checked_in')
+
+
+# naive local datetime of an ISO 8601 string (form datetime-local or API value), or None
+def parse_time(value):
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+# condition matching the windows of `spot` that overlap [start, end). `spot` is a spot id or
+# a column (correlated subqueries), `statuses` the states that count, `ignore_id` a window to skip
+def overlapping(spot, start, end, statuses=HOLDING, ignore_id=None):
+    conditions = [
+        AdvanceBooking.spot_id == spot,
+        AdvanceBooking.start_time > start - MAX_WINDOW,
+        AdvanceBooking.start_time < end,
+        AdvanceBooking.end_time > start,
+        AdvanceBooking.status.in_(statuses),
+    ]
+    if ignore_id is not None:
+        conditions.append(AdvanceBooking.id != ignore_id)
+    return db.and_(*conditions)
+
+# spots of a lot without a window overlapping [start, end), lowest id first
+def free_spots_query(lot_id, start, end):
+    query = (select(ParkingSpot.id)
+             .where(ParkingSpot.lot_id == lot_id, ~db.exists().where(overlapping(ParkingSpot.id, start, end)))
+             .order_by(ParkingSpot.id))
+    if start < datetime.now() + WALKIN_HORIZON:
+        # a walk-in parked now has no end time, keep its spot out of windows that start soon
+        query = query.where(ParkingSpot.is_occupied == False)
+    return query
+
+# id of a spot of a lot free during [start, end), or None
+def find_free_spot(lot_id, start, end, after=None):
+    query = free_spots_query(lot_id, start, end)
+    if after is not None:
+        query = query.where(ParkingSpot.id > after)
+    return db.session.execute(query.limit(1)).scalar()
+
+# does the vehicle already hold a window overlapping [start, end) (in any lot)
+def vehicle_is_booked(vehicle_id, start, end):
+    return db.session.query(db.exists().where(
+        AdvanceBooking.vehicle_id == vehicle_id,
+        AdvanceBooking.start_time > start - MAX_WINDOW,
+        AdvanceBooking.start_time < end,
+        AdvanceBooking.end_time > start,
+        AdvanceBooking.status.in_(HOLDING),
+    )).scalar()
+
+# store a window on a free spot of the lot inside the current transaction, trying the next
+# free spot when another request took one meanwhile. Returns the AdvanceBooking, or None if
+# no spot of the lot is free during the window. The caller commits.
+def reserve_window(user_id, lot_id, vehicle_id, start, end):
+    spot_id = None
+    for _ in range(MAX_BOOK_ATTEMPTS):
+        spot_id = find_free_spot(lot_id, start, end, after=spot_id)
+        if spot_id is None:
+            return None
+        row = select(literal(user_id), literal(lot_id), literal(spot_id), literal(vehicle_id),
+                     literal(start), literal(end), literal('booked'), literal(datetime.now()))
+        result = db.session.execute(
+            insert(AdvanceBooking)
+            .from_select(['user_id', 'lot_id', 'spot_id', 'vehicle_id', 'start_time', 'end_time', 'status', 'created_at'],
+                         row.where(~db.exists().where(overlapping(spot_id, start, end))))
+        )
+        if result.rowcount == 1:
+            return db.session.get(AdvanceBooking, result.lastrowid)
+    return None
+
+# cancel a window that has not been checked in, returns False if it can't be cancelled
+def cancel_window(booking):
+    result = db.session.execute(
+        update(AdvanceBooking)
+        .where(AdvanceBooking.id == booking.id, AdvanceBooking.status == 'booked')
+        .values(status='cancelled')
+        .execution_options(synchronize_session=False)
+    )
+    db.session.refresh(booking)
+    return result.rowcount == 1
+
+# the windows of a user that are not over yet, soonest first
+def upcoming_windows(user_id):
+    return (AdvanceBooking.query
+            .filter(AdvanceBooking.user_id == user_id, AdvanceBooking.end_time > datetime.now(),
+                    AdvanceBooking.status.in_(HOLDING))
+            .order_by(AdvanceBooking.start_time))
+
+# condition: some spots hold a booked window that is not over yet
+def upcoming_windows_exist(spot_ids):
+    now = datetime.now()
+    return db.exists().where(
+        AdvanceBooking.spot_id.in_(spot_ids),
+        AdvanceBooking.start_time > now - MAX_WINDOW,
+        AdvanceBooking.end_time > now,
+        AdvanceBooking.status == 'booked',
+    )
+
+def has_upcoming_windows(spot_ids):
+    return db.session.query(upcoming_windows_exist(spot_ids)).scalar()
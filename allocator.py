@@ -0,0 +1,130 @@
+from models import db, ParkingSpot
+from advance import overlapping, WALKIN_HORIZON
+from sqlalchemy import update
+from datetime import datetime
+import heapq
+import threading
+
+
+#------------------------------------- Free spot allocator ---------------------------------------
+# Keeps the free spot ids of every lot in memory (a min-heap plus a set) so picking a vacant
+# spot never loads the spots of a lot. A lot is loaded lazily with one indexed query on
+# (lot_id, is_occupied) that only reads ids, and is kept in sync by the book/release/spot routes.
+# The database stays the source of truth: when in doubt a lot is simply invalidated.
+# Spots booked ahead (advance.py) stay in the free list; claim_spot() refuses the ones whose
+# window starts soon and drops them from the list until they are released or the lot reloads.
+
+class FreeSpotAllocator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free = {}    # lot_id -> set of free spot ids
+        self._heap = {}    # lot_id -> heap of spot ids (may contain stale ids)
+
+    def _load(self, lot_id):
+        ids = db.session.execute(
+            db.select(ParkingSpot.id).where(ParkingSpot.lot_id == lot_id, ParkingSpot.is_occupied == False)
+        ).scalars().all()
+        heap = list(ids)
+        heapq.heapify(heap)
+        with self._lock:
+            self._free[lot_id] = set(ids)
+            self._heap[lot_id] = heap
+
+    # lowest free spot id of a lot, or None if the lot is full
+    def first_free(self, lot_id):
+        if lot_id not in self._free:
+            self._load(lot_id)
+        with self._lock:
+            free = self._free.get(lot_id)
+            heap = self._heap.get(lot_id)
+            if free is None:
+                return None
+            while heap and heap[0] not in free:
+                heapq.heappop(heap)
+            return heap[0] if heap else None
+
+    def free_count(self, lot_id):
+        if lot_id not in self._free:
+            self._load(lot_id)
+        with self._lock:
+            return len(self._free.get(lot_id, ()))
+
+    def mark_occupied(self, lot_id, spot_id):
+        with self._lock:
+            free = self._free.get(lot_id)
+            if free is not None:
+                free.discard(spot_id)
+
+    def mark_free(self, lot_id, spot_id):
+        with self._lock:
+            free = self._free.get(lot_id)
+            if free is not None and spot_id not in free:
+                free.add(spot_id)
+                heapq.heappush(self._heap[lot_id], spot_id)
+
+    def add_spots(self, lot_id, spot_ids):
+        for spot_id in spot_ids:
+            self.mark_free(lot_id, spot_id)
+
+    def remove_spot(self, lot_id, spot_id):
+        self.mark_occupied(lot_id, spot_id)
+
+    # forget a lot, it is reloaded from the database on next use
+    def invalidate(self, lot_id):
+        with self._lock:
+            self._free.pop(lot_id, None)
+            self._heap.pop(lot_id, None)
+
+
+allocator = FreeSpotAllocator()
+
+
+# condition on a spot that is not booked ahead for a window starting before WALKIN_HORIZON,
+# `ignore_booking_id` is the window being checked in
+def not_booked_soon(ignore_booking_id=None):
+    now = datetime.now()
+    return ~db.exists().where(overlapping(ParkingSpot.id, now, now + WALKIN_HORIZON,
+                                          statuses=('booked',), ignore_id=ignore_booking_id))
+
+# first free spot of a lot straight from the database (uses the (lot_id, is_occupied) index)
+def first_free_spot_db(lot_id):
+    return db.session.execute(
+        db.select(ParkingSpot.id)
+        .where(ParkingSpot.lot_id == lot_id, ParkingSpot.is_occupied == False, not_booked_soon())
+        .order_by(ParkingSpot.id)
+        .limit(1)
+    ).scalar()
+
+
+MAX_CLAIM_ATTEMPTS = 10
+
+# atomically mark a free spot of a lot as occupied inside the current transaction.
+# The UPDATE only matches a spot that is still free, so of two concurrent requests for the
+# same spot exactly one wins; the loser retries on the next free spot. Returns the claimed
+# spot id, or None if the lot is full. The caller commits (or rolls back) the session.
+# `ignore_booking_id` lets an advance booking claim the spot it holds.
+def claim_spot(lot_id, spot_id=None, ignore_booking_id=None):
+    from_db = False
+    for _ in range(MAX_CLAIM_ATTEMPTS):
+        if spot_id is None:
+            spot_id = first_free_spot_db(lot_id) if from_db else allocator.first_free(lot_id) or first_free_spot_db(lot_id)
+            if spot_id is None:
+                return None
+        result = db.session.execute(
+            update(ParkingSpot)
+            .where(ParkingSpot.id == spot_id, ParkingSpot.lot_id == lot_id, ParkingSpot.is_occupied == False,
+                   not_booked_soon(ignore_booking_id))
+            .values(is_occupied=True)
+            .execution_options(synchronize_session=False)
+        )
+        allocator.mark_occupied(lot_id, spot_id)
+        if result.rowcount == 1:
+            return spot_id
+        # lost the race, or the cached free list is stale (another worker, a spot booked soon):
+        # forget the lot and take the next spots from the database. The failed UPDATE already
+        # holds the write lock, so its answer stays true until we commit.
+        if not from_db:
+            allocator.invalidate(lot_id)
+            from_db = True
+        spot_id = None
+    return None
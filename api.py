@@ -0,0 +1,344 @@
+from app import app
+from flask import request, session, Response
+from flask_restful import Api, Resource, abort
+from models import db, User, ParkingLot, ParkingSpot, AdvanceBooking
+from bookings import book, release, book_window, check_in, BookingError
+from advance import parse_time, find_free_spot, cancel_window, upcoming_windows
+from pagination import keyset_page
+from history import reservation_history, find_reservation
+from search import search_page, SEARCH_FIELDS
+from geo import nearest_lots, pincode_location, MAX_NEAREST
+from werkzeug.security import check_password_hash
+from functools import wraps
+import hashlib
+
+
+#--------------------------------------------- JSON API --------------------------------------------
+# Versioned JSON API (/api/v1) for the mobile app and kiosks, using the same session login as
+# the web pages. Lots are returned in a compact shape without their spots (add ?spots=1 to a
+# single lot to get them). Read endpoints send an ETag built from ParkingLot.occupancy_version,
+# so a client polling with If-None-Match gets an empty 304 until a lot actually changes.
+
+API_PREFIX = '/api/v1'
+MAX_BATCH_LOTS = 100
+
+api = Api(app, prefix=API_PREFIX)
+
+# HTTP status of a refused booking, by BookingError.reason
+BOOKING_ERROR_STATUS = {'vehicle': 404, 'booked': 409, 'full': 409, 'window': 400, 'released': 409}
+
+
+def api_auth_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            abort(401, message='Login required.')
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+#--------------------------------------------- Shapes ----------------------------------------------
+
+def lot_json(lot):
+    return {
+        'id': lot.id,
+        'name': lot.name,
+        'address': lot.address,
+        'pincode': lot.pincode,
+        'price_per_hour': lot.price_per_hour,
+        'latitude': lot.latitude,
+        'longitude': lot.longitude,
+        'total_spots': lot.total_spots,
+        'free_spots': lot.total_spots - lot.occupied_count,
+        'version': lot.occupancy_version,
+    }
+
+def availability_json(lot):
+    return {
+        'lot_id': lot.id,
+        'total_spots': lot.total_spots,
+        'free_spots': lot.total_spots - lot.occupied_count,
+        'version': lot.occupancy_version,
+    }
+
+def spot_json(spot):
+    return {'id': spot.id, 'spot_number': spot.spot_number, 'is_occupied': bool(spot.is_occupied)}
+
+def reservation_json(reservation):
+    return {
+        'id': reservation.id,
+        'lot_id': reservation.lot_id,
+        'spot_id': reservation.spot_id,
+        'vehicle_id': reservation.vehicle_id,
+        'parking_timestamp': reservation.parking_timestamp.isoformat(timespec='seconds'),
+        'leaving_timestamp': reservation.leaving_timestamp and reservation.leaving_timestamp.isoformat(timespec='seconds'),
+        'total_cost': None if reservation.total_cost is None else float(reservation.total_cost),
+    }
+
+def advance_booking_json(booking):
+    return {
+        'id': booking.id,
+        'lot_id': booking.lot_id,
+        'spot_id': booking.spot_id,
+        'vehicle_id': booking.vehicle_id,
+        'start': booking.start_time.isoformat(timespec='seconds'),
+        'end': booking.end_time.isoformat(timespec='seconds'),
+        'status': booking.status,
+        'reservation_id': booking.reservation_id,
+    }
+
+def page_json(page, key, items):
+    return {key: items, 'next_after': page.next_after}
+
+
+#--------------------------------------------- ETags -----------------------------------------------
+
+# ETag of a set of lots: their ids and versions, plus the query args that shaped the response
+def lots_etag(lots):
+    state = ','.join(f'{lot.id}:{lot.occupancy_version}' for lot in lots)
+    digest = hashlib.sha1(f'{request.full_path}|{state}'.encode()).hexdigest()
+    return digest[:20]
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+# 304 if the client already has this version, else the data with its ETag
+def conditional(data, etag):
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    return data, 200, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+
+
+#--------------------------------------------- Session ---------------------------------------------
+
+class SessionResource(Resource):
+    def post(self):
+        data = request.get_json(silent=True) or {}
+        user = User.query.filter_by(username=data.get('username')).first()
+        if not user or not check_password_hash(user.passhash, data.get('password') or ''):
+            abort(401, message='Username or password is incorrect.')
+        session['user_id'] = user.id
+        return {'user_id': user.id, 'name': user.name, 'is_admin': bool(user.is_admin)}, 201
+
+    def delete(self):
+        session.pop('user_id', None)
+        return '', 204
+
+
+#---------------------------------------------- Lots -----------------------------------------------
+
+class LotListResource(Resource):
+    method_decorators = [api_auth_required]
+
+    # ?q= searches the name (or the address with ?field=address), ?pincode= filters by pincode
+    # prefix, ?after= and ?per_page= page through the result
+    def get(self):
+        lots = ParkingLot.query
+        pincode = request.args.get('pincode')
+        if pincode:
+            lots = lots.filter(ParkingLot.pincode.like(f'{pincode}%'))
+        q = request.args.get('q')
+        field = request.args.get('field', 'name')
+        if field not in SEARCH_FIELDS:
+            abort(400, message=f'field must be one of {", ".join(SEARCH_FIELDS)}.')
+        if q:
+            page = search_page(ParkingLot, field, q, lots)
+        else:
+            page = keyset_page(lots, ParkingLot.id)
+        return conditional(page_json(page, 'lots', [lot_json(lot) for lot in page.items]), lots_etag(page.items))
+
+# lots with a free spot nearest to ?lat=&lon= (or to the centroid of ?pincode=), ?limit= of them
+class NearestLotsResource(Resource):
+    method_decorators = [api_auth_required]
+
+    def get(self):
+        latitude = request.args.get('lat', type=float)
+        longitude = request.args.get('lon', type=float)
+        if latitude is None or longitude is None:
+            location = pincode_location(request.args.get('pincode', ''))
+            if not location:
+                abort(400, message='Give lat and lon, or a known pincode.')
+            latitude, longitude = location
+        limit = max(1, min(request.args.get('limit', 5, type=int), MAX_NEAREST))
+        nearest = nearest_lots(latitude, longitude, limit=limit)
+        data = {'lots': [dict(lot_json(lot), distance_km=round(distance, 3)) for lot, distance in nearest]}
+        return conditional(data, lots_etag([lot for lot, _ in nearest]))
+
+class LotResource(Resource):
+    method_decorators = [api_auth_required]
+
+    def get(self, lot_id):
+        lot = ParkingLot.query.get(lot_id)
+        if not lot:
+            abort(404, message=f'Parking lot {lot_id} not found.')
+        etag = lots_etag([lot])
+        if etag in request.if_none_match:
+            return not_modified(etag)
+        data = lot_json(lot)
+        if request.args.get('spots', type=int):
+            spots = ParkingSpot.query.filter_by(lot_id=lot_id).order_by(ParkingSpot.spot_number).all()
+            data['spots'] = [spot_json(spot) for spot in spots]
+        return conditional(data, etag)
+
+class LotAvailabilityResource(Resource):
+    method_decorators = [api_auth_required]
+
+    def get(self, lot_id):
+        lot = ParkingLot.query.get(lot_id)
+        if not lot:
+            abort(404, message=f'Parking lot {lot_id} not found.')
+        return conditional(availability_json(lot), lots_etag([lot]))
+
+# availability of many lots in one call: GET ?ids=1,2,3 or POST {"ids": [1, 2, 3]}
+class AvailabilityResource(Resource):
+    method_decorators = [api_auth_required]
+
+    def _lots(self, ids):
+        try:
+            ids = sorted({int(id) for id in ids})
+        except (TypeError, ValueError):
+            abort(400, message='ids must be lot ids.')
+        if len(ids) > MAX_BATCH_LOTS:
+            abort(400, message=f'At most {MAX_BATCH_LOTS} lots per call.')
+        if not ids:
+            return []
+        return ParkingLot.query.filter(ParkingLot.id.in_(ids)).order_by(ParkingLot.id).all()
+
+    def get(self):
+        ids = [id for id in request.args.get('ids', '').split(',') if id]
+        lots = self._lots(ids)
+        return conditional({'lots': [availability_json(lot) for lot in lots]}, lots_etag(lots))
+
+    def post(self):
+        data = request.get_json(silent=True) or {}
+        lots = self._lots(data.get('ids') or [])
+        return {'lots': [availability_json(lot) for lot in lots]}
+
+
+#------------------------------------------ Reservations -------------------------------------------
+
+class BookingResource(Resource):
+    method_decorators = [api_auth_required]
+
+    # {"vehicle_id": 1}, the first free spot of the lot is reserved
+    def post(self, lot_id):
+        data = request.get_json(silent=True) or {}
+        if not db.session.get(ParkingLot, lot_id):
+            abort(404, message=f'Parking lot {lot_id} not found.')
+        try:
+            reservation = book(session['user_id'], lot_id, data.get('vehicle_id'))
+        except BookingError as e:
+            abort(BOOKING_ERROR_STATUS[e.reason], message=str(e), reason=e.reason)
+        return reservation_json(reservation), 201
+
+class ReservationListResource(Resource):
+    method_decorators = [api_auth_required]
+
+    # parking history of the user, newest first
+    def get(self):
+        history = reservation_history('user_id')
+        page = keyset_page(db.session.query(history).params(user_id=session['user_id']), history.id, descending=True)
+        return page_json(page, 'reservations', [reservation_json(r) for r in page.items])
+
+class ReleaseResource(Resource):
+    method_decorators = [api_auth_required]
+
+    def post(self, reservation_id):
+        reservation = find_reservation(reservation_id)
+        if not reservation:
+            abort(404, message=f'Reservation {reservation_id} not found.')
+        if reservation.user_id != session['user_id']:
+            abort(403, message=f'Reservation {reservation_id} belongs to another user.')
+        if reservation.leaving_timestamp:
+            abort(409, message='Reservation already released.')
+        try:
+            return reservation_json(release(reservation))
+        except BookingError as e:
+            abort(BOOKING_ERROR_STATUS[e.reason], message=str(e), reason=e.reason)
+
+
+#---------------------------------------- Advance bookings -----------------------------------------
+
+def window_args(source):
+    start = parse_time(source.get('start'))
+    end = parse_time(source.get('end'))
+    if not start or not end:
+        abort(400, message='start and end must be ISO 8601 date times.')
+    return start, end
+
+class LotWindowsResource(Resource):
+    method_decorators = [api_auth_required]
+
+    # a spot of the lot free during ?start=&end=, spot_id is null when every spot is booked
+    def get(self, lot_id):
+        if not db.session.get(ParkingLot, lot_id):
+            abort(404, message=f'Parking lot {lot_id} not found.')
+        start, end = window_args(request.args)
+        return {'lot_id': lot_id, 'start': start.isoformat(timespec='seconds'),
+                'end': end.isoformat(timespec='seconds'), 'spot_id': find_free_spot(lot_id, start, end)}
+
+    # {"vehicle_id": 1, "start": "...", "end": "..."}, a spot free during the window is booked
+    def post(self, lot_id):
+        data = request.get_json(silent=True) or {}
+        if not db.session.get(ParkingLot, lot_id):
+            abort(404, message=f'Parking lot {lot_id} not found.')
+        start, end = window_args(data)
+        try:
+            booking = book_window(session['user_id'], lot_id, data.get('vehicle_id'), start, end)
+        except BookingError as e:
+            abort(BOOKING_ERROR_STATUS[e.reason], message=str(e), reason=e.reason)
+        return advance_booking_json(booking), 201
+
+class AdvanceBookingListResource(Resource):
+    method_decorators = [api_auth_required]
+
+    # windows of the user that are not over yet, soonest first
+    def get(self):
+        return {'bookings': [advance_booking_json(b) for b in upcoming_windows(session['user_id'])]}
+
+def own_advance_booking(booking_id):
+    booking = db.session.get(AdvanceBooking, booking_id)
+    if not booking:
+        abort(404, message=f'Advance booking {booking_id} not found.')
+    if booking.user_id != session['user_id']:
+        abort(403, message=f'Advance booking {booking_id} belongs to another user.')
+    return booking
+
+class AdvanceBookingResource(Resource):
+    method_decorators = [api_auth_required]
+
+    # cancel the window
+    def delete(self, booking_id):
+        booking = own_advance_booking(booking_id)
+        if not cancel_window(booking):
+            abort(409, message='Advance booking already checked in or cancelled.')
+        db.session.commit()
+        return '', 204
+
+class CheckInResource(Resource):
+    method_decorators = [api_auth_required]
+
+    def post(self, booking_id):
+        booking = own_advance_booking(booking_id)
+        try:
+            reservation = check_in(booking)
+        except BookingError as e:
+            abort(BOOKING_ERROR_STATUS[e.reason], message=str(e), reason=e.reason)
+        return reservation_json(reservation), 201
+
+
+api.add_resource(SessionResource, '/session', endpoint='api_session')
+api.add_resource(LotListResource, '/lots', endpoint='api_lots')
+api.add_resource(NearestLotsResource, '/lots/nearest', endpoint='api_nearest_lots')
+api.add_resource(LotResource, '/lots/<int:lot_id>', endpoint='api_lot')
+api.add_resource(LotAvailabilityResource, '/lots/<int:lot_id>/availability', endpoint='api_lot_availability')
+api.add_resource(AvailabilityResource, '/availability', endpoint='api_availability')
+api.add_resource(BookingResource, '/lots/<int:lot_id>/bookings', endpoint='api_book')
+api.add_resource(ReservationListResource, '/reservations', endpoint='api_reservations')
+api.add_resource(ReleaseResource, '/reservations/<int:reservation_id>/release', endpoint='api_release')
+api.add_resource(LotWindowsResource, '/lots/<int:lot_id>/windows', endpoint='api_lot_windows')
+api.add_resource(AdvanceBookingListResource, '/advance-bookings', endpoint='api_advance_bookings')
+api.add_resource(AdvanceBookingResource, '/advance-bookings/<int:booking_id>', endpoint='api_advance_booking')
+api.add_resource(CheckInResource, '/advance-bookings/<int:booking_id>/checkin', endpoint='api_check_in')
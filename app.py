@@ -1,12 +1,55 @@
 from flask import Flask
+import os
+import sys
 
 app = Flask(__name__)
+# with `python app.py` this is __main__, the modules importing `app` must get it, not a second copy
+sys.modules.setdefault('app', sys.modules[__name__])
 
 import config 
 
 import models
 
+import history
+
+import migrations
+
+import geo
+
+import provisioning
+
+import querybudget
+
+import metrics
+
+import occupancy
+
+import billing
+
+import export
+
+import rollups
+
+import startup
+
+import jobs
+
 import routes
 
+import api
+
+import eventstream
+
 if __name__ == "__main__":
+    # development server only, production runs wsgi.py (after `flask init-db`), `flask run-jobs`
+    # and `flask serve-events`
+    with app.app_context():
+        migrations.init_db()
+    app.config['JOB_WORKER_IN_PROCESS'] = True
+    # the reloader runs this file in a watcher process too, only the serving process runs jobs
+    # and the event stream server (on the next port, sharing the in-process broker)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        jobs.start_worker_thread()
+        port = eventstream.start_server_thread(port=5001)
+        app.config['EVENT_STREAM_URL'] = f'http://{{hostname}}:{port}{eventstream.STREAM_PATH}'
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,1150 @@
+import click
+import http.cookiejar
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from sqlalchemy import event
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+
+#-------------------------------------------- Benchmark --------------------------------------------
+# Load generator for the booking lifecycle. `python benchmark.py run` creates a throw-away SQLite
+# database, seeds it with bulk inserts (users, vehicles, lots, spots, past reservations), then
+# drives the real app through the Flask test client: register -> login -> add vehicle -> book ->
+# release -> history for every virtual user, plus the admin dashboards. It reports p50/p95/p99
+# latency and throughput per step and can save them as JSON; `python benchmark.py compare`
+# diffs two such files (e.g. from two commits) and fails on regressions. `python benchmark.py
+# nearest` times the nearest free lot lookup (geo.py) on a large synthetic set of lots and
+# `python benchmark.py windows` stress tests advance bookings (advance.py) with tens of thousands
+# of overlapping windows on top of a long booking history. `python benchmark.py delete-lot` times
+# the set based lot deletion (provisioning.delete_lot) against the ORM cascade it replaced, and
+# `python benchmark.py history` times the active reservation lookups of the hot table
+# (history.py) against one table holding the whole history, as the history grows.
+# `python benchmark.py report` builds the admin summary figures with the per lot loops of old,
+# with GROUP BY queries and from the running counters (reports.py), counting statements.
+# `python benchmark.py allocate` times picking and booking a free spot (allocator.py) as the
+# lots grow, against loading every spot of the lot, and `python benchmark.py stress` fires
+# parallel bookings at one lot and fails on any double occupancy. `python benchmark.py provision`
+# times creating and halving lots of 10k and 100k spots (provisioning.py) against one ORM
+# object per spot, and importing as many spots from CSV. `python benchmark.py search` times the
+# name and address searches (search.py) against ilike('%query%') at 100k users, and `python
+# benchmark.py serve` load tests the booking flow over HTTP under Flask's development server,
+# waitress and gunicorn (wsgi.py).
+#
+# The app is imported only after the database url has been pointed at the benchmark database,
+# so the configured database is never touched.
+
+PASSWORD = 'benchmark'
+SEED_CHUNK_SIZE = 10000
+NOISE_FLOOR_MS = 0.5        # smaller differences never count as a regression
+COMMON_MATCHES = 100        # a search term matching this many rows is reported as common
+
+
+def _prepare_environment(database):
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.abspath(database)}'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.pop('METRICS_ENABLED', None)
+
+def _load_app():
+    from app import app
+    import migrations
+    with app.app_context():
+        migrations.init_db()
+    return app
+
+def _chunks(rows, size=SEED_CHUNK_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+def _bulk_insert(model, rows):
+    from models import db
+    from sqlalchemy import insert
+    for chunk in _chunks(rows):
+        db.session.execute(insert(model), chunk)
+
+# past reservations into the partitions of their release month, numbered after `last_id`.
+# Returns the last id used.
+def _bulk_insert_history(rows, last_id=0):
+    from history import ensure_partition, partition_name, set_last_id
+    partitions = {}
+    for row in rows:
+        last_id += 1
+        row['id'] = last_id
+        partitions.setdefault(partition_name(row['leaving_timestamp']), []).append(row)
+    for name, partition_rows in sorted(partitions.items()):
+        _bulk_insert(ensure_partition(name), partition_rows)
+    set_last_id(last_id)
+    return last_id
+
+
+#---------------------------------------------- Seed ----------------------------------------------
+
+# past reservations go to the history partitions, or to the hot table with partitioned=False
+# (the single table layout from before history.py)
+def seed(rng, users, vehicles_per_user, lots, spots_per_lot, reservations, partitioned=True):
+    from models import db, User, Vehicle, ParkingLot, ParkingSpot, Reservation
+    from werkzeug.security import generate_password_hash
+    from occupancy import repair_counters
+    from rollups import backfill
+    from sqlalchemy import text
+
+    passhash = generate_password_hash(PASSWORD)
+    _bulk_insert(User, [dict(name=f'Seed user {n}', address=f'{n} Seed street', pincode=f'{560001 + n % 50}',
+                             username=f'seed{n}@example.com', passhash=passhash) for n in range(users)])
+    user_ids = db.session.execute(db.select(User.id).where(User.is_admin == False).order_by(User.id)).scalars().all()
+    _bulk_insert(Vehicle, [dict(user_id=user_id, vehicle_number=f'SEED{user_id}-{n}', vehicle_type='car')
+                           for user_id in user_ids for n in range(vehicles_per_user)])
+    _bulk_insert(ParkingLot, [dict(name=f'Seed lot {n}', address=f'{n} Market road', pincode=f'{560001 + n % 50}',
+                                   total_spots=spots_per_lot, price_per_hour=rng.choice([20.0, 30.0, 40.0, 50.0]))
+                              for n in range(lots)])
+    lot_rows = db.session.execute(db.select(ParkingLot.id, ParkingLot.price_per_hour).order_by(ParkingLot.id)).all()
+    _bulk_insert(ParkingSpot, [dict(lot_id=lot_id, spot_number=n + 1, is_occupied=False)
+                               for lot_id, _ in lot_rows for n in range(spots_per_lot)])
+
+    vehicles = db.session.execute(db.select(Vehicle.id, Vehicle.user_id)).all()
+    spots = {}
+    for spot_id, lot_id in db.session.execute(db.select(ParkingSpot.id, ParkingSpot.lot_id)):
+        spots.setdefault(lot_id, []).append(spot_id)
+    now = datetime.now().replace(microsecond=0)
+    rows = []
+    for _ in range(reservations if vehicles and lot_rows else 0):
+        vehicle_id, user_id = rng.choice(vehicles)
+        lot_id, price = rng.choice(lot_rows)
+        start = now - timedelta(minutes=rng.randrange(60, 365 * 24 * 60))
+        minutes = rng.randrange(15, 12 * 60)
+        rows.append(dict(user_id=user_id, lot_id=lot_id, spot_id=rng.choice(spots[lot_id]), vehicle_id=vehicle_id,
+                         parking_timestamp=start, leaving_timestamp=start + timedelta(minutes=minutes),
+                         total_cost=round(minutes / 60 * price, 2), price_per_hour=price))
+    if partitioned:
+        _bulk_insert_history(rows)
+    else:
+        _bulk_insert(Reservation, rows)
+    repair_counters()
+    db.session.commit()
+    backfill()
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+
+#------------------------------------------- Scenarios --------------------------------------------
+
+class Timer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}       # step -> [seconds, ...]
+        self.errors = {}        # step -> count
+
+    def request(self, client, step, method, url, **kwargs):
+        start = time.perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.samples.setdefault(step, []).append(seconds)
+            if response.status_code >= 400:
+                self.errors[step] = self.errors.get(step, 0) + 1
+        return response
+
+# statements sent to the database while the block runs: with count_statements() as count: ...; count[0]
+@contextmanager
+def count_statements():
+    from models import db
+    count = [0]
+
+    def counted(*args):
+        count[0] += 1
+    event.listen(db.engine, 'before_cursor_execute', counted)
+    try:
+        yield count
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counted)
+
+# one new user going through the whole booking lifecycle
+def lifecycle(app, timer, number, lot_ids, rng):
+    from models import Vehicle, Reservation
+    client = app.test_client()
+    username = f'bench{number}@example.com'
+    timer.request(client, 'register', 'post', '/register', data=dict(
+        name=f'Bench user {number}', address=f'{number} Bench street', pincode='560001',
+        username=username, password=PASSWORD, confirm_password=PASSWORD))
+    timer.request(client, 'login', 'post', '/login', data=dict(username=username, password=PASSWORD))
+    timer.request(client, 'user', 'get', '/user')
+    timer.request(client, 'add_vehicle', 'post', '/vehicle/add',
+                  data=dict(vehicleno=f'BENCH{number}', vehicle_type='car'))
+    with app.app_context():
+        vehicle_id = Vehicle.query.filter_by(vehicle_number=f'BENCH{number}').first().id
+
+    lot_id = rng.choice(lot_ids)
+    timer.request(client, 'book_lot', 'get', f'/lot/{lot_id}/book')
+    timer.request(client, 'book_lot_post', 'post', f'/lot/{lot_id}/book', data=dict(vehicleid=vehicle_id))
+    timer.request(client, 'parking_history', 'get', '/parking/history')
+    with app.app_context():
+        reservation = Reservation.query.filter_by(vehicle_id=vehicle_id, leaving_timestamp=None).first()
+    if reservation:
+        timer.request(client, 'release', 'get', f'/spot/{reservation.id}/release')
+        timer.request(client, 'release_post', 'post', f'/spot/{reservation.id}/release')
+    timer.request(client, 'parking_history', 'get', '/parking/history')
+
+def admin_round(app, timer):
+    client = app.test_client()
+    timer.request(client, 'admin_login', 'post', '/login', data=dict(username='admin123@gmail.com', password='admin123'))
+    timer.request(client, 'admin', 'get', '/admin')
+    timer.request(client, 'admin_counts', 'get', '/admin?view=counts')
+    timer.request(client, 'userdata', 'get', '/userdata')
+    timer.request(client, 'admin_summary', 'get', '/admin/summary')
+    timer.request(client, 'admin_trends', 'get', '/admin/trends')
+
+
+#--------------------------------------------- Report ---------------------------------------------
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summarize(timer, seconds):
+    steps = {}
+    for step, samples in timer.samples.items():
+        samples = sorted(samples)
+        total = sum(samples)
+        steps[step] = {
+            'count': len(samples),
+            'errors': timer.errors.get(step, 0),
+            'mean_ms': total / len(samples) * 1000,
+            'p50_ms': percentile(samples, 0.5) * 1000,
+            'p95_ms': percentile(samples, 0.95) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+            'rps': len(samples) / total if total else 0.0,     # single client throughput
+        }
+    requests = sum(step['count'] for step in steps.values())
+    return {'steps': steps, 'requests': requests, 'seconds': seconds, 'rps': requests / seconds if seconds else 0.0}
+
+def print_report(result):
+    click.echo(f"{'step':<18}{'count':>7}{'errors':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}")
+    for step, s in sorted(result['steps'].items()):
+        click.echo(f"{step:<18}{s['count']:>7}{s['errors']:>7}{s['p50_ms']:>9.2f}{s['p95_ms']:>9.2f}"
+                   f"{s['p99_ms']:>9.2f}{s['rps']:>9.0f}")
+    click.echo(f"{result['requests']} requests in {result['seconds']:.2f}s, {result['rps']:.0f} req/s overall")
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@click.group()
+def cli():
+    """Booking lifecycle benchmark."""
+
+@cli.command()
+@click.option('--users', default=1000, show_default=True, help='Seeded users.')
+@click.option('--vehicles-per-user', default=1, show_default=True)
+@click.option('--lots', default=50, show_default=True, help='Seeded parking lots.')
+@click.option('--spots-per-lot', default=100, show_default=True)
+@click.option('--reservations', default=100000, show_default=True, help='Seeded past reservations.')
+@click.option('--virtual-users', default=200, show_default=True, help='Users driven through the lifecycle.')
+@click.option('--admin-rounds', default=20, show_default=True, help='Passes over the admin dashboards.')
+@click.option('--concurrency', default=1, show_default=True, help='Virtual users running at the same time.')
+@click.option('--seed', 'random_seed', default=42, show_default=True, help='Random seed of the synthetic data.')
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results as JSON.')
+def run(users, vehicles_per_user, lots, spots_per_lot, reservations, virtual_users, admin_rounds,
+        concurrency, random_seed, database, output):
+    """Seed a synthetic dataset and time the booking lifecycle and admin pages."""
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+
+    start = time.perf_counter()
+    with app.app_context():
+        seed(rng, users, vehicles_per_user, lots, spots_per_lot, reservations)
+        from models import ParkingLot
+        lot_ids = [lot.id for lot in ParkingLot.query.with_entities(ParkingLot.id)]
+    click.echo(f'Seeded {users} users, {lots} lots x {spots_per_lot} spots, {reservations} reservations '
+               f'in {time.perf_counter() - start:.1f}s ({database})')
+
+    timer = Timer()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # every virtual user gets its own random stream so runs repeat whatever the thread timing
+        jobs = [executor.submit(lifecycle, app, timer, number, lot_ids, random.Random(random_seed + number))
+                for number in range(virtual_users)]
+        jobs += [executor.submit(admin_round, app, timer) for _ in range(admin_rounds)]
+        for job in jobs:
+            job.result()
+    result = summarize(timer, time.perf_counter() - start)
+    result['meta'] = {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'params': dict(users=users, vehicles_per_user=vehicles_per_user, lots=lots, spots_per_lot=spots_per_lot,
+                       reservations=reservations, virtual_users=virtual_users, admin_rounds=admin_rounds,
+                       concurrency=concurrency, seed=random_seed),
+    }
+    print_report(result)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+        click.echo(f'Results written to {output}')
+
+@cli.command()
+@click.option('--lots', default=50000, show_default=True, help='Seeded parking lots.')
+@click.option('--full-share', default=0.3, show_default=True, help='Share of lots without a free spot.')
+@click.option('--queries', default=500, show_default=True, help='Nearest lot lookups to time.')
+@click.option('--limit', default=5, show_default=True, help='Lots returned per lookup.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+def nearest(lots, full_share, queries, limit, random_seed, database):
+    """Time "nearest lots with a free spot" with the R*Tree against a full scan."""
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+    # lots spread over India, denser around a few cities like real parking
+    cities = [(28.61, 77.21), (19.08, 72.88), (12.97, 77.59), (13.08, 80.27), (22.57, 88.36), (17.39, 78.49)]
+
+    def point():
+        if rng.random() < 0.8:
+            latitude, longitude = rng.choice(cities)
+            return latitude + rng.gauss(0, 0.15), longitude + rng.gauss(0, 0.15)
+        return rng.uniform(8, 35), rng.uniform(68, 97)
+
+    with app.app_context():
+        from models import db, ParkingLot
+        from geo import nearest_lots, distance_km, MAX_RADIUS_KM
+        rows = []
+        for n in range(lots):
+            latitude, longitude = point()
+            total = rng.randrange(10, 200)
+            rows.append(dict(name=f'Geo lot {n}', address=f'{n} Ring road', pincode='560001', total_spots=total,
+                             price_per_hour=30.0, occupied_count=total if rng.random() < full_share else 0,
+                             latitude=latitude, longitude=longitude))
+        _bulk_insert(ParkingLot, rows)
+        db.session.commit()
+        points = [point() for _ in range(queries)]
+
+        def full_scan(latitude, longitude):
+            free = db.session.execute(
+                db.select(ParkingLot.id, ParkingLot.latitude, ParkingLot.longitude)
+                .where(ParkingLot.occupied_count < ParkingLot.total_spots)
+            ).all()
+            return sorted((distance_km(latitude, longitude, lat, lon), id) for id, lat, lon in free)[:limit]
+
+        timings = {'rtree': [], 'full scan': []}
+        mismatches = 0
+        for latitude, longitude in points:
+            start = time.perf_counter()
+            found = nearest_lots(latitude, longitude, limit=limit)
+            timings['rtree'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            expected = full_scan(latitude, longitude)
+            timings['full scan'].append(time.perf_counter() - start)
+            expected = [id for distance, id in expected if distance <= MAX_RADIUS_KM]
+            mismatches += [lot.id for lot, _ in found] != expected
+            db.session.expire_all()
+
+    click.echo(f'{lots} lots ({full_share:.0%} full), {queries} lookups of the {limit} nearest free lots')
+    for name, samples in timings.items():
+        samples.sort()
+        click.echo(f'{name:<10} p50 {percentile(samples, 0.5) * 1000:8.2f} ms   p95 {percentile(samples, 0.95) * 1000:8.2f} ms'
+                   f'   p99 {percentile(samples, 0.99) * 1000:8.2f} ms')
+    click.echo(f'different results: {mismatches}')
+
+@cli.command()
+@click.option('--spots', default=200, show_default=True, help='Spots of the booked lot.')
+@click.option('--history', default=100000, show_default=True, help='Seeded past windows.')
+@click.option('--requests', 'request_count', default=20000, show_default=True, help='Overlapping windows to book.')
+@click.option('--days', default=7, show_default=True, help='Days ahead the booked windows fall in.')
+@click.option('--naive-queries', default=200, show_default=True, help='Free spot lookups checked against a full scan.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+def windows(spots, history, request_count, days, naive_queries, random_seed, database):
+    """Book many overlapping advance windows in one lot and time the overlap checks."""
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+
+    with app.app_context():
+        from models import db, ParkingSpot, Vehicle, AdvanceBooking
+        from advance import find_free_spot, reserve_window, HOLDING, WALKIN_HORIZON
+        from sqlalchemy import text
+        seed(rng, 200, 1, 1, spots, 0)
+        spot_rows = db.session.execute(db.select(ParkingSpot.id, ParkingSpot.lot_id).order_by(ParkingSpot.id)).all()
+        lot_id = spot_rows[0].lot_id
+        vehicles = db.session.execute(db.select(Vehicle.id, Vehicle.user_id)).all()
+
+        # back to back past windows on every spot, a year of history in total
+        now = datetime.now().replace(second=0, microsecond=0)
+        rows = []
+        per_spot = max(history // len(spot_rows), 1)
+        gap = timedelta(days=365) / per_spot
+        for spot_id, _ in spot_rows:
+            for n in range(per_spot):
+                vehicle_id, user_id = rng.choice(vehicles)
+                start = now - timedelta(days=365) + gap * n
+                rows.append(dict(user_id=user_id, lot_id=lot_id, spot_id=spot_id, vehicle_id=vehicle_id,
+                                 start_time=start, end_time=start + gap * rng.uniform(0.3, 1.0),
+                                 status='checked_in' if rng.random() < 0.9 else 'cancelled', created_at=start))
+        _bulk_insert(AdvanceBooking, rows)
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+
+        def window():
+            start = now + WALKIN_HORIZON + timedelta(minutes=rng.randrange(0, days * 24 * 60))
+            return start, start + timedelta(minutes=rng.randrange(30, 8 * 60))
+
+        timings = {'find free spot': [], 'book window': []}
+        booked = 0
+        for _ in range(request_count):
+            start, end = window()
+            vehicle_id, user_id = rng.choice(vehicles)
+            began = time.perf_counter()
+            find_free_spot(lot_id, start, end)
+            timings['find free spot'].append(time.perf_counter() - began)
+            began = time.perf_counter()
+            booked += reserve_window(user_id, lot_id, vehicle_id, start, end) is not None
+            db.session.commit()
+            timings['book window'].append(time.perf_counter() - began)
+
+        # the same lookups answered by reading every window of the lot
+        def full_scan(start, end):
+            taken = {spot_id for spot_id, in db.session.execute(
+                db.select(AdvanceBooking.spot_id)
+                .where(AdvanceBooking.lot_id == lot_id, AdvanceBooking.status.in_(HOLDING),
+                       AdvanceBooking.start_time < end, AdvanceBooking.end_time > start))}
+            return next((spot_id for spot_id, _ in spot_rows if spot_id not in taken), None)
+
+        timings['full scan'] = []
+        mismatches = 0
+        for _ in range(naive_queries):
+            start, end = window()
+            expected_start = time.perf_counter()
+            expected = full_scan(start, end)
+            timings['full scan'].append(time.perf_counter() - expected_start)
+            mismatches += find_free_spot(lot_id, start, end) != expected
+
+        # no two holding windows of a spot may overlap
+        overlaps = db.session.execute(text(
+            "SELECT COUNT(*) FROM (SELECT start_time, LAG(end_time) OVER (PARTITION BY spot_id ORDER BY start_time) AS previous_end "
+            "FROM advance_booking WHERE status IN ('booked', 'checked_in')) WHERE previous_end > start_time"
+        )).scalar()
+
+    click.echo(f'{spots} spots, {len(rows)} past windows, {request_count} requested windows over {days} days: '
+               f'{booked} booked, {request_count - booked} refused')
+    for name, samples in timings.items():
+        samples.sort()
+        click.echo(f'{name:<15} p50 {percentile(samples, 0.5) * 1000:8.2f} ms   p95 {percentile(samples, 0.95) * 1000:8.2f} ms'
+                   f'   p99 {percentile(samples, 0.99) * 1000:8.2f} ms')
+    click.echo(f'different results: {mismatches}, overlapping windows: {overlaps}')
+
+@cli.command('delete-lot')
+@click.option('--reservations', default=100000, show_default=True, help='Past reservations of each deleted lot.')
+@click.option('--spots', default=1000, show_default=True, help='Spots of each deleted lot.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+def delete_lot_command(reservations, spots, random_seed, database):
+    """Delete two identical lots, one through the ORM cascade and one set based."""
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+
+    with app.app_context():
+        from models import db, ParkingLot, ParkingSpot, Reservation, ReservationArchive
+        from provisioning import delete_lot
+        # the ORM cascade only knew the single reservation table
+        seed(rng, 1000, 1, 2, spots, reservations * 2, partitioned=False)
+        lot_ids = db.session.execute(db.select(ParkingLot.id).order_by(ParkingLot.id)).scalars().all()
+        counts = dict(db.session.execute(
+            db.select(Reservation.lot_id, db.func.count()).group_by(Reservation.lot_id)).all())
+        db.session.commit()
+
+        def orm_cascade(lot_id):
+            lot = db.session.get(ParkingLot, lot_id)
+            if any(spot.is_occupied for spot in lot.spots):
+                raise click.ClickException('Seeded lot has an occupied spot.')
+            db.session.delete(lot)
+
+        results = {}
+        for name, lot_id, delete in (('orm cascade', lot_ids[0], orm_cascade), ('set based', lot_ids[1], delete_lot)):
+            db.session.expire_all()
+            tracemalloc.start()
+            start = time.perf_counter()
+            delete(lot_id)
+            db.session.commit()
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = (lot_id, seconds, peak)
+
+        left = db.session.execute(db.select(db.func.count()).select_from(Reservation)).scalar()
+        left += db.session.execute(db.select(db.func.count()).select_from(ParkingSpot)).scalar()
+        archived = dict(db.session.execute(
+            db.select(ReservationArchive.lot_id, db.func.count()).group_by(ReservationArchive.lot_id)).all())
+
+    click.echo(f'lots of {spots} spots, {counts[lot_ids[0]]} and {counts[lot_ids[1]]} past reservations')
+    for name, (lot_id, seconds, peak) in results.items():
+        click.echo(f'{name:<12} {seconds * 1000:9.1f} ms   peak Python memory {peak / 2**20:7.1f} MiB   '
+                   f'archived {archived.get(lot_id, 0)} reservations')
+    click.echo(f'rows left behind: {left}')
+
+@cli.command()
+@click.option('--sizes', default='10000,100000,1000000', show_default=True,
+              help='Comma separated history sizes to time the lookups at, e.g. up to 10000000.')
+@click.option('--active', default=2000, show_default=True, help='Active reservations (cars parked now).')
+@click.option('--lots', default=50, show_default=True)
+@click.option('--spots-per-lot', default=100, show_default=True)
+@click.option('--users', default=5000, show_default=True, help='Seeded users, one vehicle each.')
+@click.option('--queries', default=2000, show_default=True, help='Lookups of each kind timed per size.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+def history(sizes, active, lots, spots_per_lot, users, queries, random_seed, database):
+    """Time the active reservation lookups as the reservation history grows."""
+    sizes = sorted(int(size) for size in sizes.split(','))
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+
+    with app.app_context():
+        from models import db, ParkingSpot, Vehicle, Reservation
+        from history import reservation_history
+        from sqlalchemy import Table, Column, Index, MetaData, insert, select, text
+        seed(rng, users, 1, lots, spots_per_lot, 0)
+        spots = db.session.execute(db.select(ParkingSpot.id, ParkingSpot.lot_id)).all()
+        vehicles = db.session.execute(db.select(Vehicle.id, Vehicle.user_id)).all()
+
+        # the same rows in one table with the indexes of the layout before history.py
+        single = Table('reservation_single', MetaData(),
+                       *[Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable)
+                         for c in Reservation.__table__.columns],
+                       Index('ix_reservation_single_user', 'user_id'),
+                       Index('ix_reservation_single_spot', 'spot_id'),
+                       Index('ix_reservation_single_vehicle', 'vehicle_id'),
+                       Index('ix_reservation_single_active_vehicle', 'vehicle_id',
+                             sqlite_where=text('leaving_timestamp IS NULL')))
+        single.create(db.session.connection())
+
+        now = datetime.now().replace(microsecond=0)
+        parked = []
+        for (spot_id, lot_id), (vehicle_id, user_id) in zip(rng.sample(spots, min(active, len(spots))),
+                                                            rng.sample(vehicles, min(active, len(vehicles)))):
+            parked.append(dict(user_id=user_id, lot_id=lot_id, spot_id=spot_id, vehicle_id=vehicle_id,
+                               parking_timestamp=now - timedelta(minutes=rng.randrange(1, 600)),
+                               leaving_timestamp=None, total_cost=None))
+        _bulk_insert(Reservation, parked)
+        last_id = db.session.execute(db.select(db.func.max(Reservation.id))).scalar() or 0
+        db.session.execute(insert(single).from_select([c.name for c in Reservation.__table__.columns],
+                                                      select(Reservation.__table__)))
+        db.session.commit()
+
+        def past(count):
+            for _ in range(count):
+                vehicle_id, user_id = rng.choice(vehicles)
+                spot_id, lot_id = rng.choice(spots)
+                start = now - timedelta(minutes=rng.randrange(60, 2 * 365 * 24 * 60))
+                minutes = rng.randrange(15, 12 * 60)
+                yield dict(user_id=user_id, lot_id=lot_id, spot_id=spot_id, vehicle_id=vehicle_id,
+                           parking_timestamp=start, leaving_timestamp=start + timedelta(minutes=minutes),
+                           total_cost=round(minutes / 60 * 30.0, 2), price_per_hour=30.0)
+
+        def timed(lookup):
+            samples = []
+            for _ in range(queries):
+                (vehicle_id, user_id), (spot_id, _) = rng.choice(vehicles), rng.choice(spots)
+                start = time.perf_counter()
+                lookup(vehicle_id, user_id, spot_id)
+                samples.append(time.perf_counter() - start)
+                db.session.expire_all()
+            return sorted(samples)
+
+        def history_page(vehicle_id, user_id, spot_id):
+            page = reservation_history('user_id')
+            return db.session.query(page).params(user_id=user_id).order_by(page.id.desc()).limit(20).all()
+
+        hot = Reservation.__table__
+        lookups = {
+            # bookings.book / delete_vehicle_post
+            'vehicle parked': (
+                lambda v, u, s: db.session.execute(
+                    select(hot.c.id).where(hot.c.vehicle_id == v, hot.c.leaving_timestamp.is_(None)).limit(1)).first(),
+                lambda v, u, s: db.session.execute(
+                    select(single.c.id).where(single.c.vehicle_id == v, single.c.leaving_timestamp.is_(None)).limit(1)).first()),
+            # view_reserve
+            'spot parked': (
+                lambda v, u, s: db.session.execute(
+                    select(hot.c.id).where(hot.c.spot_id == s, hot.c.leaving_timestamp.is_(None)).limit(1)).first(),
+                lambda v, u, s: db.session.execute(
+                    select(single.c.id).where(single.c.spot_id == s, single.c.leaving_timestamp.is_(None)).limit(1)).first()),
+            # parking_history, first page
+            'history page': (
+                history_page,
+                lambda v, u, s: db.session.execute(
+                    select(single).where(single.c.user_id == u).order_by(single.c.id.desc()).limit(20)).all()),
+        }
+
+        click.echo(f'{len(parked)} active reservations, {len(spots)} spots, {len(vehicles)} vehicles, '
+                   f'{queries} lookups of each kind per size')
+        click.echo(f"{'history':>10}  {'lookup':<15}{'split p50':>11}{'p95':>9}{'single p50':>12}{'p95':>9}  (ms)")
+        loaded = 0
+        for size in sizes:
+            while loaded < size:
+                rows = list(past(min(size - loaded, SEED_CHUNK_SIZE * 10)))
+                last_id = _bulk_insert_history(rows, last_id)
+                db.session.execute(insert(single), rows)
+                db.session.commit()
+                loaded += len(rows)
+            db.session.execute(text('ANALYZE'))
+            db.session.commit()
+            for name, (split_lookup, single_lookup) in lookups.items():
+                split_samples, single_samples = timed(split_lookup), timed(single_lookup)
+                click.echo(f'{size:>10}  {name:<15}{percentile(split_samples, 0.5) * 1000:>11.3f}'
+                           f'{percentile(split_samples, 0.95) * 1000:>9.3f}{percentile(single_samples, 0.5) * 1000:>12.3f}'
+                           f'{percentile(single_samples, 0.95) * 1000:>9.3f}')
+
+@cli.command()
+@click.option('--lots', default=400, show_default=True, help='Seeded parking lots.')
+@click.option('--spots-per-lot', default=100, show_default=True)
+@click.option('--reservations', default=1000000, show_default=True, help='Seeded past reservations.')
+@click.option('--occupied-share', default=0.5, show_default=True, help='Share of spots with a car parked now.')
+@click.option('--rounds', default=5, show_default=True, help='Times each report is built.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+def report(lots, spots_per_lot, reservations, occupied_share, rounds, random_seed, database):
+    """Time the admin summary figures: per lot loops, GROUP BY queries and the running counters."""
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+
+    with app.app_context():
+        from models import db, ParkingLot, ParkingSpot
+        from history import reservation_history, union_select
+        from reports import lot_revenue, lot_occupancy
+        from occupancy import repair_counters
+        start = time.perf_counter()
+        seed(rng, 1000, 1, lots, spots_per_lot, reservations)
+        spot_ids = db.session.execute(db.select(ParkingSpot.id)).scalars().all()
+        occupied = rng.sample(spot_ids, int(len(spot_ids) * occupied_share))
+        for chunk in _chunks(occupied):
+            db.session.execute(db.update(ParkingSpot).where(ParkingSpot.id.in_(chunk)).values(is_occupied=True))
+        repair_counters()
+        db.session.commit()
+        click.echo(f'Seeded {lots} lots x {spots_per_lot} spots, {reservations} reservations '
+                   f'in {time.perf_counter() - start:.1f}s ({database})')
+
+        # admin_summary before reports.py: every reservation and spot of every lot as ORM objects
+        def per_lot_loops():
+            revenue, occupancy = [], []
+            history = reservation_history('lot_id')
+            for lot in ParkingLot.query.order_by(ParkingLot.id).all():
+                reservations = db.session.query(history).params(lot_id=lot.id).all()
+                revenue.append((lot.id, lot.name, round(sum(float(r.total_cost or 0) for r in reservations
+                                                              if r.leaving_timestamp), 2)))
+                spots = ParkingSpot.query.filter_by(lot_id=lot.id).all()
+                taken = sum(1 for spot in spots if spot.is_occupied)
+                occupancy.append((lot.id, lot.name, taken, len(spots) - taken))
+            return revenue, occupancy
+
+        # the same figures from one GROUP BY per report, no maintained counters
+        def group_by():
+            past = union_select(lambda t: [t.c.leaving_timestamp.isnot(None)], ['lot_id', 'total_cost']).subquery()
+            totals = db.select(past.c.lot_id, db.func.sum(past.c.total_cost).label('total')).group_by(past.c.lot_id).subquery()
+            revenue = db.session.execute(
+                db.select(ParkingLot.id, ParkingLot.name, db.func.round(db.func.coalesce(totals.c.total, 0), 2))
+                .outerjoin(totals, totals.c.lot_id == ParkingLot.id).order_by(ParkingLot.id)).all()
+            taken = db.func.sum(db.case((ParkingSpot.is_occupied == True, 1), else_=0))
+            occupancy = db.session.execute(
+                db.select(ParkingLot.id, ParkingLot.name, db.func.coalesce(taken, 0),
+                          db.func.count(ParkingSpot.id) - db.func.coalesce(taken, 0))
+                .outerjoin(ParkingSpot, ParkingSpot.lot_id == ParkingLot.id)
+                .group_by(ParkingLot.id).order_by(ParkingLot.id)).all()
+            return [tuple(r) for r in revenue], [tuple(r) for r in occupancy]
+
+        # reports.py, what admin_summary runs
+        def counters():
+            return [(id, name, float(total)) for id, name, total in lot_revenue()], lot_occupancy()
+
+        results = {}
+        for name, build in (('per lot loops', per_lot_loops), ('group by', group_by), ('counters', counters)):
+            samples = []
+            for _ in range(rounds):
+                db.session.expire_all()
+                with count_statements() as statements:
+                    start = time.perf_counter()
+                    figures = build()
+                    samples.append(time.perf_counter() - start)
+            revenue, occupancy = figures
+            results[name] = (statements[0], sorted(samples), ([(i, n, round(float(t), 2)) for i, n, t in revenue],
+                                                              [tuple(r) for r in occupancy]))
+            db.session.rollback()
+
+    click.echo(f"{'report':<15}{'statements':>11}{'p50 ms':>10}{'max ms':>10}")
+    for name, (statements, samples, _) in results.items():
+        click.echo(f'{name:<15}{statements:>11}{percentile(samples, 0.5) * 1000:>10.1f}{samples[-1] * 1000:>10.1f}')
+    expected = results['per lot loops'][2]
+    different = [name for name, (_, _, figures) in results.items() if figures != expected]
+    click.echo(f'different figures: {", ".join(different) or "none"}')
+
+@cli.command()
+@click.option('--sizes', default='100,1000,2000,10000', show_default=True, help='Comma separated lot sizes (spots).')
+@click.option('--occupied-share', default=0.9, show_default=True, help='Share of spots with a car parked.')
+@click.option('--queries', default=500, show_default=True, help='Lookups and bookings timed per size.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+def allocate(sizes, occupied_share, queries, random_seed, database):
+    """Time picking and booking a free spot as lots grow: free list, indexed query and spot scan."""
+    sizes = sorted(int(size) for size in sizes.split(','))
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+
+    with app.app_context():
+        from models import db, ParkingLot, ParkingSpot, Vehicle
+        from provisioning import create_lot
+        from occupancy import repair_counters
+        from allocator import allocator, first_free_spot_db
+        from bookings import book, release
+        seed(rng, queries, 1, 0, 0, 0)
+        vehicles = db.session.execute(db.select(Vehicle.id, Vehicle.user_id)).all()
+
+        # book_lot before allocator.py: every spot of the lot loaded to find a free one
+        def spots_scan(lot_id):
+            lot = db.session.get(ParkingLot, lot_id)
+            return next((s.id for s in lot.spots if not s.is_occupied), None)
+
+        def timed(lookup, lot_id):
+            samples = []
+            for _ in range(queries):
+                db.session.expire_all()
+                start = time.perf_counter()
+                lookup(lot_id)
+                samples.append(time.perf_counter() - start)
+            return sorted(samples)
+
+        click.echo(f'{occupied_share:.0%} of the spots occupied, {queries} lookups and bookings per size')
+        click.echo(f"{'spots':>7}  {'free list':>10}{'indexed query':>15}{'spot scan':>11}{'book':>9}   (p50 ms)")
+        for size in sizes:
+            lot_id = create_lot(f'Lot of {size}', 'Ring road', '560001', 30.0, size).id
+            spot_ids = db.session.execute(db.select(ParkingSpot.id).where(ParkingSpot.lot_id == lot_id)).scalars().all()
+            # keep enough spots free for the timed bookings
+            taken = rng.sample(spot_ids, min(int(size * occupied_share), max(size - queries, 0)))
+            for chunk in _chunks(taken):
+                db.session.execute(db.update(ParkingSpot).where(ParkingSpot.id.in_(chunk)).values(is_occupied=True))
+            repair_counters()
+            db.session.commit()
+            allocator.invalidate(lot_id)
+
+            free_list = timed(allocator.first_free, lot_id)
+            indexed = timed(first_free_spot_db, lot_id)
+            scan = timed(spots_scan, lot_id)
+            db.session.rollback()
+            booking = []
+            for vehicle_id, user_id in vehicles:
+                start = time.perf_counter()
+                reservation = book(user_id, lot_id, vehicle_id)
+                booking.append(time.perf_counter() - start)
+                release(reservation)
+            booking.sort()
+            click.echo(f'{size:>7}  {percentile(free_list, 0.5) * 1000:>10.3f}{percentile(indexed, 0.5) * 1000:>15.3f}'
+                       f'{percentile(scan, 0.5) * 1000:>11.3f}{percentile(booking, 0.5) * 1000:>9.3f}')
+
+@cli.command()
+@click.option('--spots', default=200, show_default=True, help='Spots of the booked lot.')
+@click.option('--bookings', default=2000, show_default=True, help='Booking attempts, one vehicle each.')
+@click.option('--concurrency', default=32, show_default=True, help='Bookings running at the same time.')
+@click.option('--release-share', default=0.5, show_default=True, help='Share of the booked cars leaving right away.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+def stress(spots, bookings, concurrency, release_share, random_seed, database):
+    """Fire parallel bookings at one lot and fail on any double occupancy."""
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+
+    with app.app_context():
+        from models import db, ParkingLot, ParkingSpot, Vehicle, Reservation
+        from sqlalchemy import text
+        seed(rng, bookings, 1, 1, spots, 0)
+        lot_id = db.session.execute(db.select(ParkingLot.id)).scalar()
+        vehicles = db.session.execute(db.select(Vehicle.id, Vehicle.user_id)).all()
+        db.session.commit()
+
+    outcomes = {}
+    lock = threading.Lock()
+
+    def attempt(vehicle_id, user_id, leaves):
+        from bookings import book, release, BookingError
+        with app.app_context():
+            try:
+                reservation = book(user_id, lot_id, vehicle_id)
+                outcome = 'booked'
+                if leaves:
+                    release(reservation)
+            except BookingError as e:
+                outcome = e.reason
+        with lock:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        jobs = [executor.submit(attempt, vehicle_id, user_id, rng.random() < release_share)
+                for vehicle_id, user_id in vehicles]
+        for job in jobs:
+            job.result()
+    seconds = time.perf_counter() - start
+
+    with app.app_context():
+        # spots with two cars, cars parked twice, and occupied flags or counters out of step
+        shared = db.session.execute(text(
+            'SELECT COUNT(*) FROM (SELECT spot_id FROM reservation GROUP BY spot_id HAVING COUNT(*) > 1)')).scalar()
+        twice = db.session.execute(text(
+            'SELECT COUNT(*) FROM (SELECT vehicle_id FROM reservation GROUP BY vehicle_id HAVING COUNT(*) > 1)')).scalar()
+        parked = db.session.execute(db.select(db.func.count()).select_from(Reservation)).scalar()
+        occupied = db.session.execute(
+            db.select(db.func.count()).where(ParkingSpot.lot_id == lot_id, ParkingSpot.is_occupied == True)).scalar()
+        counter = db.session.get(ParkingLot, lot_id).occupied_count
+
+    click.echo(f'{bookings} bookings of one lot of {spots} spots, {concurrency} at a time: '
+               + ', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items())))
+    click.echo(f"{bookings / seconds:.0f} attempts/s, {outcomes.get('booked', 0) / seconds:.0f} bookings/s ({seconds:.2f}s)")
+    click.echo(f'parked now: {parked} reservations, {occupied} occupied spots, lot counter {counter}')
+    click.echo(f'spots with two cars: {shared}, vehicles parked twice: {twice}')
+    if shared or twice or not parked == occupied == counter:
+        raise click.ClickException('Double occupancy or counters out of step.')
+
+@cli.command()
+@click.option('--sizes', default='10000,100000', show_default=True, help='Comma separated lot sizes (spots).')
+@click.option('--spots-per-csv-lot', default=100, show_default=True, help='Size of the lots of the CSV import.')
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+def provision(sizes, spots_per_csv_lot, database):
+    """Time creating and halving big lots set based and through the ORM, and a CSV import."""
+    sizes = sorted(int(size) for size in sizes.split(','))
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+
+    with app.app_context():
+        from models import db, ParkingLot, ParkingSpot
+        from provisioning import create_lot, resize_lot, import_lots_command
+
+        def timed(action):
+            start = time.perf_counter()
+            result = action()
+            db.session.commit()
+            return time.perf_counter() - start, result
+
+        # add_lot_post / edit_lot_post before provisioning.py: one ORM object per spot
+        def orm_create(size):
+            lot = ParkingLot(name=f'ORM lot of {size}', address='Ring road', pincode='560001', total_spots=size,
+                             price_per_hour=30.0)
+            db.session.add(lot)
+            db.session.flush()
+            for n in range(size):
+                db.session.add(ParkingSpot(lot_id=lot.id, spot_number=n + 1, is_occupied=False))
+            return lot.id
+
+        def orm_shrink(lot_id, count):
+            for spot in (ParkingSpot.query.filter_by(lot_id=lot_id)
+                         .order_by(ParkingSpot.spot_number.desc()).limit(count).all()):
+                db.session.delete(spot)
+
+        click.echo(f"{'spots':>8}{'create':>10}{'halve':>10}{'ORM create':>12}{'ORM halve':>11}{'CSV import':>12}   (s)")
+        for size in sizes:
+            create, lot_id = timed(lambda: create_lot(f'Lot of {size}', 'Ring road', '560001', 30.0, size).id)
+            halve, _ = timed(lambda: resize_lot(lot_id, size - size // 2))
+            orm, orm_lot_id = timed(lambda: orm_create(size))
+            orm_halve, _ = timed(lambda: orm_shrink(orm_lot_id, size // 2))
+            db.session.expunge_all()
+
+            path = os.path.join(os.path.dirname(database), f'lots-{size}.csv')
+            with open(path, 'w') as f:
+                f.write('name,address,pincode,price,total_spots\n')
+                for n in range(max(size // spots_per_csv_lot, 1)):
+                    f.write(f'CSV lot {n},{n} Market road,560001,30,{spots_per_csv_lot}\n')
+            start = time.perf_counter()
+            result = app.test_cli_runner().invoke(import_lots_command, [path])
+            imported = time.perf_counter() - start
+            if result.exit_code:
+                raise click.ClickException(result.output)
+            click.echo(f'{size:>8}{create:>10.2f}{halve:>10.2f}{orm:>12.2f}{orm_halve:>11.2f}{imported:>12.2f}')
+
+@cli.command()
+@click.option('--users', default=100000, show_default=True, help='Seeded users.')
+@click.option('--lots', default=1000, show_default=True, help='Seeded parking lots.')
+@click.option('--queries', default=500, show_default=True, help='Searches timed per field.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to use (default: a temporary one).')
+def search(users, lots, queries, random_seed, database):
+    """Time the name and address searches with the FTS5 index against ilike."""
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+
+    with app.app_context():
+        from models import db, User, ParkingLot
+        from search import ranked_ids, SEARCH_LIMIT
+        seed(rng, users, 0, lots, 1, 0)
+
+        # the search bars before search.py
+        def ilike(model, field, query):
+            return db.session.execute(
+                db.select(model.id).where(getattr(model, field).ilike(f'%{query}%')).limit(SEARCH_LIMIT)
+            ).scalars().all()
+
+        click.echo(f'{users} users, {lots} lots, {queries} searches per field')
+        click.echo(f"{'search':<20}{'terms':<10}{'count':>6}{'fts p50':>9}{'p95':>9}{'ilike p50':>11}{'p95':>9}  (ms)")
+        for model, count in ((User, users), (ParkingLot, lots)):
+            for field in ('name', 'address'):
+                values = db.session.execute(db.select(getattr(model, field)).where(
+                    model.id.in_([rng.randrange(1, count + 1) for _ in range(queries)]))).scalars().all()
+                # a part of a real value, in another case, and a few misses (searches are stripped)
+                terms = []
+                for n in range(queries):
+                    if n % 10 == 0 or not values:
+                        terms.append(f'zz{n}q')
+                        continue
+                    value = rng.choice(values)
+                    start = rng.randrange(0, max(len(value) - 4, 1))
+                    terms.append(value[start:start + rng.randrange(4, 9)].strip().upper())
+                # terms found in a few rows, and terms found in most (the seeded text repeats a lot)
+                timings = {kind: {'fts': [], 'ilike': []} for kind in ('selective', 'common')}
+                different = 0
+                for term in terms:
+                    found, seconds = {}, {}
+                    for name, lookup in (('fts', ranked_ids), ('ilike', ilike)):
+                        start = time.perf_counter()
+                        found[name] = lookup(model, field, term)
+                        seconds[name] = time.perf_counter() - start
+                    kind = 'common' if len(found['ilike']) >= COMMON_MATCHES else 'selective'
+                    for name, value in seconds.items():
+                        timings[kind][name].append(value)
+                    # both return every match below the limit, in a different order
+                    if len(found['ilike']) < SEARCH_LIMIT:
+                        different += set(found['fts']) != set(found['ilike'])
+                for kind, samples in timings.items():
+                    fts, slow = sorted(samples['fts']), sorted(samples['ilike'])
+                    click.echo(f'{model.__tablename__ + "." + field:<20}{kind:<10}{len(fts):>6}{percentile(fts, 0.5) * 1000:>9.2f}'
+                               f'{percentile(fts, 0.95) * 1000:>9.2f}{percentile(slow, 0.5) * 1000:>11.2f}'
+                               f'{percentile(slow, 0.95) * 1000:>9.2f}')
+                click.echo(f'{"":<20}different results: {different}')
+
+# servers the booking flow is load tested under: name -> (module needed, command)
+SERVERS = {
+    'dev': (None, lambda port, workers, threads: [sys.executable, '-m', 'flask', '--app', 'app', 'run',
+                                                  '--port', str(port), '--no-reload', '--no-debugger']),
+    'waitress': ('waitress', lambda port, workers, threads: [sys.executable, '-m', 'waitress', '--host', '127.0.0.1',
+                                                              '--port', str(port), f'--threads={workers * threads}',
+                                                              '--call', 'wsgi:create_app']),
+    'gunicorn': ('gunicorn', lambda port, workers, threads: [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+                                                              '--threads', str(threads), '--bind', f'127.0.0.1:{port}',
+                                                              'wsgi:create_app()']),
+}
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# a logged in HTTP client of a running server, timing every request into `timer`
+class HttpClient:
+    def __init__(self, base_url, timer):
+        self.base_url = base_url
+        self.timer = timer
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, step, method, path, form=None, json_body=None):
+        data, headers = None, {}
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        elif json_body is not None:
+            data, headers = json.dumps(json_body).encode(), {'Content-Type': 'application/json'}
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method.upper())
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        except OSError:
+            status, body = 599, b''
+        seconds = time.perf_counter() - start
+        if step:
+            with self.timer._lock:
+                self.timer.samples.setdefault(step, []).append(seconds)
+                if status >= 400:
+                    self.timer.errors[step] = self.timer.errors.get(step, 0) + 1
+        return status, body
+
+@cli.command()
+@click.option('--servers', default='dev,waitress,gunicorn', show_default=True,
+              help='Comma separated servers to compare, the ones not installed are skipped.')
+@click.option('--workers', default=4, show_default=True, help='gunicorn workers (waitress gets workers x threads threads).')
+@click.option('--threads', default=4, show_default=True, help='Threads per gunicorn worker.')
+@click.option('--clients', default=16, show_default=True, help='Virtual users driving the booking flow at once.')
+@click.option('--duration', default=20.0, show_default=True, help='Seconds of load per server.')
+@click.option('--lots', default=20, show_default=True, help='Seeded parking lots.')
+@click.option('--spots-per-lot', default=100, show_default=True)
+@click.option('--reservations', default=50000, show_default=True, help='Seeded past reservations.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--database', type=click.Path(dir_okay=False), help='SQLite file to seed (default: a temporary one).')
+def serve(servers, workers, threads, clients, duration, lots, spots_per_lot, reservations, random_seed, database):
+    """Load test the booking flow over HTTP under the dev server, waitress and gunicorn."""
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='parking-bench-'), 'bench.sqlite3')
+    elif os.path.exists(database):
+        raise click.ClickException(f'{database} exists, the benchmark needs a new database.')
+    _prepare_environment(database)
+    app = _load_app()
+    rng = random.Random(random_seed)
+
+    with app.app_context():
+        from models import db, User, Vehicle, ParkingLot
+        from sqlalchemy import text
+        seed(rng, clients, 1, lots, spots_per_lot, reservations)
+        users = db.session.execute(
+            db.select(User.username, Vehicle.id).join(Vehicle, Vehicle.user_id == User.id).order_by(User.id)).all()
+        lot_ids = db.session.execute(db.select(ParkingLot.id)).scalars().all()
+        db.session.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+        db.session.remove()
+        db.engine.dispose()
+
+    # one virtual user: log in once, then dashboard -> book -> release -> history until the time is up
+    def drive(base_url, timer, username, vehicle_id, deadline, rng):
+        client = HttpClient(base_url, timer)
+        client.request(None, 'post', '/login', form=dict(username=username, password=PASSWORD))
+        while time.perf_counter() < deadline:
+            client.request('user', 'get', '/user')
+            status, body = client.request('book', 'post', f'/api/v1/lots/{rng.choice(lot_ids)}/bookings',
+                                          json_body=dict(vehicle_id=vehicle_id))
+            if status == 201:
+                client.request('release', 'post', f"/api/v1/reservations/{json.loads(body)['id']}/release")
+            client.request('parking_history', 'get', '/parking/history')
+
+    results = {}
+    for name in servers.split(','):
+        module, command = SERVERS[name]
+        if module and importlib.util.find_spec(module) is None:
+            click.echo(f'{name}: not installed, skipped')
+            continue
+        # every server starts from the same seeded database
+        server_database = os.path.join(os.path.dirname(database), f'{name}.sqlite3')
+        shutil.copy(database, server_database)
+        port = _free_port()
+        env = dict(os.environ, SQLALCHEMY_DATABASE_URI=f'sqlite:///{server_database}')
+        process = subprocess.Popen(command(port, workers, threads), env=env, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+        base_url = f'http://127.0.0.1:{port}'
+        try:
+            started = time.perf_counter()
+            while HttpClient(base_url, None).request(None, 'get', '/login')[0] != 200:
+                if process.poll() is not None or time.perf_counter() - started > 30:
+                    raise click.ClickException(f'{name} did not start.')
+                time.sleep(0.2)
+            timer = Timer()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                jobs = [executor.submit(drive, base_url, timer, username, vehicle_id, start + duration,
+                                        random.Random(random_seed + n))
+                        for n, (username, vehicle_id) in enumerate(users[:clients])]
+                for job in jobs:
+                    job.result()
+            results[name] = summarize(timer, time.perf_counter() - start)
+        finally:
+            process.terminate()
+            process.wait()
+
+    click.echo(f'{clients} clients for {duration:g}s per server, gunicorn {workers} workers x {threads} threads')
+    click.echo(f"{'server':<10}{'req/s':>8}{'errors':>8}" + ''.join(f'{step + " p95":>22}' for step in
+                                                                 ('user', 'book', 'release', 'parking_history')))
+    for name, result in results.items():
+        errors = sum(step['errors'] for step in result['steps'].values())
+        p95 = [result['steps'].get(step, {}).get('p95_ms', 0.0) for step in ('user', 'book', 'release', 'parking_history')]
+        click.echo(f"{name:<10}{result['rps']:>8.0f}{errors:>8}" + ''.join(f'{value:>19.1f} ms' for value in p95))
+
+@cli.command()
+@click.argument('baseline', type=click.File('r'))
+@click.argument('current', type=click.File('r'))
+@click.option('--metric', type=click.Choice(['p50_ms', 'p95_ms', 'p99_ms', 'mean_ms']), default='p95_ms', show_default=True)
+@click.option('--threshold', default=10.0, show_default=True, help='Allowed slowdown in percent.')
+def compare(baseline, current, metric, threshold):
+    """Compare two result files and fail if a step got slower than the threshold."""
+    baseline, current = json.load(baseline), json.load(current)
+    if baseline.get('meta', {}).get('params') != current.get('meta', {}).get('params'):
+        click.echo('Warning: the runs used different parameters.')
+    click.echo(f"{'step':<18}{'baseline':>10}{'current':>10}{'change':>9}")
+    regressions = []
+    for step in sorted(set(baseline['steps']) | set(current['steps'])):
+        old = baseline['steps'].get(step, {}).get(metric)
+        new = current['steps'].get(step, {}).get(metric)
+        if old is None or new is None:
+            click.echo(f"{step:<18}{'-' if old is None else f'{old:.2f}':>10}{'-' if new is None else f'{new:.2f}':>10}")
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        regressed = change > threshold and new - old > NOISE_FLOOR_MS
+        click.echo(f"{step:<18}{old:>10.2f}{new:>10.2f}{change:>+8.1f}%{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(step)
+    click.echo(f"overall req/s {baseline['rps']:.0f} -> {current['rps']:.0f}")
+    if regressions:
+        raise click.ClickException(f'{len(regressions)} step(s) slower than {threshold:g}% on {metric}: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    cli()
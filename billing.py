@@ -0,0 +1,93 @@
+from app import app
+from models import db
+from history import history_tables
+from occupancy import repair_counters
+from rollups import backfill
+from sqlalchemy import func, update, bindparam
+from decimal import Decimal
+import click
+
+
+#--------------------------------------------- Billing ---------------------------------------------
+# The charge of a reservation is always computed on the server from its timestamps and the lot
+# price it was booked at. Pricing rules come from the app config:
+#   BILLING_MINIMUM_CHARGE    smallest amount ever charged (default 0)
+#   BILLING_ROUNDING_MINUTES  bill time in started blocks of this many minutes, e.g. 60 for
+#                             per hour billing (default 0 = exact duration)
+#   BILLING_DAILY_CAP_HOURS   at most this many hours are billed per 24 hours (default None)
+# Single charges and batch audits share the same vectorized NumPy implementation.
+
+AUDIT_CHUNK_SIZE = 100000
+
+
+def _rules():
+    return (app.config.get('BILLING_MINIMUM_CHARGE', 0),
+            app.config.get('BILLING_ROUNDING_MINUTES', 0),
+            app.config.get('BILLING_DAILY_CAP_HOURS'))
+
+# charges for arrays of durations (seconds) and hourly rates, rounded to 2 decimals
+def charges(durations, rates):
+    import numpy as np
+    minimum, rounding, cap = _rules()
+    hours = np.maximum(np.asarray(durations, dtype=float), 0) / 3600
+    if rounding:
+        blocks = np.ceil(hours * 60 / rounding - 1e-9)
+        hours = blocks * rounding / 60
+    if cap is not None:
+        days = np.floor(hours / 24)
+        hours = days * min(cap, 24) + np.minimum(hours - days * 24, cap)
+    cost = np.maximum(hours * np.asarray(rates, dtype=float), minimum)
+    return np.round(cost, 2)
+
+def charge(parking_timestamp, leaving_timestamp, price_per_hour):
+    seconds = (leaving_timestamp - parking_timestamp).total_seconds()
+    return Decimal(str(float(charges([seconds], [price_per_hour])[0]))).quantize(Decimal('0.01'))
+
+
+#---------------------------------------------- Audit ----------------------------------------------
+
+# stream completed reservations in chunks, partition by partition, and yield
+# (table, ids, stored costs, expected costs) arrays. The expected cost uses the price the
+# reservation was booked at, it is NaN for reservations released before that price was kept
+# (migration 13): today's lot price says nothing about what they were charged.
+def audit_chunks(chunk_size=AUDIT_CHUNK_SIZE):
+    import numpy as np
+    for table in history_tables(archived=True):
+        seconds = (func.julianday(table.c.leaving_timestamp) - func.julianday(table.c.parking_timestamp)) * 86400
+        query = (db.select(table.c.id, seconds, table.c.price_per_hour, table.c.total_cost)
+                 .where(table.c.leaving_timestamp.isnot(None))
+                 .execution_options(yield_per=chunk_size))
+        for rows in db.session.execute(query).partitions():
+            ids, durations, rates, stored = zip(*rows)
+            stored = np.array([np.nan if cost is None else float(cost) for cost in stored])
+            rates = np.array([np.nan if rate is None else rate for rate in rates], dtype=float)
+            yield table, np.array(ids), stored, charges(durations, rates)
+
+@app.cli.command('audit-billing')
+@click.option('--fix', is_flag=True, help='Store the recomputed charge where it differs, with the lot counters and rollups.')
+def audit_billing_command(fix):
+    """Recompute the charge of every completed reservation with the price it was booked at."""
+    import numpy as np
+    checked = wrong = unknown = 0
+    fixes = {}      # table -> [{'reservation_id': ..., 'cost': ...}, ...]
+    for table, ids, stored, expected in audit_chunks():
+        known = ~np.isnan(expected)
+        bad = known & (np.isnan(stored) | (np.abs(stored - expected) >= 0.01))
+        checked += int(known.sum())
+        unknown += int((~known).sum())
+        wrong += int(bad.sum())
+        if fix:
+            fixes.setdefault(table, []).extend({'reservation_id': int(i), 'cost': float(c)}
+                                               for i, c in zip(ids[bad], expected[bad]))
+    if any(fixes.values()):
+        for table, rows in fixes.items():
+            if rows:
+                db.session.execute(update(table).where(table.c.id == bindparam('reservation_id'))
+                                   .values(total_cost=bindparam('cost')), rows)
+        # the lot revenue counters and the usage rollups summed the old charges
+        repair_counters()
+        backfill()
+        db.session.commit()
+    click.echo(f'Checked {checked} reservation(s), {wrong} with a different charge' + (', fixed.' if fix else '.'))
+    if unknown:
+        click.echo(f'{unknown} reservation(s) released before their price was kept were not checked.')
@@ -0,0 +1,156 @@
+from models import db, ParkingLot, ParkingSpot, Reservation, Vehicle
+from advance import reserve_window, vehicle_is_booked, MAX_WINDOW, MIN_WINDOW, MAX_DAYS_AHEAD, CHECKIN_EARLY
+from occupancy import occupy, vacate
+from billing import charge
+from rollups import record_release
+from history import move_to_history
+from allocator import allocator, claim_spot
+from events import publish_lot
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from datetime import datetime, timedelta
+
+
+#--------------------------------------------- Bookings --------------------------------------------
+# Booking and releasing a spot, shared by the HTML routes and the JSON API. Both functions
+# commit and then publish the new availability of the lot (events.py); a refused booking
+# raises BookingError with a reason the caller turns into a flash message and redirect, or
+# an HTTP status. Windows booked ahead (advance.py) are booked here too and become a
+# reservation when the driver checks in.
+
+# the hourly rate of a reservation, the lot price when it was booked
+def booked_price(reservation):
+    if reservation.price_per_hour is None:
+        return reservation.parkinglot.price_per_hour
+    return reservation.price_per_hour
+
+
+class BookingError(Exception):
+    # reason is 'vehicle' (not found / not owned), 'booked' (vehicle already parked or booked
+    # for the window), 'full', 'window' (a window that can't be booked or checked in now) or
+    # 'released' (the reservation was released meanwhile)
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def _owned_vehicle(user_id, vehicle_id):
+    vehicle = Vehicle.query.filter_by(id=vehicle_id, user_id=user_id).first()
+    if not vehicle:
+        raise BookingError('vehicle', f'Vehicle {vehicle_id} not found or not owned by the user.')
+    return vehicle
+
+# reserve a spot of a lot for a vehicle of the user, `spot_id` is the spot offered to the user
+# (`booking` is the advance booking being checked in, it may claim the spot it holds)
+def book(user_id, lot_id, vehicle_id, spot_id=None, booking=None):
+    vehicle = _owned_vehicle(user_id, vehicle_id)
+
+    # Check if given vehicle has already a reserved spot in any lot (the unique index on the
+    # active reservations of a vehicle refuses the one that commits second)
+    vehicle_number = vehicle.vehicle_number
+    reservation = Reservation.query.filter_by(vehicle_id=vehicle.id, leaving_timestamp=None).first()
+    if reservation:
+        if reservation.lot_id == lot_id:
+            raise BookingError('booked', f'You have already booked a spot for vehicle : {vehicle.vehicle_number} in this parking lot.')
+        raise BookingError('booked', f'You already booked a spot for vehicle : {vehicle.vehicle_number}')
+
+    # Claim the offered spot, or the next free one if somebody took it meanwhile
+    try:
+        spot_id = claim_spot(lot_id, spot_id, ignore_booking_id=booking and booking.id)
+        if not spot_id:
+            db.session.rollback()
+            raise BookingError('full', 'No vacant spots available in this lot.')
+        occupy(lot_id)
+        reservation = Reservation(
+            user_id=user_id,
+            lot_id=lot_id,
+            spot_id=spot_id,
+            vehicle_id=vehicle.id,
+            parking_timestamp=datetime.now(),
+            leaving_timestamp=None,
+            total_cost=None,
+            price_per_hour=db.session.get(ParkingLot, lot_id).price_per_hour,
+        )
+        db.session.add(reservation)
+        if booking:
+            db.session.flush()
+            booking.status = 'checked_in'
+            booking.reservation_id = reservation.id
+        db.session.commit()
+    except BookingError:
+        raise
+    except IntegrityError:
+        db.session.rollback()
+        allocator.invalidate(lot_id)
+        raise BookingError('booked', f'You already booked a spot for vehicle : {vehicle_number}')
+    except Exception:
+        db.session.rollback()
+        allocator.invalidate(lot_id)
+        raise
+    publish_lot(lot_id, -1, spot_id=spot_id, occupied=True)
+    return reservation
+
+# end an active reservation, the charge is computed here from the timestamps and the price of
+# the lot when it was booked (booked_price). The reservation moves to the history partitions
+# (history.py) and is detached from the session.
+# Like claim_spot() the release is a conditional UPDATE, so of two concurrent releases (a double
+# submitted form) exactly one goes through and the other gets BookingError('released').
+def release(reservation):
+    leaving_timestamp = datetime.now()
+    total_cost = charge(reservation.parking_timestamp, leaving_timestamp, booked_price(reservation))
+    result = db.session.execute(
+        update(Reservation)
+        .where(Reservation.id == reservation.id, Reservation.leaving_timestamp.is_(None))
+        .values(leaving_timestamp=leaving_timestamp, total_cost=total_cost)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        raise BookingError('released', 'This reservation has already been released.')
+    set_committed_value(reservation, 'leaving_timestamp', leaving_timestamp)
+    set_committed_value(reservation, 'total_cost', total_cost)
+    lot_id, spot_id = reservation.lot_id, reservation.spot_id
+    db.session.execute(
+        update(ParkingSpot).where(ParkingSpot.id == spot_id).values(is_occupied=False)
+        .execution_options(synchronize_session=False)
+    )
+    vacate(lot_id, total_cost)
+    record_release(reservation)
+    move_to_history(reservation)
+    db.session.commit()
+    allocator.mark_free(lot_id, spot_id)
+    publish_lot(lot_id, 1, spot_id=spot_id, occupied=False)
+    return reservation
+
+# book a spot of a lot for a vehicle of the user during [start, end)
+def book_window(user_id, lot_id, vehicle_id, start, end):
+    now = datetime.now()
+    if end - start < MIN_WINDOW or end - start > MAX_WINDOW:
+        raise BookingError('window', f'A booking lasts from {MIN_WINDOW.seconds // 60} minutes '
+                                     f'to {MAX_WINDOW.total_seconds() / 3600:g} hours.')
+    if start < now or start > now + timedelta(days=MAX_DAYS_AHEAD):
+        raise BookingError('window', f'A booking starts within the next {MAX_DAYS_AHEAD} days.')
+    vehicle = _owned_vehicle(user_id, vehicle_id)
+    if vehicle_is_booked(vehicle.id, start, end):
+        raise BookingError('booked', f'Vehicle : {vehicle.vehicle_number} is already booked during this time.')
+    try:
+        booking = reserve_window(user_id, lot_id, vehicle.id, start, end)
+        if not booking:
+            db.session.rollback()
+            raise BookingError('full', 'No spot of this lot is free during this time.')
+        db.session.commit()
+    except BookingError:
+        raise
+    except Exception:
+        db.session.rollback()
+        raise
+    return booking
+
+# park on the spot held by an advance booking, or on another free spot of the lot if a
+# walk-in is still parked there. Returns the new reservation.
+def check_in(booking):
+    now = datetime.now()
+    if booking.status != 'booked' or not booking.start_time - CHECKIN_EARLY <= now < booking.end_time:
+        raise BookingError('window', 'This booking can not be checked in now.')
+    return book(booking.user_id, booking.lot_id, booking.vehicle_id, booking.spot_id, booking=booking)
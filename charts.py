@@ -0,0 +1,200 @@
+from app import app
+from metrics import observe_chart
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import BytesIO
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+#---------------------------------------- Chart service -----------------------------------------
+# Charts are drawn with the object oriented Figure API (no global pyplot state) in a small
+# worker pool. Every chart is keyed by a hash of its kind and input data, so the same data
+# is rendered only once and then served from memory or from the disk cache. The kind and data
+# of a requested chart are saved next to it in CHART_DIR, so any worker process sharing the
+# directory can draw a chart that another one was asked for.
+
+CHART_DIR = os.path.join(app.instance_path, 'charts')
+MEMORY_LIMIT = 64       # charts kept in memory
+DISK_LIMIT = 512        # charts kept in CHART_DIR
+FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='chart')
+_lock = threading.Lock()
+_memory = OrderedDict()   # key -> bytes, least recently used first
+_pending = {}             # key -> Future of a chart being rendered
+
+
+def _revenue_donut(fig, data):
+    ax = fig.add_subplot()
+    if sum(data['values']) > 0:
+        ax.pie(data['values'], labels=data['labels'], autopct='%1.1f%%',
+               startangle=140, wedgeprops=dict(width=0.4))
+    else:
+        ax.text(0.5, 0.5, 'No revenue yet', ha='center', va='center')
+        ax.axis('off')
+    ax.set_title('Revenue Distribution by Lot')
+
+def _occupancy_bar(fig, data):
+    ax = fig.add_subplot()
+    x = range(len(data['labels']))
+    ax.bar(x, data['available'], width=0.4, label='Available', align='center')
+    ax.bar(x, data['occupied'], width=0.4, bottom=data['available'], label='Occupied', align='center')
+    ax.set_xticks(list(x), data['labels'], rotation=45)
+    ax.set_ylabel('Number of Spots')
+    ax.set_title('Parking Spot Summary by Lot')
+    ax.legend()
+
+def _user_usage_bar(fig, data):
+    ax = fig.add_subplot()
+    ax.bar(data['labels'], data['values'], color='green')
+    ax.set_xlabel('Parking Lots')
+    ax.set_ylabel('No. of Used Spots')
+    ax.set_title('Summary of Used Parking Spots')
+    ax.tick_params(axis='x', labelrotation=45)
+
+def _occupancy_trend(fig, data):
+    ax = fig.add_subplot()
+    ax.plot(range(len(data['labels'])), data['values'], marker='.')
+    _trend_ticks(ax, data['labels'])
+    ax.set_ylim(bottom=0)
+    ax.set_ylabel('Occupancy (%)')
+    ax.set_title(data['title'])
+
+def _revenue_trend(fig, data):
+    ax = fig.add_subplot()
+    ax.bar(range(len(data['labels'])), data['values'], color='green')
+    _trend_ticks(ax, data['labels'])
+    ax.set_ylabel('Revenue')
+    ax.set_title(data['title'])
+
+# at most ~12 labelled ticks on a time axis
+def _trend_ticks(ax, labels):
+    step = max(1, len(labels) // 12)
+    ticks = list(range(0, len(labels), step))
+    ax.set_xticks(ticks, [labels[i] for i in ticks], rotation=45, ha='right')
+
+CHARTS = {
+    'revenue_donut': (_revenue_donut, (6.4, 4.8)),
+    'occupancy_bar': (_occupancy_bar, (8, 6)),
+    'user_usage_bar': (_user_usage_bar, (8, 5)),
+    'occupancy_trend': (_occupancy_trend, (10, 4.5)),
+    'revenue_trend': (_revenue_trend, (10, 4.5)),
+}
+
+
+def chart_key(kind, data, fmt='png'):
+    payload = json.dumps([kind, data, fmt], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _disk_path(key, fmt):
+    return os.path.join(CHART_DIR, f'{key}.{fmt}')
+
+def _spec_path(key):
+    return os.path.join(CHART_DIR, f'{key}.json')
+
+# write a file of CHART_DIR in one step, readers never see it half written
+def _write(path, content):
+    os.makedirs(CHART_DIR, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def _remember(key, content):
+    with _lock:
+        _memory[key] = content
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_LIMIT:
+            _memory.popitem(last=False)
+
+def _evict_disk():
+    files = [os.path.join(CHART_DIR, f) for f in os.listdir(CHART_DIR) if not f.endswith('.tmp')]
+    if len(files) <= DISK_LIMIT:
+        return
+    files.sort(key=os.path.getmtime)
+    for path in files[:len(files) - DISK_LIMIT]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _render(kind, data, fmt, key):
+    try:
+        # matplotlib is slow to import, so only chart workers pay for it
+        from matplotlib.figure import Figure
+        start = time.perf_counter()
+        draw, figsize = CHARTS[kind]
+        fig = Figure(figsize=figsize)
+        draw(fig, data)
+        fig.tight_layout()
+        buffer = BytesIO()
+        fig.savefig(buffer, format=fmt)
+        content = buffer.getvalue()
+        observe_chart(kind, time.perf_counter() - start)
+
+        _write(_disk_path(key, fmt), content)
+        _evict_disk()
+        _remember(key, content)
+        return content
+    finally:
+        with _lock:
+            _pending.pop(key, None)
+
+
+# queue a chart for rendering (if not already cached) and return its key
+def request_chart(kind, data, fmt='png'):
+    key = chart_key(kind, data, fmt)
+    with _lock:
+        if key in _memory or key in _pending:
+            return key
+    if os.path.exists(_disk_path(key, fmt)):
+        return key
+    # drawn from the saved JSON in every process alike (Decimal amounts become floats)
+    spec = json.dumps({'kind': kind, 'data': data, 'format': fmt},
+                      default=lambda v: float(v) if isinstance(v, Decimal) else str(v))
+    _write(_spec_path(key), spec.encode())
+    _submit(kind, json.loads(spec)['data'], fmt, key)
+    return key
+
+def _submit(kind, data, fmt, key):
+    with _lock:
+        future = _pending.get(key)
+        if future is None:
+            future = _pending[key] = _executor.submit(_render, kind, data, fmt, key)
+    return future
+
+# draw a chart requested from another process (or evicted from disk) from its saved kind and data
+def _render_saved(key, fmt):
+    try:
+        with open(_spec_path(key)) as f:
+            spec = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if spec.get('kind') not in CHARTS or spec.get('format') != fmt:
+        return None
+    return _submit(spec['kind'], spec['data'], fmt, key).result()
+
+# rendered chart bytes for a key, waiting for the worker if it is still rendering
+def get_chart(key, fmt='png'):
+    with _lock:
+        content = _memory.get(key)
+        if content is not None:
+            _memory.move_to_end(key)
+            return content
+        future = _pending.get(key)
+    if future is not None:
+        return future.result()
+    path = _disk_path(key, fmt)
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        os.utime(path)
+    except OSError:
+        return _render_saved(key, fmt)
+    _remember(key, content)
+    return content
@@ -6,4 +6,40 @@ from app import app
 
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS')
\ No newline at end of file
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS')
+
+# Database engine : SQLAlchemy pool options, and pragmas applied to every new SQLite connection
+engine_options = {'pool_pre_ping': True}
+if os.getenv('DB_POOL_SIZE'):
+    engine_options['pool_size'] = int(os.getenv('DB_POOL_SIZE'))
+    engine_options['max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),    # readers don't block the writer
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),   # safe with WAL, far fewer fsyncs
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)),  # ms to wait for the write lock
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+}
+
+# Availability events (events.py) : redis:// url of the broker shared by all workers (default
+# in-process). The streams are served by the event stream server (eventstream.py), up to
+# SSE_MAX_SUBSCRIBERS per process; EVENT_STREAM_URL is its address when the pages can't reach it
+# at /events/availability of their own origin (set by `python app.py`). A WSGI worker serving
+# the streams itself holds a thread for each, so it keeps SSE_MAX_THREAD_STREAMS of them, below
+# its threads (gunicorn --threads 4, waitress 8), and asks the next ones to come back later.
+app.config['EVENT_BROKER_URL'] = os.getenv('EVENT_BROKER_URL')
+app.config['EVENT_STREAM_URL'] = os.getenv('EVENT_STREAM_URL')
+app.config['SSE_MAX_SUBSCRIBERS'] = int(os.getenv('SSE_MAX_SUBSCRIBERS', 5000))
+app.config['SSE_MAX_THREAD_STREAMS'] = int(os.getenv('SSE_MAX_THREAD_STREAMS', 2))
+
+# Instrumentation (metrics.py) : off unless METRICS_ENABLED is set. METRICS_SLOW_REQUEST_MS logs
+# slower requests with their SQL, METRICS_TOKEN lets a scraper read /admin/metrics without a login
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+app.config['METRICS_SLOW_REQUEST_MS'] = float(os.getenv('METRICS_SLOW_REQUEST_MS')) if os.getenv('METRICS_SLOW_REQUEST_MS') else None
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+
+# Background jobs (jobs.py) : run by `flask run-jobs`, or by a thread of the web process when
+# JOB_WORKER_IN_PROCESS is set (always with `python app.py`); JOB_POLL_SECONDS between looks for new jobs
+app.config['JOB_WORKER_IN_PROCESS'] = os.getenv('JOB_WORKER_IN_PROCESS', '').lower() in ('1', 'true', 'yes')
+app.config['JOB_POLL_SECONDS'] = float(os.getenv('JOB_POLL_SECONDS', 1))
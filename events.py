@@ -0,0 +1,269 @@
+from app import app
+from models import db, ParkingLot
+from collections import defaultdict
+import asyncio
+import click
+import json
+import queue
+import threading
+import time
+
+
+#------------------------------------------ Availability events ------------------------------------
+# Bookings, releases and lot/spot edits publish an availability event after they commit. The
+# broker fans every event out to the in-memory queues of the subscribers of that lot (one
+# publish per change, however many clients watch), and the SSE route in routes.py streams a
+# subscriber's queue to the browser, so watching clients never poll the database.
+#
+# LocalBroker delivers inside one process. With several workers set EVENT_BROKER_URL to a
+# redis:// url: RedisBroker publishes through Redis and one listener thread per worker feeds
+# the same local fan-out (needs the redis package). The streams themselves are served by the
+# asyncio server of eventstream.py, or by the SSE route of a WSGI worker (a thread each).
+
+SUBSCRIBER_QUEUE_SIZE = 100     # events buffered per subscriber, the oldest are dropped
+ALL_LOTS = None                 # topic of subscribers that watch every lot
+BUSY_RETRY_MS = 30000           # a stream refused for lack of room comes back after this
+SSE_KEEPALIVE = 15              # seconds between keep-alive comments on an idle stream
+
+
+class Subscription:
+    def __init__(self, broker, lot_ids):
+        self.broker = broker
+        self.lot_ids = lot_ids
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, event):
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                # slow client, drop its oldest event rather than blocking the publisher
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    # next event, or None after `timeout` seconds without one
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+# a subscription read by a coroutine running on `loop` (eventstream.py), the publishers run
+# in other threads and wake it with call_soon_threadsafe
+class AsyncSubscription(Subscription):
+    def __init__(self, broker, lot_ids, loop):
+        super().__init__(broker, lot_ids)
+        self.loop = loop
+        self.ready = asyncio.Event()
+
+    def put(self, event):
+        super().put(event)
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    # next event, or None after `timeout` seconds without one
+    async def next(self, timeout):
+        while True:
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.ready.clear()
+            if not self.queue.empty():
+                continue
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+
+class LocalBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._topics = defaultdict(set)     # lot_id (or ALL_LOTS) -> subscriptions
+        self._count = 0
+
+    # subscribe to some lots, or to every lot when lot_ids is empty. With an event loop the
+    # subscription is read by a coroutine of that loop.
+    def subscribe(self, lot_ids=(), loop=None):
+        lot_ids = tuple(lot_ids) or (ALL_LOTS,)
+        subscription = AsyncSubscription(self, lot_ids, loop) if loop else Subscription(self, lot_ids)
+        with self._lock:
+            for lot_id in subscription.lot_ids:
+                self._topics[lot_id].add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            self._count -= 1
+            for lot_id in subscription.lot_ids:
+                subscribers = self._topics.get(lot_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._topics[lot_id]
+
+    def subscriber_count(self):
+        return self._count
+
+    def publish(self, event):
+        self.deliver(event)
+
+    def deliver(self, event):
+        with self._lock:
+            subscribers = self._topics.get(event['lot_id'], set()) | self._topics.get(ALL_LOTS, set())
+        for subscription in subscribers:
+            subscription.put(event)
+
+
+class RedisBroker(LocalBroker):
+    CHANNEL = 'parking.availability'
+
+    def __init__(self, url):
+        super().__init__()
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('EVENT_BROKER_URL needs the redis package (pip install redis).')
+        self._redis = redis.Redis.from_url(url)
+        self._listener = threading.Thread(target=self._listen, name='event-listener', daemon=True)
+        self._listener.start()
+
+    def publish(self, event):
+        self._redis.publish(self.CHANNEL, json.dumps(event))
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                for message in pubsub.listen():
+                    self.deliver(json.loads(message['data']))
+            except Exception:
+                app.logger.exception('Lost the event broker connection, reconnecting')
+                time.sleep(1)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                url = app.config.get('EVENT_BROKER_URL')
+                _broker = RedisBroker(url) if url else LocalBroker()
+    return _broker
+
+
+#-------------------------------------------- Publishing -------------------------------------------
+
+def availability_event(lot, **changes):
+    return {
+        'lot_id': lot.id,
+        'total_spots': lot.total_spots,
+        'free_spots': lot.total_spots - lot.occupied_count,
+        'version': lot.occupancy_version,
+        **changes,
+    }
+
+# publish the availability of a lot after a committed change. `delta` is the change in free
+# spots, `spot_id`/`occupied` name the spot that changed (book, release, spot delete).
+def publish_lot(lot_id, delta=0, **changes):
+    lot = db.session.execute(
+        db.select(ParkingLot.id, ParkingLot.total_spots, ParkingLot.occupied_count, ParkingLot.occupancy_version)
+        .where(ParkingLot.id == lot_id)
+    ).first()
+    if lot is None:
+        event = {'lot_id': lot_id, 'deleted': True}
+    else:
+        event = availability_event(lot, delta=delta, **changes)
+    try:
+        get_broker().publish(event)
+    except Exception:
+        # the change is committed, a lost event only delays the clients' view
+        app.logger.exception('Could not publish availability of lot %s', lot_id)
+
+# one event in text/event-stream format
+def sse_format(event):
+    if 'version' in event:
+        event_id = f"{event['lot_id']}-{event['version']}"
+    else:
+        event_id = f"{event['lot_id']}-deleted"
+    return f"event: availability\nid: {event_id}\ndata: {json.dumps(event)}\n\n"
+
+# the whole stream sent to a client refused for lack of room: the browser reconnects after
+# `retry` and the page polls the availability API meanwhile
+def sse_busy():
+    return f"retry: {BUSY_RETRY_MS}\nevent: busy\ndata: {{}}\n\n"
+
+
+#-------------------------------------------- Benchmark --------------------------------------------
+
+@app.cli.command('bench-events')
+@click.option('--subscribers', type=int, default=1000, show_default=True)
+@click.option('--events', 'event_count', type=int, default=200, show_default=True)
+@click.option('--lots', type=int, default=50, show_default=True)
+@click.option('--http', is_flag=True, help='Stream over HTTP from the event stream server (eventstream.py) '
+                                           'instead of reading the broker from one thread per subscriber.')
+def bench_events_command(subscribers, event_count, lots, http):
+    """Measure fan-out of the broker to many concurrent subscribers."""
+    broker = get_broker() if http else LocalBroker()
+
+    def publish():
+        for n in range(event_count):
+            broker.publish({'lot_id': n % lots + 1, 'sent': time.perf_counter()})
+        for lot_id in range(1, lots + 1):
+            broker.publish({'lot_id': lot_id, 'stop': True})
+
+    start = time.perf_counter()
+    if http:
+        from eventstream import bench_streams
+        app.config['SSE_MAX_SUBSCRIBERS'] = max(app.config['SSE_MAX_SUBSCRIBERS'], subscribers)
+        results, start = bench_streams(subscribers, lots, publish)
+    else:
+        results = []
+        lock = threading.Lock()
+
+        def consume(subscription):
+            count = 0
+            lags = []
+            while True:
+                event = subscription.get()
+                if event is None or event.get('stop'):
+                    break
+                count += 1
+                lags.append(time.perf_counter() - event['sent'])
+            with lock:
+                results.append((count, lags))
+
+        subscriptions = [broker.subscribe([n % lots + 1]) for n in range(subscribers)]
+        threads = [threading.Thread(target=consume, args=(s,), daemon=True) for s in subscriptions]
+        for thread in threads:
+            thread.start()
+        start = time.perf_counter()
+        publish()
+        for thread in threads:
+            thread.join(timeout=30)
+    total_seconds = time.perf_counter() - start
+
+    latencies = sorted(lag for _, lags in results for lag in lags)
+    delivered = sum(count for count, _ in results)
+    click.echo(f'{subscribers} {"HTTP streams" if http else "subscribers"} on {lots} lots, {event_count} events')
+    click.echo(f'delivered {delivered} in {total_seconds * 1000:.1f} ms ({delivered / total_seconds:.0f}/s)')
+    if latencies:
+        for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            click.echo(f'{name} delivery latency: {latencies[int(q * (len(latencies) - 1))] * 1000:.2f} ms')
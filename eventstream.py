@@ -0,0 +1,195 @@
+from app import app
+from events import get_broker, sse_format, sse_busy, SSE_KEEPALIVE
+from urllib.parse import urlsplit, parse_qs
+from http.cookies import SimpleCookie
+import asyncio
+import click
+import json
+import threading
+import time
+
+
+#--------------------------------------- Event stream server ---------------------------------------
+# A WSGI worker holds a thread for every open availability stream, so routes.py serves only a
+# few per worker. This asyncio server (standard library only) serves them instead: an open
+# stream is a coroutine waiting on its subscription (events.AsyncSubscription), so one process
+# keeps thousands of dashboards live without a thread each. It answers GET /events/availability
+# only, authenticated by the session cookie of the Flask app.
+#
+#   flask --app app serve-events --port 5001   next to the web workers, with EVENT_BROKER_URL so
+#                                              it receives their events; the reverse proxy sends
+#                                              /events/ to it, unbuffered
+#   python app.py                              runs it in a thread of the development server,
+#                                              the pages connect to EVENT_STREAM_URL
+#
+# Past SSE_MAX_SUBSCRIBERS streams a client gets events.sse_busy(): the browser reconnects
+# later and the page polls the availability API meanwhile.
+
+STREAM_PATH = '/events/availability'
+REQUEST_TIMEOUT = 10        # seconds to send the request headers
+MAX_REQUEST_BYTES = 16 * 1024
+
+_thread = None
+_thread_lock = threading.Lock()
+_port = None
+
+
+# user id of the Flask session in a Cookie header, or None
+def session_user(cookie_header):
+    cookie = SimpleCookie()
+    try:
+        cookie.load(cookie_header)
+    except Exception:
+        return None
+    morsel = cookie.get(app.config['SESSION_COOKIE_NAME'])
+    serializer = app.session_interface.get_signing_serializer(app)
+    if morsel is None or serializer is None:
+        return None
+    try:
+        session = serializer.loads(morsel.value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return None
+    return session.get('user_id')
+
+# pages served from another port (python app.py) open the stream with credentials, allowed for
+# origins on the hostname the client connected to
+def cors_headers(headers):
+    origin = headers.get('origin')
+    if not origin or urlsplit(origin).hostname != urlsplit('//' + headers.get('host', '')).hostname:
+        return []
+    return [('Access-Control-Allow-Origin', origin), ('Access-Control-Allow-Credentials', 'true'), ('Vary', 'Origin')]
+
+def response_head(status, headers=()):
+    lines = [f'HTTP/1.1 {status}', 'Connection: close', *(f'{name}: {value}' for name, value in headers)]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+async def read_request(reader):
+    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+    request_line, *lines = head.decode('latin-1').split('\r\n')
+    method, target, _ = request_line.split(' ', 2)
+    headers = {}
+    for line in lines:
+        name, colon, value = line.partition(':')
+        if colon:
+            headers[name.strip().lower()] = value.strip()
+    return method, urlsplit(target), headers
+
+async def handle(reader, writer):
+    subscription = None
+    try:
+        try:
+            method, url, headers = await read_request(reader)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+            return
+        if method != 'GET' or url.path != STREAM_PATH:
+            writer.write(response_head('404 Not Found', [('Content-Length', '0')]))
+            return
+        if session_user(headers.get('cookie', '')) is None:
+            writer.write(response_head('401 Unauthorized', [('Content-Length', '0')]))
+            return
+        stream_headers = [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache'),
+                          ('X-Accel-Buffering', 'no'), *cors_headers(headers)]
+        broker = get_broker()
+        if broker.subscriber_count() >= app.config['SSE_MAX_SUBSCRIBERS']:
+            writer.write(response_head('200 OK', stream_headers) + sse_busy().encode())
+            return
+        lot_ids = [int(id) for id in parse_qs(url.query).get('lots', [''])[0].split(',') if id.isdigit()]
+        subscription = broker.subscribe(lot_ids, loop=asyncio.get_running_loop())
+        writer.write(response_head('200 OK', stream_headers) + b'retry: 5000\n\n')
+        await writer.drain()
+        # the client sends nothing more, the read ends when it goes away and frees its place
+        # at once rather than at the next write
+        closed = asyncio.ensure_future(reader.read())
+        while True:
+            next_event = asyncio.ensure_future(subscription.next(SSE_KEEPALIVE))
+            await asyncio.wait({next_event, closed}, return_when=asyncio.FIRST_COMPLETED)
+            if closed.done():
+                next_event.cancel()
+                return
+            event = next_event.result()
+            writer.write((sse_format(event) if event else ': keepalive\n\n').encode())
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        if subscription is not None:
+            subscription.close()
+        writer.close()
+
+async def serve(host, port, started=None):
+    global _port
+    server = await asyncio.start_server(handle, host, port, limit=MAX_REQUEST_BYTES)
+    _port = server.sockets[0].getsockname()[1]
+    if started:
+        started.set()
+    async with server:
+        await server.serve_forever()
+
+# serve in a daemon thread of this process (python app.py, tests), returns the port listened on
+def start_server_thread(host='127.0.0.1', port=0):
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            started = threading.Event()
+            _thread = threading.Thread(target=lambda: asyncio.run(serve(host, port, started)),
+                                       name='event-stream', daemon=True)
+            _thread.start()
+            started.wait()
+    return _port
+
+
+#-------------------------------------------- Benchmark --------------------------------------------
+
+# `subscribers` HTTP clients of the server of this process (subscriber n watches lot n % lots + 1),
+# read on an event loop of their own until a `stop` event. publish() runs once they are all
+# connected. Returns ([(events received, delivery latencies in seconds)] per client, start time).
+def bench_streams(subscribers, lots, publish):
+    port = start_server_thread()
+    cookie = app.session_interface.get_signing_serializer(app).dumps({'user_id': 0})
+
+    async def client(n, connected):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {STREAM_PATH}?lots={n % lots + 1} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                     f'Cookie: {app.config["SESSION_COOKIE_NAME"]}={cookie}\r\n\r\n'.encode())
+        await reader.readuntil(b'retry: 5000\n\n')
+        connected()
+        count, lags = 0, []
+        while line := await reader.readline():
+            if line.startswith(b'data: '):
+                event = json.loads(line[len(b'data: '):])
+                if event.get('stop'):
+                    break
+                count += 1
+                lags.append(time.perf_counter() - event['sent'])
+        writer.close()
+        return count, lags
+
+    async def run():
+        ready = asyncio.Event()
+        waiting = [subscribers]
+
+        def connected():
+            waiting[0] -= 1
+            if not waiting[0]:
+                ready.set()
+
+        clients = [asyncio.create_task(client(n, connected)) for n in range(subscribers)]
+        await ready.wait()
+        start = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, publish)
+        return await asyncio.gather(*clients), start
+
+    return asyncio.run(run())
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@app.cli.command('serve-events')
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', type=int, default=5001, show_default=True)
+def serve_events_command(host, port):
+    """Serve the availability event streams from an asyncio server."""
+    if not app.config.get('EVENT_BROKER_URL'):
+        raise click.ClickException('Set EVENT_BROKER_URL, the web workers publish their events through it.')
+    click.echo(f'Serving {STREAM_PATH} on {host}:{port}')
+    asyncio.run(serve(host, port))
@@ -0,0 +1,144 @@
+from app import app
+from models import db, ParkingLot, Vehicle, ReservationArchive
+from history import history_tables
+from sqlalchemy import func, text
+import click
+import csv
+import io
+import os
+import zlib
+
+
+#--------------------------------------- Reservation export ----------------------------------------
+# Reservation history (joined with lot and vehicle) is read partition by partition (history.py),
+# archived reservations first (their lot may be gone, the archive keeps its name)
+# with yield_per in fixed size chunks and written out chunk by chunk, so memory use stays the
+# same whatever the history size.
+# Formats: gzip compressed CSV, one NumPy .npy file per column, or Parquet (needs pyarrow).
+
+EXPORT_CHUNK_SIZE = 20000
+COLUMNS = ['id', 'user_id', 'lot_id', 'lot_name', 'spot_id', 'vehicle_id', 'vehicle_number',
+           'parking_timestamp', 'leaving_timestamp', 'total_cost']
+NPY_DTYPES = {
+    'id': 'i8', 'user_id': 'i8', 'lot_id': 'i8', 'spot_id': 'i8', 'vehicle_id': 'i8',
+    'lot_name': 'U50', 'vehicle_number': 'U25',
+    'parking_timestamp': 'datetime64[s]', 'leaving_timestamp': 'datetime64[s]',
+    'total_cost': 'f8',
+}
+
+
+# rows of one reservation table (the archive, a history partition or the hot one)
+def export_query(table):
+    if table is ReservationArchive.__table__:
+        return (db.select(table.c.id, table.c.user_id, table.c.lot_id, table.c.lot_name,
+                          table.c.spot_id, table.c.vehicle_id, func.coalesce(Vehicle.vehicle_number, ''),
+                          table.c.parking_timestamp, table.c.leaving_timestamp, table.c.total_cost)
+                .outerjoin(Vehicle, table.c.vehicle_id == Vehicle.id)
+                .order_by(table.c.id))
+    return (db.select(table.c.id, table.c.user_id, table.c.lot_id, ParkingLot.name,
+                      table.c.spot_id, table.c.vehicle_id, Vehicle.vehicle_number,
+                      table.c.parking_timestamp, table.c.leaving_timestamp, table.c.total_cost)
+            .join(ParkingLot, table.c.lot_id == ParkingLot.id)
+            .join(Vehicle, table.c.vehicle_id == Vehicle.id)
+            .order_by(table.c.id))
+
+# lists of rows, at most chunk_size each, one table after the other (archive, then oldest partition first)
+def export_chunks(chunk_size=EXPORT_CHUNK_SIZE):
+    for table in history_tables(archived=True):
+        result = db.session.execute(export_query(table).execution_options(yield_per=chunk_size))
+        for rows in result.partitions():
+            yield rows
+
+
+#---------------------------------------------- CSV -----------------------------------------------
+
+# gzip compressed CSV as a stream of byte chunks
+def csv_gz_stream(chunk_size=EXPORT_CHUNK_SIZE):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)    # wbits 31 = gzip container
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for rows in export_chunks(chunk_size):
+        writer.writerows(rows)
+        data = compressor.compress(buffer.getvalue().encode())
+        buffer.seek(0)
+        buffer.truncate()
+        if data:
+            yield data
+    yield compressor.compress(buffer.getvalue().encode()) + compressor.flush()
+
+def export_csv_gz(path):
+    with open(path, 'wb') as f:
+        for data in csv_gz_stream():
+            f.write(data)
+
+
+#-------------------------------------------- Columnar --------------------------------------------
+
+# one .npy file per column, filled through memory maps one chunk at a time
+def export_npy(directory):
+    import numpy as np
+    os.makedirs(directory, exist_ok=True)
+    # the arrays are sized by a count before the reads: pysqlite runs each SELECT outside of a
+    # transaction, on the database of its own moment, so BEGIN for one snapshot of the count and
+    # the reads (a release or lot deletion meanwhile would leave rows missing or read twice)
+    db.session.rollback()
+    db.session.execute(text('BEGIN'))
+    try:
+        total = sum(db.session.execute(db.select(func.count()).select_from(export_query(table).subquery())).scalar()
+                    for table in history_tables(archived=True))
+        arrays = {name: np.lib.format.open_memmap(os.path.join(directory, f'{name}.npy'), mode='w+',
+                                                  dtype=NPY_DTYPES[name], shape=(total,))
+                  for name in COLUMNS}
+        start = 0
+        for rows in export_chunks():
+            end = start + len(rows)
+            for index, name in enumerate(COLUMNS):
+                values = [row[index] for row in rows]
+                if name == 'total_cost':
+                    values = [np.nan if v is None else float(v) for v in values]
+                elif name.endswith('_timestamp'):
+                    values = [np.datetime64('NaT') if v is None else np.datetime64(v, 's') for v in values]
+                arrays[name][start:end] = values
+            start = end
+    finally:
+        db.session.rollback()
+    for array in arrays.values():
+        array.flush()
+    return total
+
+# Parquet with one row group per chunk
+def export_parquet(path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise click.ClickException('Parquet export needs pyarrow (pip install pyarrow).')
+    schema = pa.schema([
+        ('id', pa.int64()), ('user_id', pa.int64()), ('lot_id', pa.int64()), ('lot_name', pa.string()),
+        ('spot_id', pa.int64()), ('vehicle_id', pa.int64()), ('vehicle_number', pa.string()),
+        ('parking_timestamp', pa.timestamp('s')), ('leaving_timestamp', pa.timestamp('s')),
+        ('total_cost', pa.float64()),
+    ])
+    with pq.ParquetWriter(path, schema, compression='snappy') as writer:
+        for rows in export_chunks():
+            columns = [list(column) for column in zip(*rows)]
+            columns[-1] = [None if v is None else float(v) for v in columns[-1]]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@app.cli.command('export-reservations')
+@click.argument('output')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'npy', 'parquet']), default='csv',
+              help='csv writes OUTPUT as .csv.gz, npy writes a directory with one file per column.')
+def export_reservations_command(output, fmt):
+    """Export the reservation history for offline reporting."""
+    if fmt == 'csv':
+        export_csv_gz(output)
+    elif fmt == 'npy':
+        export_npy(output)
+    else:
+        export_parquet(output)
+    click.echo(f'Exported reservations to {output}.')
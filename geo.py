@@ -0,0 +1,106 @@
+from app import app
+from models import db, ParkingLot, PincodeCentroid
+from sqlalchemy import table, column, update
+from sqlalchemy.dialects.sqlite import insert
+import click
+import csv
+import math
+
+
+#--------------------------------------------- Proximity -------------------------------------------
+# Lots carry coordinates, indexed by the parkinglot_rtree R*Tree that triggers keep in sync
+# (migration 7). The nearest lots with a free spot are found by asking the R*Tree for the lots in
+# a box around the driver, filtered on the occupancy counters in the same query, and growing the
+# box until it holds enough lots; only the lots inside the box are ever read. Drivers and lots
+# that only have a pincode are placed on the centroid of their pincode (pincode_centroid table,
+# loaded with `flask import-pincodes`).
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+START_RADIUS_KM = 2.0
+MAX_RADIUS_KM = 50.0
+MAX_NEAREST = 50
+
+_pincode_cache = {}     # pincode -> (latitude, longitude)
+
+RTREE = table('parkinglot_rtree', column('id'), column('min_lat'), column('max_lat'),
+              column('min_lon'), column('max_lon'))
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+# (south, north, west, east) of a box holding the circle of radius_km around a point
+def bounding_box(latitude, longitude, radius_km):
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    return latitude - dlat, latitude + dlat, longitude - dlon, longitude + dlon
+
+def lots_in_box(south, north, west, east, free_only=True):
+    query = (db.select(ParkingLot).join(RTREE, RTREE.c.id == ParkingLot.id)
+             .where(RTREE.c.max_lat >= south, RTREE.c.min_lat <= north,
+                    RTREE.c.max_lon >= west, RTREE.c.min_lon <= east))
+    if free_only:
+        query = query.where(ParkingLot.occupied_count < ParkingLot.total_spots)
+    return db.session.execute(query).scalars().all()
+
+# the `limit` lots closest to a point (with a free spot unless free_only is False),
+# as [(lot, distance_km), ...] nearest first, none further than max_km
+def nearest_lots(latitude, longitude, limit=5, max_km=MAX_RADIUS_KM, free_only=True):
+    radius = min(START_RADIUS_KM, max_km)
+    while True:
+        lots = lots_in_box(*bounding_box(latitude, longitude, radius), free_only=free_only)
+        found = sorted(((lot, distance_km(latitude, longitude, lot.latitude, lot.longitude)) for lot in lots),
+                       key=lambda item: item[1])
+        # a lot in a corner of the box can be further away than one just outside of it,
+        # only the lots inside the circle are certainly the nearest
+        found = [(lot, distance) for lot, distance in found if distance <= radius]
+        if len(found) >= limit or radius >= max_km:
+            return found[:limit]
+        # the number of lots grows with the area, so guess the radius that holds `limit` of them
+        grow = math.sqrt(limit / max(len(found), 1)) * 1.25
+        radius = min(radius * max(grow, 3), max_km)
+
+# (latitude, longitude) of a pincode centroid or None, known pincodes are cached in memory
+def pincode_location(pincode):
+    location = _pincode_cache.get(pincode)
+    if location is None:
+        centroid = db.session.get(PincodeCentroid, pincode)
+        if not centroid:
+            return None
+        location = _pincode_cache[pincode] = (centroid.latitude, centroid.longitude)
+    return location
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@app.cli.command('import-pincodes')
+@click.argument('csv_file', type=click.File('r'))
+def import_pincodes_command(csv_file):
+    """Load pincode centroids from a CSV file with columns pincode,latitude,longitude."""
+    rows = [{'pincode': row['pincode'].strip(), 'latitude': float(row['latitude']),
+             'longitude': float(row['longitude'])} for row in csv.DictReader(csv_file)]
+    if rows:
+        statement = insert(PincodeCentroid)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['pincode'],
+            set_={'latitude': statement.excluded.latitude, 'longitude': statement.excluded.longitude}), rows)
+    db.session.commit()
+    _pincode_cache.clear()
+    click.echo(f'Imported {len(rows)} pincode(s).')
+
+@app.cli.command('geocode-lots')
+def geocode_lots_command():
+    """Place lots without coordinates on the centroid of their pincode."""
+    centroid = db.select(PincodeCentroid).where(PincodeCentroid.pincode == ParkingLot.pincode)
+    result = db.session.execute(
+        update(ParkingLot)
+        .where(ParkingLot.latitude.is_(None), centroid.exists())
+        .values(latitude=centroid.with_only_columns(PincodeCentroid.latitude).scalar_subquery(),
+                longitude=centroid.with_only_columns(PincodeCentroid.longitude).scalar_subquery())
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    click.echo(f'Placed {result.rowcount} lot(s).')
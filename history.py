@@ -0,0 +1,202 @@
+from app import app
+from models import db, Reservation, ReservationArchive
+from sqlalchemy import Table, Column, Index, MetaData, select, union_all, insert, delete, text, func, bindparam, event
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.schema import CreateTable, CreateIndex
+from datetime import datetime
+import click
+import re
+
+
+#----------------------------------------- Reservation history -------------------------------------
+# The reservation table only holds the active reservations (the cars parked right now), so the
+# "is this vehicle / spot parked" checks of the booking routes read a table whose size follows the
+# number of spots, not the years of history. On release a reservation is moved, with its id, to
+# the history partition of its release month (reservation_YYYY_MM, same columns and lookup
+# indexes) in the release transaction. Ids come from the AUTOINCREMENT sequence of the hot table,
+# so they stay unique across every partition.
+#
+# Reads of the whole history go through this module: history_tables() lists the partitions
+# (oldest first) and the hot table, with reservation_archive (reservations of deleted lots,
+# spots and vehicles, provisioning.py) first for the readers that need them, union_select() is one UNION ALL over them with the filter
+# applied to every arm so each arm uses its own index, and reservation_history() maps such a
+# union back to Reservation for the ORM pages (parking history). Partitions are found in sqlite_master
+# and cached per process.
+
+PARTITION_PREFIX = 'reservation_'
+PARTITION_NAME = re.compile(r'^reservation_(\d{4})_(\d{2})$')
+INDEXED_COLUMNS = ('user_id', 'lot_id', 'spot_id', 'vehicle_id')
+
+_metadata = MetaData()
+_partitions = {}        # name -> Table of the partitions known to exist
+_entities = {}          # (column, table names) -> reservation_history() entity
+
+
+def partition_name(moment):
+    return f'{PARTITION_PREFIX}{moment:%Y_%m}'
+
+# Table of a partition, the reservation columns without foreign keys (lots, spots and vehicles
+# are deleted while their history stays)
+def partition_table(name):
+    table = _metadata.tables.get(name)
+    if table is None:
+        columns = [Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable)
+                   for c in Reservation.__table__.columns]
+        indexes = [Index(f'ix_{name}_{column[:-3]}', column) for column in INDEXED_COLUMNS]
+        table = Table(name, _metadata, *columns, *indexes)
+    return table
+
+def _scan():
+    names = db.session.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'reservation\\_%' ESCAPE '\\'")
+    ).scalars()
+    for name in names:
+        if PARTITION_NAME.match(name) and name not in _partitions:
+            _partitions[name] = partition_table(name)
+
+# the history partitions, oldest first. sqlite_master is read again while the current month has
+# no known partition, as another process may have just created it
+def partitions():
+    if partition_name(datetime.now()) not in _partitions:
+        _scan()
+    return [_partitions[name] for name in sorted(_partitions)]
+
+# every table holding reservations, the partitions oldest first and the hot table last.
+# archived=True puts reservation_archive first (revenue, rollups, exports, billing audit).
+def history_tables(archived=False):
+    tables = partitions() + [Reservation.__table__]
+    return [ReservationArchive.__table__] + tables if archived else tables
+
+# create a partition inside the current transaction if it doesn't exist yet. It is cached once
+# the transaction commits, a rolled back creation is never taken for an existing partition.
+def ensure_partition(name):
+    if name not in _partitions:
+        _scan()
+    table = partition_table(name)
+    if name not in _partitions:
+        db.session.execute(CreateTable(table, if_not_exists=True))
+        for index in table.indexes:
+            db.session.execute(CreateIndex(index, if_not_exists=True))
+        db.session.info.setdefault('new_partitions', set()).add(name)
+    return table
+
+@event.listens_for(Session, 'after_commit')
+def _cache_new_partitions(session):
+    for name in session.info.pop('new_partitions', ()):
+        _partitions[name] = partition_table(name)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_new_partitions(session, previous_transaction):
+    session.info.pop('new_partitions', None)
+
+
+#------------------------------------------- Moving rows -------------------------------------------
+
+# move a released reservation from the hot table to the partition of its release month inside
+# the current transaction, the caller commits. The reservation object leaves the session.
+def move_to_history(reservation):
+    db.session.flush()
+    hot = Reservation.__table__
+    table = ensure_partition(partition_name(reservation.leaving_timestamp))
+    db.session.execute(insert(table).from_select([c.name for c in hot.columns],
+                                                 select(*hot.columns).where(hot.c.id == reservation.id)))
+    db.session.execute(delete(hot).where(hot.c.id == reservation.id))
+    db.session.expunge(reservation)
+
+# new reservations get ids above last_id (after history was loaded with explicit ids)
+def set_last_id(last_id):
+    db.session.execute(text("DELETE FROM sqlite_sequence WHERE name = 'reservation'"))
+    db.session.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('reservation', :seq)"), {'seq': last_id})
+
+# migration 11 : move the completed reservations of the single reservation table to the
+# partitions, then rebuild the (now small) table with AUTOINCREMENT if it doesn't have it yet
+def split_reservations():
+    hot = Reservation.__table__
+    # the columns added by later migrations don't exist yet
+    existing = {row[1] for row in db.session.execute(text('PRAGMA table_info(reservation)'))}
+    names = [c.name for c in hot.columns if c.name in existing]
+    last_id = db.session.execute(select(func.max(hot.c.id))).scalar()
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_reservation_leaving ON reservation (leaving_timestamp)'))
+    months = db.session.execute(
+        select(func.strftime('%Y-%m', hot.c.leaving_timestamp)).where(hot.c.leaving_timestamp.isnot(None)).distinct()
+    ).scalars().all()
+    for month in months:
+        start = datetime.strptime(month, '%Y-%m')
+        end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+        table = ensure_partition(partition_name(start))
+        db.session.execute(insert(table).from_select(
+            names, select(*(hot.c[name] for name in names)).where(hot.c.leaving_timestamp >= start, hot.c.leaving_timestamp < end)))
+    db.session.execute(delete(hot).where(hot.c.leaving_timestamp.isnot(None)))
+    db.session.execute(text('DROP INDEX ix_reservation_leaving'))
+
+    sql = db.session.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'reservation'")).scalar()
+    if 'AUTOINCREMENT' not in sql.upper():
+        # keep the references of advance_booking pointing at "reservation" while it is renamed
+        db.session.execute(text('PRAGMA legacy_alter_table = ON'))
+        db.session.execute(text('ALTER TABLE reservation RENAME TO reservation_old'))
+        for index in hot.indexes:
+            db.session.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+        db.session.execute(CreateTable(hot))
+        for index in hot.indexes:
+            if index.name == 'ix_reservation_active_vehicle':
+                # plain like migration 1, migration 12 makes it unique once no vehicle is parked twice
+                db.session.execute(text('CREATE INDEX ix_reservation_active_vehicle ON reservation (vehicle_id) '
+                                        'WHERE leaving_timestamp IS NULL'))
+            else:
+                db.session.execute(CreateIndex(index))
+        columns = ', '.join(names)
+        db.session.execute(text(f'INSERT INTO reservation ({columns}) SELECT {columns} FROM reservation_old'))
+        db.session.execute(text('DROP TABLE reservation_old'))
+        db.session.execute(text('PRAGMA legacy_alter_table = OFF'))
+    if last_id is not None:
+        set_last_id(last_id)
+    # statistics gathered on the big table would make the planner scan the small one
+    if db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")).scalar():
+        db.session.execute(text("DELETE FROM sqlite_stat1 WHERE tbl = 'reservation'"))
+    _partitions.clear()
+
+
+#--------------------------------------------- Queries ---------------------------------------------
+
+# UNION ALL of `columns` (names, default all) of every table, where(table) returns the conditions
+# applied to each arm
+def union_select(where=None, columns=None, tables=None):
+    columns = columns or [c.name for c in Reservation.__table__.columns]
+    arms = []
+    for table in tables or history_tables():
+        arm = select(*(table.c[name] for name in columns))
+        if where is not None:
+            arm = arm.where(*where(table))
+        arms.append(arm)
+    return union_all(*arms)
+
+# Reservation entity over the whole history filtered on `column` = :column, e.g.
+#   history = reservation_history('user_id')
+#   db.session.query(history).params(user_id=user_id).order_by(history.id.desc())
+# The entity is reused until the partitions change, building the union every time would cost
+# more than running it.
+def reservation_history(column):
+    tables = history_tables()
+    key = (column, tuple(table.name for table in tables))
+    entity = _entities.get(key)
+    if entity is None:
+        union = union_select(lambda t: [t.c[column] == bindparam(column)], tables=tables)
+        entity = _entities[key] = aliased(Reservation, union.subquery('reservation_history'), adapt_on_names=True)
+    return entity
+
+# an active or past reservation by id, or None
+def find_reservation(reservation_id):
+    reservation = db.session.get(Reservation, reservation_id)
+    if reservation is None:
+        reservation = db.session.query(reservation_history('id')).params(id=reservation_id).first()
+    return reservation
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@app.cli.command('history-partitions')
+def history_partitions_command():
+    """List the reservation history partitions with their number of reservations."""
+    for table in history_tables():
+        count = db.session.execute(select(func.count()).select_from(table)).scalar()
+        click.echo(f'{table.name:<20} {count:>10}')
@@ -0,0 +1,235 @@
+from app import app
+from models import db, Job, ParkingLot
+from provisioning import resize_lot, delete_lot
+from occupancy import touch
+from allocator import allocator
+from events import publish_lot
+from sqlalchemy import update, event
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+import click
+import json
+import os
+import socket
+import threading
+
+
+#--------------------------------------------- Job queue -------------------------------------------
+# Slow admin operations (deleting a lot with its spots and history, large lot resizes) are
+# queued in the job table and run by a worker instead of blocking a web worker. The route
+# enqueues and returns, the admin polls the job (/admin/jobs/<id>) for its status and result.
+#
+# `flask run-jobs` is the worker process. A job is claimed with a conditional UPDATE, so several
+# workers never run the same job; a failing job is retried with a growing delay until it has
+# used max_attempts, a job raising JobRefused fails at once. A job left 'running' by a crashed
+# worker is claimed again after JOB_LEASE, or fails if that was its last attempt. With
+# JOB_WORKER_IN_PROCESS set (development, tests, `python app.py`) a thread of the web process
+# runs the jobs instead, woken when a transaction that queued jobs commits.
+#
+# Handlers run in the worker process: they invalidate that process's allocator only, the web
+# workers notice the changed spots through claim_spot(); availability events reach the web
+# workers when EVENT_BROKER_URL is set.
+
+JOB_LEASE = timedelta(minutes=10)
+RETRY_DELAY = 5             # seconds before the first retry, doubled on every attempt
+INLINE_RESIZE_SPOTS = 100   # smaller lot resizes are done in the request
+
+HANDLERS = {}               # kind -> function(**payload) returning a JSON serialisable result
+
+_wakeup = threading.Event()
+_thread = None
+_thread_lock = threading.Lock()
+
+
+class JobRefused(Exception):
+    # the job can't be done (not a transient error), it fails without retries
+    pass
+
+
+def handler(kind):
+    def register(f):
+        HANDLERS[kind] = f
+        return f
+    return register
+
+
+# queue a job inside the current transaction, the caller commits
+def enqueue(kind, payload=None, user_id=None, max_attempts=3):
+    if kind not in HANDLERS:
+        raise ValueError(f'Unknown job kind {kind!r}')
+    now = datetime.now()
+    job = Job(kind=kind, payload=json.dumps(payload or {}), status='queued', attempts=0,
+              max_attempts=max_attempts, run_after=now, created_by=user_id, created_at=now)
+    db.session.add(job)
+    db.session.flush()
+    if app.config.get('JOB_WORKER_IN_PROCESS'):
+        start_worker_thread()
+    db.session.info['jobs_queued'] = True
+    return job
+
+# the worker can't see a job before its transaction commits
+@event.listens_for(Session, 'after_commit')
+def _wake_worker(session):
+    if session.info.pop('jobs_queued', False):
+        _wakeup.set()
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_queued(session, previous_transaction):
+    session.info.pop('jobs_queued', None)
+
+def job_json(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'created_at': job.created_at.isoformat(timespec='seconds'),
+        'finished_at': job.finished_at and job.finished_at.isoformat(timespec='seconds'),
+        'result': job.result and json.loads(job.result),
+        'error': job.error,
+    }
+
+
+#--------------------------------------------- Worker ----------------------------------------------
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+# take the next due job (or one whose worker died), returns it or None
+def claim_next(worker):
+    now = datetime.now()
+    while True:
+        job_id = db.session.execute(
+            db.select(Job.id).where(Job.status == 'queued', Job.run_after <= now).order_by(Job.run_after).limit(1)
+        ).scalar()
+        expired = None
+        if job_id is None:
+            expired = db.session.execute(
+                db.select(Job.id, Job.attempts >= Job.max_attempts)
+                .where(Job.status == 'running', Job.locked_at < now - JOB_LEASE).limit(1)
+            ).first()
+            if expired is None:
+                db.session.commit()
+                return None
+            job_id, exhausted = expired
+            # its workers died on every attempt, it is not run once more
+            if exhausted:
+                db.session.execute(
+                    update(Job)
+                    .where(Job.id == job_id, Job.status == 'running', Job.locked_at < now - JOB_LEASE)
+                    .values(status='failed', locked_by=None, finished_at=now,
+                            error='The worker stopped during the last attempt.')
+                    .execution_options(synchronize_session=False)
+                )
+                db.session.commit()
+                continue
+        result = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == ('running' if expired else 'queued'))
+            .values(status='running', locked_by=worker, locked_at=now, attempts=Job.attempts + 1)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return db.session.get(Job, job_id)
+        # another worker took it, look again
+
+def run_job(job):
+    try:
+        result = HANDLERS[job.kind](**json.loads(job.payload))
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job.id)
+        job.error = str(e) or e.__class__.__name__
+        if isinstance(e, JobRefused) or job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = datetime.now()
+        else:
+            job.status = 'queued'
+            job.run_after = datetime.now() + timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        if not isinstance(e, JobRefused):
+            app.logger.exception('Job %s (%s) failed, attempt %d of %d', job.id, job.kind, job.attempts, job.max_attempts)
+    else:
+        job.status = 'done'
+        job.result = json.dumps(result)
+        job.error = None
+        job.finished_at = datetime.now()
+    job.locked_by = None
+    db.session.commit()
+    return job
+
+# run due jobs until none is left (or `limit` ran), returns the number run
+def run_pending(limit=None, worker=None):
+    worker = worker or worker_name()
+    count = 0
+    while limit is None or count < limit:
+        job = claim_next(worker)
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+def work(poll_seconds):
+    worker = worker_name()
+    while True:
+        try:
+            with app.app_context():
+                run_pending(worker=worker)
+        except Exception:
+            app.logger.exception('Job worker error')
+        _wakeup.wait(poll_seconds)
+        _wakeup.clear()
+
+def start_worker_thread():
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=work, args=(app.config.get('JOB_POLL_SECONDS', 1),),
+                                       name='job-worker', daemon=True)
+            _thread.start()
+
+
+#--------------------------------------------- Lot jobs --------------------------------------------
+
+@handler('delete_lot')
+def delete_lot_job(lot_id):
+    if not db.session.get(ParkingLot, lot_id):
+        return {'lot_id': lot_id, 'deleted': False}
+    archived = delete_lot(lot_id)
+    if archived is None:
+        raise JobRefused("The lot can't be deleted as spots of this lot are occupied or booked ahead.")
+    db.session.commit()
+    allocator.invalidate(lot_id)
+    publish_lot(lot_id)
+    return {'lot_id': lot_id, 'deleted': True, 'archived_reservations': archived}
+
+@handler('resize_lot')
+def resize_lot_job(lot_id, total_spots):
+    lot = db.session.get(ParkingLot, lot_id)
+    if not lot:
+        raise JobRefused(f'Parking lot {lot_id} not found.')
+    previous = lot.total_spots
+    if not resize_lot(lot_id, total_spots):
+        raise JobRefused("Spots can't be removed from the lot as some of them are occupied or booked ahead.")
+    lot.total_spots = total_spots
+    touch(lot_id)
+    db.session.commit()
+    allocator.invalidate(lot_id)
+    publish_lot(lot_id, total_spots - previous)
+    return {'lot_id': lot_id, 'total_spots': total_spots}
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True, help='Run the due jobs and exit.')
+@click.option('--poll', default=1.0, show_default=True, help='Seconds between looks for new jobs.')
+def run_jobs_command(once, poll):
+    """Run queued background jobs."""
+    if once:
+        click.echo(f'Ran {run_pending()} job(s).')
+        return
+    click.echo(f'Job worker {worker_name()} started.')
+    work(poll)
@@ -0,0 +1,154 @@
+from app import app
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import threading
+import time
+
+
+#------------------------------------------ Instrumentation ----------------------------------------
+# Per endpoint latency histograms, SQL statement count and time, template and chart render
+# times, served in Prometheus text format by the admin only /admin/metrics route. Enabled with
+# METRICS_ENABLED; when it is off none of the hooks below are installed, so requests pay nothing.
+# METRICS_SLOW_REQUEST_MS additionally logs every slower request with the statements it ran.
+# Values are per worker process, like the other in-process caches.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_LOG_STATEMENTS = 20        # statements listed per slow request, slowest first
+
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, name, help, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}       # label value -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, label_value, value):
+        with _lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with _lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for label_value, values in sorted(series.items()):
+            label = f'{self.label}="{_escape(label_value)}"'
+            for bound, count in zip(self.buckets, values):
+                yield f'{self.name}_bucket{{{label},le="{bound}"}} {count}'
+            yield f'{self.name}_bucket{{{label},le="+Inf"}} {values[-2]}'
+            yield f'{self.name}_sum{{{label}}} {values[-1]:.6f}'
+            yield f'{self.name}_count{{{label}}} {values[-2]}'
+
+class Counter:
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._series = {}
+
+    def inc(self, label_value, amount=1):
+        with _lock:
+            self._series[label_value] = self._series.get(label_value, 0) + amount
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with _lock:
+            series = dict(self._series)
+        for label_value, value in sorted(series.items()):
+            yield f'{self.name}{{{self.label}="{_escape(label_value)}"}} {value:g}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram('parking_request_duration_seconds', 'Request latency by endpoint.', 'endpoint')
+SQL_STATEMENTS = Counter('parking_sql_statements_total', 'SQL statements issued by endpoint.', 'endpoint')
+SQL_SECONDS = Counter('parking_sql_seconds_total', 'Time spent in SQL statements by endpoint.', 'endpoint')
+TEMPLATE_SECONDS = Histogram('parking_template_render_seconds', 'Template render time.', 'template')
+CHART_SECONDS = Histogram('parking_chart_render_seconds', 'Chart render time by chart kind.', 'kind')
+METRICS = (REQUEST_SECONDS, SQL_STATEMENTS, SQL_SECONDS, TEMPLATE_SECONDS, CHART_SECONDS)
+
+
+def enabled():
+    return bool(app.config.get('METRICS_ENABLED'))
+
+# record the render time of a chart (called from the chart workers)
+def observe_chart(kind, seconds):
+    if enabled():
+        CHART_SECONDS.observe(kind, seconds)
+
+def render_prometheus():
+    return '\n'.join(line for metric in METRICS for line in metric.lines()) + '\n'
+
+
+#--------------------------------------------- Hooks ----------------------------------------------
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_start')
+    if not starts or not has_request_context():
+        return
+    seconds = time.perf_counter() - starts.pop()
+    g.sql_seconds = g.get('sql_seconds', 0.0) + seconds
+    if app.config.get('METRICS_SLOW_REQUEST_MS') is not None:
+        g.setdefault('sql_statements', []).append((seconds, statement))
+
+def _before_render(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+def _after_render(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if starts:
+        TEMPLATE_SECONDS.observe(template.name, time.perf_counter() - starts.pop())
+
+def _start_request():
+    g.request_start = time.perf_counter()
+
+def _record_request(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+    endpoint = request.endpoint or 'unmatched'
+    sql_count = g.get('query_count', 0)      # counted by querybudget.py
+    sql_seconds = g.get('sql_seconds', 0.0)
+    REQUEST_SECONDS.observe(endpoint, seconds)
+    SQL_STATEMENTS.inc(endpoint, sql_count)
+    SQL_SECONDS.inc(endpoint, sql_seconds)
+
+    slow_ms = app.config.get('METRICS_SLOW_REQUEST_MS')
+    if slow_ms is not None and seconds * 1000 >= slow_ms:
+        statements = sorted(g.get('sql_statements', []), key=lambda item: -item[0])[:SLOW_LOG_STATEMENTS]
+        details = ''.join(f'\n  {took * 1000:8.2f} ms  {" ".join(sql.split())}' for took, sql in statements)
+        app.logger.warning('Slow request %s %s (%s): %.0f ms, %d SQL statements in %.1f ms%s',
+                           request.method, request.path, endpoint, seconds * 1000, sql_count,
+                           sql_seconds * 1000, details)
+    return response
+
+def install():
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+
+
+if enabled():
+    install()
@@ -0,0 +1,222 @@
+from app import app
+from models import db, User, Vehicle, ParkingSpot, Reservation, AdvanceBooking, Job, ReservationArchive, create_tables
+from history import split_reservations, union_select, history_tables
+from sqlalchemy import text
+import click
+
+
+#---------------------------------------- Schema migrations ----------------------------------------
+# db.create_all() only creates missing tables, it never changes an existing database. Schema
+# changes are therefore listed here in order (SQL strings, or functions for steps that need a
+# check first); the number of applied migrations is stored in SQLite's PRAGMA user_version
+# and `flask migrate` (or `flask init-db`) applies the rest.
+
+MIGRATIONS = [
+    # 1 : indexes for the hot lookup columns
+    [
+        "CREATE INDEX IF NOT EXISTS ix_parkingspot_lot_occupied ON parkingspot (lot_id, is_occupied)",
+        "CREATE INDEX IF NOT EXISTS ix_vehicle_user ON vehicle (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reservation_user ON reservation (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reservation_lot ON reservation (lot_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reservation_spot ON reservation (spot_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reservation_vehicle ON reservation (vehicle_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reservation_active_vehicle ON reservation (vehicle_id) "
+        "WHERE leaving_timestamp IS NULL",
+        "ANALYZE",
+    ],
+    # 2 : full text (trigram) index on parkinglot name and address, kept in sync by triggers
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS parkinglot_fts USING fts5("
+        "name, address, content='parkinglot', content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS parkinglot_fts_ai AFTER INSERT ON parkinglot BEGIN "
+        "INSERT INTO parkinglot_fts (rowid, name, address) VALUES (new.id, new.name, new.address); END",
+        "CREATE TRIGGER IF NOT EXISTS parkinglot_fts_ad AFTER DELETE ON parkinglot BEGIN "
+        "INSERT INTO parkinglot_fts (parkinglot_fts, rowid, name, address) VALUES ('delete', old.id, old.name, old.address); END",
+        "CREATE TRIGGER IF NOT EXISTS parkinglot_fts_au AFTER UPDATE OF name, address ON parkinglot BEGIN "
+        "INSERT INTO parkinglot_fts (parkinglot_fts, rowid, name, address) VALUES ('delete', old.id, old.name, old.address); "
+        "INSERT INTO parkinglot_fts (rowid, name, address) VALUES (new.id, new.name, new.address); END",
+        "INSERT INTO parkinglot_fts (parkinglot_fts) VALUES ('rebuild')",
+    ],
+    # 3 : full text (trigram) index on user name and address, kept in sync by triggers
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5("
+        "name, address, content='user', content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS user_fts_ai AFTER INSERT ON user BEGIN "
+        "INSERT INTO user_fts (rowid, name, address) VALUES (new.id, new.name, new.address); END",
+        "CREATE TRIGGER IF NOT EXISTS user_fts_ad AFTER DELETE ON user BEGIN "
+        "INSERT INTO user_fts (user_fts, rowid, name, address) VALUES ('delete', old.id, old.name, old.address); END",
+        "CREATE TRIGGER IF NOT EXISTS user_fts_au AFTER UPDATE OF name, address ON user BEGIN "
+        "INSERT INTO user_fts (user_fts, rowid, name, address) VALUES ('delete', old.id, old.name, old.address); "
+        "INSERT INTO user_fts (rowid, name, address) VALUES (new.id, new.name, new.address); END",
+        "INSERT INTO user_fts (user_fts) VALUES ('rebuild')",
+    ],
+    # 4 : running occupancy and revenue counters on parkinglot
+    [
+        lambda: add_column('parkinglot', 'occupied_count', 'INTEGER NOT NULL DEFAULT 0'),
+        lambda: add_column('parkinglot', 'revenue', 'FLOAT NOT NULL DEFAULT 0'),
+        "UPDATE parkinglot SET "
+        "occupied_count = (SELECT COUNT(*) FROM parkingspot WHERE lot_id = parkinglot.id AND is_occupied = 1), "
+        "revenue = (SELECT COALESCE(SUM(total_cost), 0) FROM reservation "
+        "WHERE lot_id = parkinglot.id AND leaving_timestamp IS NOT NULL)",
+    ],
+    # 5 : costs were stored as posted form strings, store them as numbers rounded to cents
+    [
+        "UPDATE reservation SET total_cost = ROUND(CAST(total_cost AS REAL), 2) WHERE total_cost IS NOT NULL",
+        "UPDATE parkinglot SET revenue = ROUND(revenue, 2)",
+    ],
+    # 6 : availability version of a lot (ETags of the JSON API)
+    [
+        lambda: add_column('parkinglot', 'occupancy_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ],
+    # 7 : lot coordinates with an R*Tree index kept in sync by triggers, pincode centroids
+    [
+        lambda: add_column('parkinglot', 'latitude', 'FLOAT'),
+        lambda: add_column('parkinglot', 'longitude', 'FLOAT'),
+        "CREATE TABLE IF NOT EXISTS pincode_centroid ("
+        "pincode VARCHAR(10) NOT NULL PRIMARY KEY, latitude FLOAT NOT NULL, longitude FLOAT NOT NULL)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS parkinglot_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)",
+        "CREATE TRIGGER IF NOT EXISTS parkinglot_rtree_ai AFTER INSERT ON parkinglot "
+        "WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN "
+        "INSERT INTO parkinglot_rtree VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude); END",
+        "CREATE TRIGGER IF NOT EXISTS parkinglot_rtree_ad AFTER DELETE ON parkinglot BEGIN "
+        "DELETE FROM parkinglot_rtree WHERE id = old.id; END",
+        "CREATE TRIGGER IF NOT EXISTS parkinglot_rtree_au AFTER UPDATE OF latitude, longitude ON parkinglot BEGIN "
+        "DELETE FROM parkinglot_rtree WHERE id = old.id; "
+        "INSERT INTO parkinglot_rtree SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude "
+        "WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL; END",
+        "INSERT OR REPLACE INTO parkinglot_rtree SELECT id, latitude, latitude, longitude, longitude "
+        "FROM parkinglot WHERE latitude IS NOT NULL AND longitude IS NOT NULL",
+    ],
+    # 8 : advance bookings of a spot for a time window, with their (spot_id, start, end) index
+    [
+        lambda: AdvanceBooking.__table__.create(db.session.connection(), checkfirst=True),
+    ],
+    # 9 : background job queue (jobs.py)
+    [
+        lambda: Job.__table__.create(db.session.connection(), checkfirst=True),
+    ],
+    # 10 : reservations of deleted lots (provisioning.delete_lot)
+    [
+        lambda: ReservationArchive.__table__.create(db.session.connection(), checkfirst=True),
+    ],
+    # 11 : reservation keeps the active reservations only, released ones move to monthly
+    # history partitions (history.py)
+    [
+        split_reservations,
+    ],
+    # 12 : a vehicle has at most one active reservation, enforced by a unique index
+    [
+        lambda: refuse_duplicates('reservation', 'vehicle_id', 'leaving_timestamp IS NULL'),
+        "DROP INDEX IF EXISTS ix_reservation_active_vehicle",
+        "CREATE UNIQUE INDEX ix_reservation_active_vehicle ON reservation (vehicle_id) "
+        "WHERE leaving_timestamp IS NULL",
+    ],
+    # 13 : the lot price a reservation was booked at, charged at release and checked by
+    # audit-billing. Parked cars get today's price (what their release would have charged),
+    # the price of past reservations is unknown.
+    [
+        lambda: [add_column(table.name, 'price_per_hour', 'FLOAT') for table in history_tables(archived=True)],
+        "UPDATE reservation SET price_per_hour = (SELECT price_per_hour FROM parkinglot WHERE id = reservation.lot_id) "
+        "WHERE leaving_timestamp IS NULL",
+    ],
+]
+
+
+# tables made by db.create_all() already have the newest columns, so only add missing ones
+def add_column(table, column, ddl):
+    columns = [row[1] for row in db.session.execute(text(f'PRAGMA table_info({table})'))]
+    if column not in columns:
+        db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+# stop a migration adding a unique index while rows would violate it, they need a manual fix
+def refuse_duplicates(table, column, where):
+    values = db.session.execute(text(
+        f'SELECT {column} FROM {table} WHERE {where} GROUP BY {column} HAVING COUNT(*) > 1')).scalars().all()
+    if values:
+        db.session.rollback()
+        raise click.ClickException(f'{table}.{column} has duplicates ({where}): {", ".join(map(str, values))}')
+
+
+def schema_version():
+    return db.session.execute(text('PRAGMA user_version')).scalar()
+
+# apply every migration newer than the database, returns the number applied
+def migrate():
+    version = schema_version()
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        for statement in statements:
+            if callable(statement):
+                statement()
+            else:
+                db.session.execute(text(statement))
+        db.session.execute(text(f'PRAGMA user_version = {number}'))
+        db.session.commit()
+    return len(MIGRATIONS) - version
+
+# tables, migrations and default admin of a new or existing database
+def init_db():
+    create_tables()
+    return migrate()
+
+
+#---------------------------------------- Query plan check -----------------------------------------
+# The lookups done by the hot routes. Each one must be answered through an index, never
+# by scanning the whole table.
+
+def hot_queries():
+    return {
+        'parking_history': union_select(lambda t: [t.c.user_id == 1]),
+        'view_reserve': Reservation.query.filter_by(spot_id=1, leaving_timestamp=None),
+        'book_lot_post (lot)': Reservation.query.filter_by(user_id=1, lot_id=1, vehicle_id=1, leaving_timestamp=None),
+        'book_lot_post (vehicle)': Reservation.query.filter_by(vehicle_id=1, leaving_timestamp=None),
+        'delete_vehicle_post': Reservation.query.filter_by(vehicle_id=1, leaving_timestamp=None),
+        'vehicle': Vehicle.query.filter_by(user_id=1),
+        'login': User.query.filter_by(username='admin'),
+        'free spot': db.select(ParkingSpot.id).where(ParkingSpot.lot_id == 1, ParkingSpot.is_occupied == False).limit(1),
+        'lot spots': ParkingSpot.query.filter_by(lot_id=1),
+        'lot reservations': union_select(lambda t: [t.c.lot_id == 1]),
+        'spot windows': db.select(AdvanceBooking.id).where(
+            AdvanceBooking.spot_id == 1, AdvanceBooking.start_time > '2024-01-01', AdvanceBooking.start_time < '2024-01-02'),
+        'vehicle windows': db.select(AdvanceBooking.id).where(
+            AdvanceBooking.vehicle_id == 1, AdvanceBooking.start_time > '2024-01-01', AdvanceBooking.start_time < '2024-01-02'),
+        'next job': db.select(Job.id).where(Job.status == 'queued', Job.run_after <= '2024-01-01').order_by(Job.run_after).limit(1),
+    }
+
+def query_plan(query):
+    statement = getattr(query, 'statement', query)
+    sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    return [row[-1] for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+
+# {name: plan} of every hot query that falls back to a full table scan
+def table_scans():
+    scans = {}
+    for name, query in hot_queries().items():
+        plan = query_plan(query)
+        if any(step.startswith('SCAN') and 'INDEX' not in step for step in plan):
+            scans[name] = plan
+    return scans
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables, apply migrations and create the default admin."""
+    applied = init_db()
+    click.echo(f'Database ready, applied {applied} migration(s), schema version {schema_version()}.')
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations."""
+    applied = migrate()
+    click.echo(f'Applied {applied} migration(s), schema version {schema_version()}.')
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a hot route query scans a whole table."""
+    scans = table_scans()
+    for name, plan in scans.items():
+        click.echo(f'{name}: ' + ' | '.join(plan))
+    if scans:
+        raise SystemExit(1)
+    click.echo('All hot queries use an index.')
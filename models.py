@@ -1,10 +1,23 @@
 from app import app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from werkzeug.security import generate_password_hash
+import sqlite3
 
 # Initialize the SQLAlchemy object
 db = SQLAlchemy(app)
 
+# apply SQLITE_PRAGMAS (see config.py) to every new SQLite connection
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config.get('SQLITE_PRAGMAS', {}).items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
 # Define the User model
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -21,6 +34,7 @@ class User(db.Model):
     reserve_user= db.relationship('Reservation', backref='user', lazy=True)
 
 class Vehicle(db.Model):
+    __table_args__ = (db.Index('ix_vehicle_user', 'user_id'),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     vehicle_number = db.Column(db.String(25), unique=True, nullable=False)
@@ -29,6 +43,7 @@ class Vehicle(db.Model):
 
     # Define the relationship with Reservation
     reserved_vehicle = db.relationship('Reservation', backref='vehicle', lazy=True,cascade="all, delete-orphan")
+    advance_bookings = db.relationship('AdvanceBooking', backref='vehicle', lazy=True, cascade="all, delete-orphan")
 
 class ParkingLot(db.Model):
     __tablename__ = 'parkinglot'
@@ -38,14 +53,23 @@ class ParkingLot(db.Model):
     pincode = db.Column(db.String(10), nullable=False)
     total_spots = db.Column(db.Integer, nullable=False)
     price_per_hour = db.Column(db.Float, nullable=False)
+    # running totals kept by occupancy.py
+    occupied_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0, server_default='0')
+    # bumped whenever availability or lot details change, used as the API ETag
+    occupancy_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # location, indexed by the parkinglot_rtree R*Tree (see geo.py)
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
     # is_deleted= db.Column(db.Boolean , default=False)
 
     # Define the relationship with ParkingSpot
-    spots= db.relationship('ParkingSpot', backref='parkinglot', lazy=True,cascade="all, delete-orphan" )
+    spots= db.relationship('ParkingSpot', backref='parkinglot', lazy=True,cascade="all, delete-orphan", order_by='ParkingSpot.spot_number')
     lots= db.relationship('Reservation', backref='parkinglot', lazy=True,cascade="all, delete-orphan")
 
 class ParkingSpot(db.Model):
     __tablename__ = 'parkingspot'
+    __table_args__ = (db.Index('ix_parkingspot_lot_occupied', 'lot_id', 'is_occupied'),)
     id = db.Column(db.Integer, primary_key=True)
     lot_id = db.Column(db.Integer, db.ForeignKey('parkinglot.id'), nullable=False)
     spot_number = db.Column(db.Integer, nullable=False)
@@ -54,8 +78,22 @@ class ParkingSpot(db.Model):
 
     # Define the relationship with Reservation
     reserved_spot = db.relationship('Reservation', backref='parkingspot', lazy=True ,cascade="all, delete-orphan")
+    advance_bookings = db.relationship('AdvanceBooking', backref='parkingspot', lazy=True, cascade="all, delete-orphan")
 
+# the active reservations, released ones are moved to the history partitions (history.py)
 class Reservation(db.Model):
+    __table_args__ = (
+        db.Index('ix_reservation_user', 'user_id'),
+        db.Index('ix_reservation_lot', 'lot_id'),
+        db.Index('ix_reservation_spot', 'spot_id'),
+        db.Index('ix_reservation_vehicle', 'vehicle_id'),
+        # partial index for the "vehicle already parked" checks (leaving_timestamp IS NULL), unique
+        # so two concurrent bookings can't both park the same vehicle
+        db.Index('ix_reservation_active_vehicle', 'vehicle_id', unique=True,
+                 sqlite_where=db.text('leaving_timestamp IS NULL')),
+        # ids are never reused, released reservations keep theirs in the history partitions (history.py)
+        {'sqlite_autoincrement': True},
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     lot_id = db.Column(db.Integer, db.ForeignKey('parkinglot.id'), nullable=False)
@@ -63,12 +101,95 @@ class Reservation(db.Model):
     vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False)
     parking_timestamp = db.Column(db.DateTime, nullable=False)
     leaving_timestamp = db.Column(db.DateTime, nullable=True)
-    total_cost = db.Column(db.Float, nullable=True)
+    total_cost = db.Column(db.Numeric(10, 2), nullable=True)
+    # lot price when the spot was booked, the rate charged at release (None before migration 13)
+    price_per_hour = db.Column(db.Float, nullable=True)
+
+# a spot booked ahead for a time window, checked in as a Reservation when the driver arrives
+class AdvanceBooking(db.Model):
+    __tablename__ = 'advance_booking'
+    __table_args__ = (
+        # overlap checks read the windows of one spot around a time range (see advance.py)
+        db.Index('ix_advance_booking_spot_window', 'spot_id', 'start_time', 'end_time'),
+        db.Index('ix_advance_booking_vehicle_window', 'vehicle_id', 'start_time'),
+        db.Index('ix_advance_booking_user', 'user_id', 'start_time'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    lot_id = db.Column(db.Integer, db.ForeignKey('parkinglot.id'), nullable=False)
+    spot_id = db.Column(db.Integer, db.ForeignKey('parkingspot.id'), nullable=False)
+    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='booked')   # 'booked', 'checked_in' or 'cancelled'
+    reservation_id = db.Column(db.Integer, db.ForeignKey('reservation.id'), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    parkinglot = db.relationship('ParkingLot')
+
+# reservations of deleted lots, kept for the revenue history with the lot and spot they were on
+class ReservationArchive(db.Model):
+    __tablename__ = 'reservation_archive'
+    __table_args__ = (
+        db.Index('ix_reservation_archive_lot', 'lot_id'),
+        db.Index('ix_reservation_archive_user', 'user_id'),
+    )
+    # no foreign keys, the lot, spot or vehicle is gone
+    id = db.Column(db.Integer, primary_key=True)        # id of the reservation
+    user_id = db.Column(db.Integer, nullable=False)
+    lot_id = db.Column(db.Integer, nullable=False)
+    spot_id = db.Column(db.Integer, nullable=False)
+    vehicle_id = db.Column(db.Integer, nullable=False)
+    parking_timestamp = db.Column(db.DateTime, nullable=False)
+    leaving_timestamp = db.Column(db.DateTime, nullable=True)
+    total_cost = db.Column(db.Numeric(10, 2), nullable=True)
+    price_per_hour = db.Column(db.Float, nullable=True)
+    lot_name = db.Column(db.String(50), nullable=False)
+    lot_address = db.Column(db.String(100), nullable=False)
+    lot_pincode = db.Column(db.String(10), nullable=False)
+    spot_number = db.Column(db.Integer, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+class LotUsageRollup(db.Model):
+    __tablename__ = 'lot_usage_rollup'
+    # no foreign key, rollups are history and outlive deleted lots
+    lot_id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(5), primary_key=True)     # 'hour' or 'day'
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    reservations_started = db.Column(db.Integer, nullable=False, default=0)
+    spot_hours = db.Column(db.Float, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+
+# background job run by the worker of jobs.py, payload and result are JSON
+class Job(db.Model):
+    __tablename__ = 'job'
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status', 'run_after'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(10), nullable=False, default='queued')   # 'queued', 'running', 'done' or 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_after = db.Column(db.DateTime, nullable=False)
+    locked_by = db.Column(db.String(64), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+# approximate location of a pincode, used to place lots and drivers that only give a pincode
+class PincodeCentroid(db.Model):
+    __tablename__ = 'pincode_centroid'
+    pincode = db.Column(db.String(10), primary_key=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
 
 
-with app.app_context():
+# create missing tables and the default admin user, run by `flask init-db` (see migrations.py)
+def create_tables():
     db.create_all()  # Create the database tables if they don't exist
-    print("Database tables created successfully.")
 
     #creating default admin user
     admin= User.query.filter_by(is_admin=True).first()
@@ -77,4 +198,4 @@ with app.app_context():
         admin = User(name='Admin', address='Admin Address', pincode='123456',
                      username='admin123@gmail.com', passhash=password_hash, is_admin=True)
         db.session.add(admin)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
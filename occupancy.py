@@ -0,0 +1,89 @@
+from app import app
+from models import db, ParkingLot, ParkingSpot
+from history import history_tables
+from sqlalchemy import update, func
+import click
+
+
+#---------------------------------------- Occupancy counters ---------------------------------------
+# ParkingLot.occupied_count and ParkingLot.revenue are denormalized running totals, changed with
+# an atomic UPDATE in the same transaction as the booking or release that causes them, so the
+# dashboards read occupancy and revenue of a lot without touching its spots or reservations.
+# ParkingLot.occupancy_version goes up with every such change (and with touch() for edits of
+# the lot), so API clients can tell from the version alone whether a lot changed.
+
+def occupy(lot_id):
+    db.session.execute(
+        update(ParkingLot).where(ParkingLot.id == lot_id)
+        .values(occupied_count=ParkingLot.occupied_count + 1,
+                occupancy_version=ParkingLot.occupancy_version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+def vacate(lot_id, cost):
+    db.session.execute(
+        update(ParkingLot).where(ParkingLot.id == lot_id)
+        .values(occupied_count=ParkingLot.occupied_count - 1, revenue=ParkingLot.revenue + (cost or 0),
+                occupancy_version=ParkingLot.occupancy_version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+# the lot itself changed (details, spots added or removed)
+def touch(lot_id):
+    db.session.execute(
+        update(ParkingLot).where(ParkingLot.id == lot_id)
+        .values(occupancy_version=ParkingLot.occupancy_version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _actual_counters():
+    occupied = (db.select(func.count(ParkingSpot.id))
+                .where(ParkingSpot.lot_id == ParkingLot.id, ParkingSpot.is_occupied == True)
+                .scalar_subquery())
+    # one correlated sum per reservation table, each read through its lot index. Reservations
+    # archived with a deleted spot or vehicle (provisioning.py) still count for their lot.
+    revenue = None
+    for table in history_tables(archived=True):
+        total = (db.select(func.coalesce(func.sum(table.c.total_cost), 0))
+                 .where(table.c.lot_id == ParkingLot.id, table.c.leaving_timestamp.isnot(None))
+                 .scalar_subquery())
+        revenue = total if revenue is None else revenue + total
+    return occupied, revenue
+
+# lots whose counters disagree with their spots/reservations : [(lot_id, stored, actual), ...]
+def check_counters():
+    occupied, revenue = _actual_counters()
+    rows = db.session.execute(
+        db.select(ParkingLot.id, ParkingLot.occupied_count, ParkingLot.revenue, occupied, revenue)
+    ).all()
+    return [(lot_id, (stored_occupied, stored_revenue), (actual_occupied, actual_revenue))
+            for lot_id, stored_occupied, stored_revenue, actual_occupied, actual_revenue in rows
+            if stored_occupied != actual_occupied or abs(stored_revenue - actual_revenue) > 0.005]
+
+# recompute the counters of every lot with one set based UPDATE
+def repair_counters():
+    occupied, revenue = _actual_counters()
+    db.session.execute(
+        update(ParkingLot).values(occupied_count=occupied, revenue=revenue)
+        .execution_options(synchronize_session=False)
+    )
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@app.cli.command('check-counters')
+@click.option('--repair', is_flag=True, help='Recompute the counters of every lot.')
+def check_counters_command(repair):
+    """Compare lot occupancy/revenue counters with the spots and reservations."""
+    mismatches = check_counters()
+    for lot_id, stored, actual in mismatches:
+        click.echo(f'Lot {lot_id}: stored occupied/revenue {stored}, actual {actual}')
+    if repair:
+        repair_counters()
+        db.session.commit()
+        click.echo(f'Repaired counters ({len(mismatches)} lot(s) were out of sync).')
+    elif mismatches:
+        raise SystemExit(1)
+    else:
+        click.echo('All lot counters are consistent.')
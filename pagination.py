@@ -0,0 +1,59 @@
+from flask import request, url_for
+
+
+#--------------------------------------- Keyset pagination -----------------------------------------
+# Listings are paged by seeking past the last key of the previous page (WHERE id > :after)
+# instead of OFFSET, so every page costs the same no matter how deep it is.
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class Page:
+    def __init__(self, items, next_after, after):
+        self.items = items
+        self.next_after = next_after
+        self.after = after
+
+    @property
+    def has_next(self):
+        return self.next_after is not None
+
+    @property
+    def is_first(self):
+        return self.after is None
+
+    # url of the current listing with the other query args (search, page size) kept
+    def url(self, after):
+        args = request.args.to_dict()
+        args.pop('after', None)
+        if after is not None:
+            args['after'] = after
+        return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+    @property
+    def next_url(self):
+        return self.url(self.next_after)
+
+    @property
+    def first_url(self):
+        return self.url(None)
+
+
+def page_size():
+    size = request.args.get('per_page', DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+# one page of `query` ordered by the unique `key` column, read from the request args
+def keyset_page(query, key, descending=False):
+    after = request.args.get('after', type=int)
+    size = page_size()
+    if after is not None:
+        query = query.filter(key < after if descending else key > after)
+    query = query.order_by(key.desc() if descending else key)
+    items = query.limit(size + 1).all()
+    next_after = None
+    if len(items) > size:
+        items = items[:size]
+        next_after = getattr(items[-1], key.key)
+    return Page(items, next_after, after)
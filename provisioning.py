@@ -0,0 +1,159 @@
+from app import app
+from models import db, ParkingLot, ParkingSpot, AdvanceBooking, ReservationArchive
+from geo import pincode_location
+from advance import upcoming_windows_exist
+from history import history_tables
+from sqlalchemy import text, func, delete, insert, update, literal
+from datetime import datetime
+import click
+import csv
+
+
+#---------------------------------------- Lot provisioning -----------------------------------------
+# Spots are created and removed with set based statements instead of one ORM object per spot.
+# Deleting a lot is set based too: no spot or reservation is loaded, the reservations are moved
+# (from the hot table and the history partitions, history.py) to reservation_archive, keeping the
+# revenue history, before the spots and the lot are deleted.
+# Nothing here commits, the caller decides where the transaction ends.
+#
+# SQLite only takes the write lock at the first write of a transaction, so "is a spot in use"
+# can't be read before deleting: a booking could commit in between. The first write of a
+# deletion is _lock_free_spots(), an UPDATE of the lot row that carries the check itself.
+
+# spots first_number..last_number of a lot generated inside SQLite with a recursive CTE
+ADD_SPOTS_SQL = text("""
+    INSERT INTO parkingspot (lot_id, spot_number, is_occupied)
+    WITH RECURSIVE seq(n) AS (
+        SELECT :first_number
+        UNION ALL
+        SELECT n + 1 FROM seq WHERE n < :last_number
+    )
+    SELECT :lot_id, n, 0 FROM seq
+""")
+
+def add_spots(lot_id, count):
+    if count <= 0:
+        return
+    last = db.session.query(func.coalesce(func.max(ParkingSpot.spot_number), 0)).filter(ParkingSpot.lot_id == lot_id).scalar()
+    db.session.execute(ADD_SPOTS_SQL, {'lot_id': lot_id, 'first_number': last + 1, 'last_number': last + count})
+
+# remove the `count` highest numbered spots of a lot (archiving their reservations).
+# Returns False without deleting anything if one of those spots is occupied or booked ahead.
+def remove_spots(lot_id, count):
+    if count <= 0:
+        return True
+    spot_ids = (db.select(ParkingSpot.id).where(ParkingSpot.lot_id == lot_id)
+                .order_by(ParkingSpot.spot_number.desc()).limit(count).scalar_subquery())
+    if not _lock_free_spots(lot_id, spot_ids):
+        return False
+    _delete_spots(spot_ids)
+    return True
+
+# bump the version of the lot only if none of `spot_ids` is occupied or booked ahead. Once it
+# matched, the transaction holds the write lock and no booking can take one of those spots
+# before the caller commits. Returns False (having written nothing) if a spot is in use.
+def _lock_free_spots(lot_id, spot_ids):
+    in_use = db.exists().where(ParkingSpot.id.in_(spot_ids), ParkingSpot.is_occupied == True)
+    result = db.session.execute(
+        update(ParkingLot)
+        .where(ParkingLot.id == lot_id, ~in_use, ~upcoming_windows_exist(spot_ids))
+        .values(occupancy_version=ParkingLot.occupancy_version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+# move the reservations matching where(table) (a list of conditions) from the hot table and every
+# history partition to reservation_archive, one INSERT ... SELECT and one DELETE per table.
+# Returns the number archived.
+def archive_reservations(where):
+    archived = 0
+    for table in history_tables():
+        archived += db.session.execute(
+            insert(ReservationArchive).from_select(
+                ['id', 'user_id', 'lot_id', 'spot_id', 'vehicle_id', 'parking_timestamp', 'leaving_timestamp', 'total_cost',
+                 'price_per_hour', 'lot_name', 'lot_address', 'lot_pincode', 'spot_number', 'archived_at'],
+                db.select(table.c.id, table.c.user_id, table.c.lot_id, table.c.spot_id, table.c.vehicle_id,
+                          table.c.parking_timestamp, table.c.leaving_timestamp, table.c.total_cost,
+                          table.c.price_per_hour, ParkingLot.name, ParkingLot.address, ParkingLot.pincode, ParkingSpot.spot_number,
+                          literal(datetime.now()))
+                .join(ParkingLot, ParkingLot.id == table.c.lot_id)
+                .outerjoin(ParkingSpot, ParkingSpot.id == table.c.spot_id)
+                .where(*where(table))
+            )
+        ).rowcount
+        db.session.execute(delete(table).where(*where(table)))
+    return archived
+
+# delete some spots (ids, or a select of them) with their advance bookings, archiving their reservations
+def _delete_spots(spot_ids):
+    archive_reservations(lambda table: [table.c.spot_id.in_(spot_ids)])
+    for statement in (
+        delete(AdvanceBooking).where(AdvanceBooking.spot_id.in_(spot_ids)),
+        delete(ParkingSpot).where(ParkingSpot.id.in_(spot_ids)),
+    ):
+        db.session.execute(statement.execution_options(synchronize_session=False))
+
+# delete a free spot (the caller updates the lot's total), returns False if it is occupied or booked ahead
+def delete_spot(spot_id):
+    lot_id = db.select(ParkingSpot.lot_id).where(ParkingSpot.id == spot_id).scalar_subquery()
+    if not _lock_free_spots(lot_id, [spot_id]):
+        return False
+    _delete_spots([spot_id])
+    return True
+
+# delete a lot with its spots and advance bookings, archiving its reservations. Returns the
+# number of archived reservations, or None without deleting anything if a spot of the lot is
+# occupied or booked ahead.
+def delete_lot(lot_id):
+    spot_ids = db.select(ParkingSpot.id).where(ParkingSpot.lot_id == lot_id)
+    if not _lock_free_spots(lot_id, spot_ids):
+        return None
+    archived = archive_reservations(lambda table: [table.c.lot_id == lot_id])
+    for statement in (
+        delete(AdvanceBooking).where(AdvanceBooking.spot_id.in_(spot_ids)),
+        delete(ParkingSpot).where(ParkingSpot.lot_id == lot_id),
+        delete(ParkingLot).where(ParkingLot.id == lot_id),
+    ):
+        db.session.execute(statement.execution_options(synchronize_session=False))
+    return archived
+
+# a lot without coordinates is placed on the centroid of its pincode, if known
+def create_lot(name, address, pincode, price, total_spots, latitude=None, longitude=None):
+    if latitude is None or longitude is None:
+        latitude, longitude = pincode_location(pincode) or (None, None)
+    lot = ParkingLot(name=name, address=address, pincode=pincode, price_per_hour=price, total_spots=total_spots,
+                     latitude=latitude, longitude=longitude)
+    db.session.add(lot)
+    db.session.flush()
+    add_spots(lot.id, int(total_spots))
+    return lot
+
+# grow or shrink a lot to `total_spots` spots, returns False if occupied (or booked) spots block a shrink
+def resize_lot(lot_id, total_spots):
+    current = db.session.query(func.count(ParkingSpot.id)).filter(ParkingSpot.lot_id == lot_id).scalar()
+    if total_spots > current:
+        add_spots(lot_id, total_spots - current)
+    elif total_spots < current:
+        if not remove_spots(lot_id, current - total_spots):
+            return False
+    return True
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@app.cli.command('import-lots')
+@click.argument('csv_file', type=click.File('r'))
+def import_lots_command(csv_file):
+    """Create lots from a CSV file with columns name,address,pincode,price,total_spots[,latitude,longitude]."""
+    count = 0
+    for row in csv.DictReader(csv_file):
+        pincode = row['pincode'].strip()
+        if not pincode.isdigit() or len(pincode) != 6:
+            db.session.rollback()
+            raise click.ClickException(f'Invalid pincode {pincode!r} on line {count + 2}.')
+        latitude, longitude = row.get('latitude'), row.get('longitude')
+        create_lot(row['name'], row['address'], pincode, float(row['price']), int(row['total_spots']),
+                   float(latitude) if latitude else None, float(longitude) if longitude else None)
+        count += 1
+    db.session.commit()
+    click.echo(f'Imported {count} parking lot(s).')
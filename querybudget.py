@@ -0,0 +1,70 @@
+from app import app
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+#------------------------------------------ Query budget -------------------------------------------
+# Counts the SQL statements issued while handling a request and logs a warning when a route
+# goes over its budget, which is how N+1 lazy loads show up. Set QUERY_BUDGET_STRICT to make
+# an over-budget request fail instead (useful when testing).
+
+DEFAULT_QUERY_BUDGET = 10
+QUERY_BUDGETS = {
+    'admin': 5,
+    'user': 5,      # a nearest lot search may widen its box a few times (geo.py)
+    'userdata': 3,
+    'parking_history': 2,
+    'book_lot': 5,
+    'release': 2,
+    'view_reserve': 3,
+    'admin_summary': 4,
+    'user_summary': 2,
+    'admin_jobs': 2,
+    'admin_job': 2,
+    'api_lots': 2,
+    'api_nearest_lots': 4,
+    'api_lot': 2,
+    'api_lot_availability': 1,
+    'api_availability': 1,
+    'api_reservations': 1,
+    'api_advance_bookings': 1,
+    'advance_bookings': 1,
+    'advance_lot': 2,
+    # writes, including the availability event published after commit; a walk-in booking
+    # retries once more when the first free spot is booked ahead (advance.py), a release moves
+    # the reservation to its history partition (history.py), 9 statements, and the first
+    # release of a month creates the partition first (6 more: a lookup, the table, 4 indexes)
+    'book_lot_post': 9,
+    'release_post': 15,
+    'api_book': 10,
+    'api_release': 15,
+    'api_lot_windows': 9,
+    # the guarded lot update, the deletes and two statements per history table to archive the
+    # reservations of the spot (provisioning.py), a year old history goes over and is logged
+    'delete_spot_post': 12,
+}
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+def query_budget(endpoint):
+    budgets = app.config.get('QUERY_BUDGETS', QUERY_BUDGETS)
+    return budgets.get(endpoint, DEFAULT_QUERY_BUDGET)
+
+@app.after_request
+def check_query_budget(response):
+    count = g.get('query_count', 0)
+    budget = query_budget(request.endpoint)
+    if count > budget:
+        message = f'{request.method} {request.path} ({request.endpoint}) issued {count} SQL statements, budget is {budget}'
+        if app.config.get('QUERY_BUDGET_STRICT'):
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+    return response
@@ -0,0 +1,33 @@
+from sqlalchemy import func
+from models import db, ParkingLot
+from history import union_select
+
+
+#--------------------------------------- Reporting queries -----------------------------------
+# Every report is a single statement returning plain tuples, so no ParkingSpot/Reservation
+# rows are ever loaded as ORM objects. Lot occupancy and revenue come from the running
+# counters on ParkingLot (see occupancy.py).
+
+# revenue of each lot : [(lot_id, lot_name, revenue), ...]
+def lot_revenue():
+    rows = db.session.query(ParkingLot.id, ParkingLot.name, ParkingLot.revenue).order_by(ParkingLot.id).all()
+    return [tuple(r) for r in rows]
+
+# occupied and available spots of each lot : [(lot_id, lot_name, occupied, available), ...]
+def lot_occupancy():
+    rows = (db.session.query(ParkingLot.id, ParkingLot.name, ParkingLot.occupied_count,
+                             ParkingLot.total_spots - ParkingLot.occupied_count)
+            .order_by(ParkingLot.id)
+            .all())
+    return [tuple(r) for r in rows]
+
+# number of reservations of a user in each lot : [(lot_id, lot_name, count), ...]
+def user_lot_usage(user_id):
+    reservations = union_select(lambda t: [t.c.user_id == user_id], ['id', 'lot_id']).subquery()
+    rows = (db.session.query(ParkingLot.id, ParkingLot.name, func.count(reservations.c.id))
+            .outerjoin(reservations, reservations.c.lot_id == ParkingLot.id)
+            .group_by(ParkingLot.id)
+            .order_by(ParkingLot.id)
+            .all())
+    return [tuple(r) for r in rows]
+
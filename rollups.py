@@ -0,0 +1,120 @@
+from app import app
+from models import db, ParkingLot, LotUsageRollup
+from history import history_tables
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert
+from collections import defaultdict
+from datetime import timedelta
+import click
+
+
+#------------------------------------------ Usage rollups ------------------------------------------
+# Per lot hourly and daily buckets of reservations started, occupied spot-hours and revenue.
+# A reservation is added to its buckets when it is released (in the same transaction), and the
+# whole table can be rebuilt from history with `flask backfill-rollups`. Trend reports only ever
+# read rollup rows, so they cost the same however long the reservation history gets.
+
+GRANULARITIES = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+BACKFILL_CHUNK_SIZE = 20000
+
+
+def bucket_start(timestamp, granularity):
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+# add one completed reservation to `buckets` : {(lot_id, granularity, start): [started, spot_hours, revenue]}
+def _accumulate(buckets, lot_id, parking_timestamp, leaving_timestamp, cost):
+    for granularity, width in GRANULARITIES.items():
+        start = bucket_start(parking_timestamp, granularity)
+        buckets[(lot_id, granularity, start)][0] += 1
+        buckets[(lot_id, granularity, bucket_start(leaving_timestamp, granularity))][2] += float(cost or 0)
+        while start < leaving_timestamp:
+            end = start + width
+            overlap = min(end, leaving_timestamp) - max(start, parking_timestamp)
+            buckets[(lot_id, granularity, start)][1] += overlap.total_seconds() / 3600
+            start = end
+
+def _new_buckets():
+    return defaultdict(lambda: [0, 0.0, 0.0])
+
+# upsert accumulated buckets, adding to the rows that already exist
+def _save(buckets):
+    if not buckets:
+        return
+    statement = insert(LotUsageRollup)
+    statement = statement.on_conflict_do_update(
+        index_elements=['lot_id', 'granularity', 'bucket_start'],
+        set_={
+            'reservations_started': LotUsageRollup.reservations_started + statement.excluded.reservations_started,
+            'spot_hours': LotUsageRollup.spot_hours + statement.excluded.spot_hours,
+            'revenue': LotUsageRollup.revenue + statement.excluded.revenue,
+        })
+    db.session.execute(statement, [
+        {'lot_id': lot_id, 'granularity': granularity, 'bucket_start': start,
+         'reservations_started': started, 'spot_hours': spot_hours, 'revenue': revenue}
+        for (lot_id, granularity, start), (started, spot_hours, revenue) in buckets.items()
+    ])
+
+# called by release_post before its commit
+def record_release(reservation):
+    buckets = _new_buckets()
+    _accumulate(buckets, reservation.lot_id, reservation.parking_timestamp,
+                reservation.leaving_timestamp, reservation.total_cost)
+    _save(buckets)
+
+# rebuild every bucket from the completed reservations, partition by partition and chunk by chunk
+def backfill():
+    db.session.execute(delete(LotUsageRollup))
+    count = 0
+    # archived reservations too, the rollups keep the history of deleted lots and spots
+    for table in history_tables(archived=True):
+        query = (db.select(table.c.lot_id, table.c.parking_timestamp, table.c.leaving_timestamp, table.c.total_cost)
+                 .where(table.c.leaving_timestamp.isnot(None))
+                 .execution_options(yield_per=BACKFILL_CHUNK_SIZE))
+        for rows in db.session.execute(query).partitions():
+            buckets = _new_buckets()
+            for row in rows:
+                _accumulate(buckets, *row)
+            _save(buckets)
+            count += len(rows)
+    return count
+
+
+#---------------------------------------------- Queries --------------------------------------------
+
+# buckets of a lot between start and end :
+# [(bucket_start, reservations_started, spot_hours, revenue, occupancy_percent), ...]
+def lot_series(lot_id, granularity, start, end):
+    lot = db.session.get(ParkingLot, lot_id)
+    rows = db.session.execute(
+        db.select(LotUsageRollup.bucket_start, LotUsageRollup.reservations_started,
+                  LotUsageRollup.spot_hours, LotUsageRollup.revenue)
+        .where(LotUsageRollup.lot_id == lot_id, LotUsageRollup.granularity == granularity,
+               LotUsageRollup.bucket_start >= bucket_start(start, granularity),
+               LotUsageRollup.bucket_start < end)
+        .order_by(LotUsageRollup.bucket_start)
+    ).all()
+    capacity = GRANULARITIES[granularity].total_seconds() / 3600 * (lot.total_spots if lot else 0)
+    return [(bucket, started, spot_hours, float(revenue), round(100 * spot_hours / capacity, 1) if capacity else 0)
+            for bucket, started, spot_hours, revenue in rows]
+
+# every bucket between start and end, with zeros where nothing happened
+def filled_series(lot_id, granularity, start, end):
+    rows = {row[0]: row for row in lot_series(lot_id, granularity, start, end)}
+    series = []
+    bucket = bucket_start(start, granularity)
+    while bucket < end:
+        series.append(rows.get(bucket, (bucket, 0, 0.0, 0.0, 0)))
+        bucket += GRANULARITIES[granularity]
+    return series
+
+
+#---------------------------------------------- CLI -----------------------------------------------
+
+@app.cli.command('backfill-rollups')
+def backfill_rollups_command():
+    """Rebuild the hourly/daily lot usage rollups from the reservation history."""
+    count = backfill()
+    db.session.commit()
+    click.echo(f'Rolled up {count} reservation(s).')
@@ -1,13 +1,30 @@
 from app import app
-from flask import render_template,request, redirect, url_for, flash,session
-from models import db,User,ParkingLot,ParkingSpot,Reservation, Vehicle
+from flask import render_template,request, redirect, url_for, flash,session, abort, Response, stream_with_context
+from models import db,User,ParkingLot,ParkingSpot,Reservation, Vehicle, AdvanceBooking, Job
+from reports import lot_revenue, lot_occupancy, user_lot_usage
+from occupancy import touch
+from billing import charge
+from export import csv_gz_stream
+from rollups import filled_series, GRANULARITIES
+from allocator import allocator, first_free_spot_db
+from bookings import book, release as release_reservation, book_window, check_in, booked_price, BookingError
+from advance import parse_time, cancel_window, upcoming_windows, has_upcoming_windows
+from events import get_broker, publish_lot, sse_format, sse_busy, SSE_KEEPALIVE
+from provisioning import create_lot, resize_lot, delete_spot as delete_parking_spot, archive_reservations
+from history import reservation_history
+from jobs import enqueue, job_json, INLINE_RESIZE_SPOTS
+from pagination import Page, keyset_page, page_size
+from geo import nearest_lots, pincode_location
+from search import search_page
+from usercache import current_user, forget_user
+from sqlalchemy import update
+from sqlalchemy.orm import joinedload, selectinload
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
-from datetime import datetime
-import os
-import matplotlib
-matplotlib.use('Agg')  # Use non-GUI backend suitable for Flask
-import matplotlib.pyplot as plt
+from charts import request_chart, get_chart, FORMATS
+from metrics import enabled as metrics_enabled, render_prometheus
+from datetime import datetime, timedelta
+import re
 
 
 #----------------------------------------- Decorators-----------------------------
@@ -30,21 +47,38 @@ def admin_required(f):
         if 'user_id' not in session:
             flash('Please login to continue')
             return redirect(url_for('login'))
-        user= User.query.get(session['user_id'])
-        if not user.is_admin:
+        user= current_user()
+        if not user or not user.is_admin:
             flash('You do not have permission to access this page')
             return redirect(url_for('user'))
         return f(*args, **kwargs)
     return decorated_function
 
 
+# search bar parameters answered by the full text index (see search.py)
+LOT_SEARCH_FIELDS = {'lotname': 'name', 'location': 'address'}
+USER_SEARCH_FIELDS = {'name': 'name', 'ulocation': 'address'}
+# longest period shown by the trend charts
+MAX_TREND_DAYS = {'hour': 31, 'day': 366}
+# page shown after a refused booking, by BookingError.reason
+BOOKING_ERROR_REDIRECTS = {'vehicle': 'vehicle', 'booked': 'parking_history', 'full': 'user', 'window': 'advance_bookings',
+                           'released': 'parking_history'}
+
+
+# both coordinates in range, or both left empty
+def valid_coordinates(latitude, longitude):
+    if latitude is None and longitude is None:
+        return True
+    return latitude is not None and longitude is not None and -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
 #--------------------------------- Index ----------------------------------------------
 
 @app.route('/')
 def index():
     if 'user_id' in session:
-        user = User.query.get(session['user_id'])
-        if user.is_admin:
+        user = current_user()
+        if user and user.is_admin:
             return redirect(url_for('admin'))
         else:
             return redirect(url_for('user'))
@@ -128,14 +162,14 @@ def register_post():
 @app.route('/profile')
 @auth_required
 def profile():
-    user = User.query.get(session['user_id'])
+    user = current_user()
     return render_template("profile.html", user=user)
     
 
 @app.route('/profile/edit')
 @auth_required
 def edit_profile():
-    user= User.query.get(session['user_id'])
+    user= current_user()
     return render_template('editprofile.html',user=user)
 
 @app.route('/profile/edit', methods=['POST'])
@@ -171,6 +205,11 @@ def edit_profile_post():
     user.username = username
     # commit changes to the database
     db.session.commit()
+    forget_user(user.id)
+    session['name'] = user.name
+    session['username'] = user.username
+    session['address'] = user.address
+    session['pincode'] = user.pincode
     flash('Profile updated successfully')
     return redirect(url_for('profile'))
 
@@ -188,10 +227,12 @@ def logout():
 @app.route('/admin')
 @admin_required
 def admin():
-    parkinglots = ParkingLot.query.all()
+    parkinglots = ParkingLot.query
 
     parameter= request.args.get('parameter')
     query= request.args.get('query')
+    # compact view shows only occupancy counts instead of a button for every spot
+    compact = request.args.get('view') == 'counts'
 
     parameters= {
         'default':'Search by ',
@@ -204,19 +245,22 @@ def admin():
     
     if parameter and query:
         try:
-            if parameter == 'lotname':
-                parkinglots = ParkingLot.query.filter(ParkingLot.name.ilike(f'%{query}%')).all()
-            elif parameter == 'location':
-                parkinglots = ParkingLot.query.filter(ParkingLot.address.ilike(f'%{query}%')).all()
-            elif parameter == 'pincode':
-                parkinglots = ParkingLot.query.filter(ParkingLot.pincode.ilike(f'{query}%')).all()
+            if parameter == 'pincode':
+                parkinglots = parkinglots.filter(ParkingLot.pincode.ilike(f'{query}%'))
             elif parameter == 'lotid' and query.isdigit():
-                parkinglots = ParkingLot.query.filter(ParkingLot.id == int(query)).all()
+                parkinglots = parkinglots.filter(ParkingLot.id == int(query))
             elif parameter == 'totalspot' and query.isdigit():
-                parkinglots = ParkingLot.query.filter(ParkingLot.total_spots == int(query)).all()
+                parkinglots = parkinglots.filter(ParkingLot.total_spots == int(query))
         except Exception as e:
             flash("Invalid search input.", "danger")
-    return render_template('admin.html',parkinglots=parkinglots,parameters=parameters,param=parameter,query=query)
+    if not compact:
+        # every spot of the page's lots in one extra query instead of one per lot
+        parkinglots = parkinglots.options(selectinload(ParkingLot.spots))
+    if parameter in LOT_SEARCH_FIELDS and query:
+        page = search_page(ParkingLot, LOT_SEARCH_FIELDS[parameter], query, parkinglots)
+    else:
+        page = keyset_page(parkinglots, ParkingLot.id)
+    return render_template('admin.html',parkinglots=page.items,page=page,compact=compact,parameters=parameters,param=parameter,query=query)
 
 
 #------------------------------------- Parking lot -----------------------------------
@@ -234,20 +278,17 @@ def add_lot_post():
     pincode = request.form.get('pincode')
     price = request.form.get('price')
     totalspots = request.form.get('totalspots')
+    latitude = request.form.get('latitude', type=float)
+    longitude = request.form.get('longitude', type=float)
     if not pincode.isdigit() or len(pincode) != 6:
         flash('Invalid pincode. It should be a 6-digit number.')
         return redirect(url_for('add_lot'))
+    if not valid_coordinates(latitude, longitude):
+        flash('Invalid location. Latitude must be between -90 and 90, longitude between -180 and 180.')
+        return redirect(url_for('add_lot'))
     
-    new_lot=ParkingLot(name=name,address=address,pincode=pincode,price_per_hour=price,total_spots=totalspots)
-    db.session.add(new_lot)
-    db.session.commit()
-    totalspots = int(totalspots)  # Convert to integer 
-    # creating parking spots
-    for i in range(1, totalspots + 1):
-        spot_number = i
-        new_spot = ParkingSpot(lot_id=new_lot.id, spot_number=spot_number, is_occupied=False)
-        db.session.add(new_spot)
-
+    # creating lot with its parking spots
+    create_lot(name, address, pincode, price, int(totalspots), latitude, longitude)
     db.session.commit()
     flash("Parking lot and spots created successfully!")
     return redirect(url_for('admin')) 
@@ -264,33 +305,43 @@ def edit_lot(id):
 @admin_required
 def edit_lot_post(id):
     parkinglot = ParkingLot.query.get(id)
+    previous_spots = parkinglot.total_spots
+    updated_spots = int(request.form.get('totalspots'))
     parkinglot.name = request.form.get('name')
     parkinglot.address = request.form.get('address')
     parkinglot.pincode = request.form.get('pincode')
     parkinglot.price_per_hour = request.form.get('price')
-    parkinglot.total_spots = request.form.get('totalspots')
+    parkinglot.latitude = request.form.get('latitude', type=float)
+    parkinglot.longitude = request.form.get('longitude', type=float)
 
     if not parkinglot.pincode.isdigit() or len(parkinglot.pincode) != 6:
         flash('Invalid pincode. It should be a 6-digit number.')
         return redirect(url_for('edit_lot', id=id))
-    
-    db.session.commit()
-
-    updated_spots = int(request.form.get('totalspots'))
-    current_spots = ParkingSpot.query.filter_by(lot_id=id).count()
-    if updated_spots > current_spots:
-        # Add new parking spots
-        for i in range(current_spots + 1, updated_spots + 1):
-            new_spot = ParkingSpot(lot_id=id, spot_number=i, is_occupied=False)
-            db.session.add(new_spot)
-
-    elif updated_spots < current_spots:
-        spots_to_delete = (ParkingSpot.query.filter_by(lot_id=id).order_by(ParkingSpot.spot_number.desc()).limit(current_spots - updated_spots).all())
-        for spot in spots_to_delete:
-            db.session.delete(spot)
-
+    if not valid_coordinates(parkinglot.latitude, parkinglot.longitude):
+        flash('Invalid location. Latitude must be between -90 and 90, longitude between -180 and 180.')
+        return redirect(url_for('edit_lot', id=id))
+    if parkinglot.latitude is None or parkinglot.longitude is None:
+        parkinglot.latitude, parkinglot.longitude = pincode_location(parkinglot.pincode) or (None, None)
+
+    # large resizes are done by the job worker (jobs.py)
+    job = None
+    if abs(updated_spots - previous_spots) > INLINE_RESIZE_SPOTS:
+        job = enqueue('resize_lot', {'lot_id': id, 'total_spots': updated_spots}, user_id=session['user_id'])
+    elif updated_spots != previous_spots:
+        if not resize_lot(id, updated_spots):
+            db.session.rollback()
+            flash("You can't remove spots from the lot as some of them are occupied.")
+            return redirect(url_for('edit_lot', id=id))
+        parkinglot.total_spots = updated_spots
+
+    touch(id)
     db.session.commit()
-    flash('Parking lot updated successfully')
+    allocator.invalidate(id)
+    publish_lot(id, parkinglot.total_spots - previous_spots)
+    if job:
+        flash(f'Parking lot updated, changing it to {updated_spots} spots is queued as job {job.id}')
+    else:
+        flash('Parking lot updated successfully')
     return redirect(url_for('admin'))
 
 #--------------------------------------------------------------------------------
@@ -305,14 +356,18 @@ def delete_lot(id):
 @admin_required
 def delete_lot_post(id):
     parkinglot = ParkingLot.query.get(id)
-    occupied_spot=next((s.id for s in parkinglot.spots if s.is_occupied), None)
-    if occupied_spot:
+    if parkinglot.occupied_count > 0:
         flash("You can't delete the lot as spot is occupied in this lot.")
         return redirect(url_for('admin'))
+    if has_upcoming_windows(db.select(ParkingSpot.id).where(ParkingSpot.lot_id == id)):
+        flash("You can't delete the lot as spots of this lot are booked ahead.")
+        return redirect(url_for('admin'))
 
-    # Delete parking lot if there is no spot occupied
-    db.session.delete(parkinglot)
+    # Delete parking lot if there is no spot occupied, the job worker deletes it with its
+    # spots and history (checking again that nobody parked meanwhile)
+    job = enqueue('delete_lot', {'lot_id': id}, user_id=session['user_id'])
     db.session.commit()
+    flash(f'Deletion of the parking lot is queued as job {job.id}')
     return redirect(url_for('admin'))
 
 
@@ -321,7 +376,7 @@ def delete_lot_post(id):
 @app.route('/userdata')
 @admin_required
 def userdata():
-    users = User.query.all()
+    users = User.query.filter(User.is_admin == False)
     parameter= request.args.get('parameter')
     query= request.args.get('query')
 
@@ -337,18 +392,18 @@ def userdata():
     if parameter and query:
         try:
             if parameter == 'userid' and query.isdigit():
-                users = User.query.filter(User.id == int(query)).all()
-            elif parameter == 'ulocation':
-                users = User.query.filter(User.address.ilike(f'%{query}%')).all()
-            elif parameter== "name":
-                users=User.query.filter(User.name.ilike(f'%{query}%')).all()
+                users = users.filter(User.id == int(query))
             elif parameter == 'uname':
-                users = User.query.filter(User.username.ilike(f'{query}%')).all()
+                users = users.filter(User.username.ilike(f'{query}%'))
             elif parameter == 'upincode':
-                users = User.query.filter(User.pincode.like(f'{query}%')).all()
+                users = users.filter(User.pincode.like(f'{query}%'))
         except Exception as e:
             flash('Invalid search query.')
-    return render_template('user/userdata.html', users=users,parameters=parameters,param=parameter,query=query)
+    if parameter in USER_SEARCH_FIELDS and query:
+        page = search_page(User, USER_SEARCH_FIELDS[parameter], query, users)
+    else:
+        page = keyset_page(users, User.id)
+    return render_template('user/userdata.html', users=page.items,page=page,parameters=parameters,param=parameter,query=query)
 
 
 #------------------------------------------- View reserved spot --------------------------------------
@@ -356,15 +411,12 @@ def userdata():
 @app.route('/reserved/<int:id>/view')
 @admin_required
 def view_reserve(id):
-    reservation=Reservation.query.filter_by(spot_id=id).first()
+    reservation=(Reservation.query.options(joinedload(Reservation.user), joinedload(Reservation.vehicle), joinedload(Reservation.parkinglot))
+                 .filter_by(spot_id=id,leaving_timestamp=None).first())
     if not reservation:
         flash('Reservation not found')
         return redirect(url_for('admin'))
-    leaving_timestamp = datetime.now()
-    ptimestamp= reservation.parking_timestamp
-    duration = leaving_timestamp - ptimestamp
-    hrs = duration.total_seconds() / 3600
-    est_cost = round(hrs * reservation.parkinglot.price_per_hour, 2)
+    est_cost = charge(reservation.parking_timestamp, datetime.now(), booked_price(reservation))
     return render_template('spot/occupiedspot.html',reservation=reservation,est_cost=est_cost)
 
 
@@ -384,94 +436,128 @@ def delete_spot(id):
 @app.route('/admin/deletespot/<int:id>', methods=['POST'])
 @admin_required
 def delete_spot_post(id):
-    spot=ParkingSpot.query.get(id)
-    parkinglot=ParkingLot.query.filter_by(id=spot.lot_id).first()
-
-    if spot.is_occupied:
-        flash("You can't delete the spot as it is reserved")
+    spot = db.session.get(ParkingSpot, id)
+    if not spot:
+        flash('Spot not found')
         return redirect(url_for('admin'))
-    db.session.delete(spot)
-    parkinglot.total_spots=parkinglot.total_spots-1
-    
+    lot_id = spot.lot_id
+    if not delete_parking_spot(id):
+        flash("You can't delete the spot as it is reserved or booked ahead")
+        return redirect(url_for('admin'))
+    db.session.execute(update(ParkingLot).where(ParkingLot.id == lot_id)
+                       .values(total_spots=ParkingLot.total_spots - 1).execution_options(synchronize_session=False))
+    touch(lot_id)
     db.session.commit()
+    allocator.remove_spot(lot_id, id)
+    publish_lot(lot_id, -1, spot_id=id, removed=True)
 
     flash('Spot deleted successfully')
     return redirect(url_for('admin'))
 
 
+# ------------------------------------------ Reservation export ------------------------------------
+
+@app.route('/admin/export/reservations.csv.gz')
+@admin_required
+def export_reservations():
+    filename = f"reservations-{datetime.now():%Y%m%d-%H%M%S}.csv.gz"
+    return Response(stream_with_context(csv_gz_stream()), mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+# ------------------------------------------ Background jobs ---------------------------------------
+
+@app.route('/admin/jobs')
+@admin_required
+def admin_jobs():
+    page = keyset_page(Job.query, Job.id, descending=True)
+    return render_template('adminjobs.html', jobs=page.items, page=page)
+
+# status and result of a job, polled by the jobs page
+@app.route('/admin/jobs/<int:id>')
+@admin_required
+def admin_job(id):
+    job = db.session.get(Job, id)
+    if not job:
+        abort(404)
+    return job_json(job)
+
+
+# ------------------------------------------ Metrics -----------------------------------------------
+
+# Prometheus metrics of this worker, for admins or a scraper sending "Bearer <METRICS_TOKEN>"
+@app.route('/admin/metrics')
+def metrics():
+    if not metrics_enabled():
+        abort(404)
+    token = app.config.get('METRICS_TOKEN')
+    if not token or request.headers.get('Authorization') != f'Bearer {token}':
+        user = current_user()
+        if not user or not user.is_admin:
+            abort(403)
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
 # ------------------------------------------ Admin summary  ----------------------------------------
 
 @app.route('/admin/summary')
 @admin_required
 def admin_summary():
     #revenue from each parking lot
-    lots = ParkingLot.query.all()
-    revenue_data = []
-    lot_labels = []
-
-    for lot in lots:
-        reservations = Reservation.query.filter_by(lot_id=lot.id).all()
-        total_revenue = 0
-        for r in reservations:
-            if r.leaving_timestamp:
-                hours = (r.leaving_timestamp - r.parking_timestamp).total_seconds() / 3600
-                total_revenue += hours * lot.price_per_hour
-        revenue_data.append(total_revenue)
-        lot_labels.append(lot.name)
+    revenue = lot_revenue()
+    lot_labels = [name for _, name, _ in revenue]
+    revenue_data = [total for _, _, total in revenue]
 
     #summary on available and occupied parking lots
-    bar_labels = []
-    occupied_counts = []
-    available_counts = []
-
-    for lot in lots:
-        spots = ParkingSpot.query.filter_by(lot_id=lot.id).all()
-        occupied = sum(1 for s in spots if s.is_occupied)
-        available = len(spots) - occupied
-        bar_labels.append(lot.name)
-        occupied_counts.append(occupied)
-        available_counts.append(available)
-
-    #  Creating charts directory if not exists
-    os.makedirs('static/charts', exist_ok=True)
-
-    # Donut chart wedges, texts, autotexts 
-    plt.pie(
-        revenue_data,
-        labels=lot_labels,
-        autopct='%1.1f%%',
-        startangle=140,
-        wedgeprops=dict(width=0.4)
-    )
-    plt.title("Revenue Distribution by Lot")
-    plt.savefig('static/charts/revenue_donut.png')
-    plt.close()
-
-    # Bar chart 
-    x = range(len(bar_labels))
-    plt.figure(figsize=(8, 6))
-    plt.bar(x, available_counts, width=0.4, label='Available', align='center')
-    plt.bar(x, occupied_counts, width=0.4, bottom=available_counts, label='Occupied', align='center')
-    plt.xticks(x, bar_labels, rotation=45)
-    plt.ylabel('Number of Spots')
-    plt.title('Parking Spot Summary by Lot')
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig('static/charts/occupancy_bar.png')
-    plt.close()
-
-    return render_template('adminsummary.html')
+    occupancy = lot_occupancy()
+    bar_labels = [name for _, name, _, _ in occupancy]
+    occupied_counts = [occupied for _, _, occupied, _ in occupancy]
+    available_counts = [available for _, _, _, available in occupancy]
+
+    revenue_chart = request_chart('revenue_donut', {'labels': lot_labels, 'values': revenue_data})
+    occupancy_chart = request_chart('occupancy_bar', {'labels': bar_labels, 'occupied': occupied_counts,
+                                                      'available': available_counts})
+
+    return render_template('adminsummary.html', revenue_chart=revenue_chart, occupancy_chart=occupancy_chart)
 
     
 
 
 
+# ------------------------------------------ Admin trends  -----------------------------------------
+
+@app.route('/admin/trends')
+@admin_required
+def admin_trends():
+    lots = db.session.execute(db.select(ParkingLot.id, ParkingLot.name).order_by(ParkingLot.id)).all()
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        granularity = 'day'
+    days = max(1, min(request.args.get('days', 7 if granularity == 'hour' else 30, type=int), MAX_TREND_DAYS[granularity]))
+    lot_id = request.args.get('lot', lots[0].id if lots else None, type=int)
+    if lot_id is None:
+        flash('No parking lots yet.')
+        return redirect(url_for('admin'))
+
+    end = datetime.now()
+    series = filled_series(lot_id, granularity, end - timedelta(days=days), end)
+    label_format = '%d %b %H:00' if granularity == 'hour' else '%d %b'
+    labels = [bucket.strftime(label_format) for bucket, *_ in series]
+    lot_name = next((name for id, name in lots if id == lot_id), f'Lot {lot_id}')
+    occupancy_chart = request_chart('occupancy_trend', {'labels': labels, 'values': [row[4] for row in series],
+                                                        'title': f'{lot_name} occupancy per {granularity}'})
+    revenue_chart = request_chart('revenue_trend', {'labels': labels, 'values': [row[3] for row in series],
+                                                    'title': f'{lot_name} revenue per {granularity}'})
+    return render_template('admintrends.html', lots=lots, lot_id=lot_id, granularity=granularity, days=days,
+                           occupancy_chart=occupancy_chart, revenue_chart=revenue_chart)
+
+
 #------------------------------------------------ User ------------------------------------------
 
 @app.route('/user')
 @auth_required
 def user():
-    parkinglots = ParkingLot.query.all()
+    parkinglots = ParkingLot.query
     parameter= request.args.get('parameter')
     query= request.args.get('query')
 
@@ -479,19 +565,26 @@ def user():
         'default':'Search by',
         'lotname':'Lot name',
         'location' : 'Location',
-        'pincode':'Pincode'
+        'pincode':'Pincode',
+        'nearby':'Nearest to pincode'
     }
     
-    if parameter=='lotname':
-        parkinglots=ParkingLot.query.filter(ParkingLot.name.ilike(f'%{query}%')).all()
-        return render_template('user/user.html',parkinglots=parkinglots,parameters=parameters,param=parameter,query=query)
-    elif parameter=='location':
-        parkinglots=ParkingLot.query.filter(ParkingLot.address.ilike(f'%{query}%')).all()
-        return render_template('user/user.html',parkinglots=parkinglots,parameters=parameters,param=parameter,query=query)
-    elif parameter=='pincode':
-        parkinglots=ParkingLot.query.filter(ParkingLot.pincode.ilike(f'{query}%')).all()
-        return render_template('user/user.html',parkinglots=parkinglots,parameters=parameters,param=parameter,query=query)
-    return render_template('user/user.html',parkinglots=parkinglots,parameters=parameters,param=parameter,query=query)
+    distances = None
+    if parameter=='pincode':
+        parkinglots=parkinglots.filter(ParkingLot.pincode.ilike(f'{query}%'))
+    if parameter in LOT_SEARCH_FIELDS and query:
+        page = search_page(ParkingLot, LOT_SEARCH_FIELDS[parameter], query)
+    elif parameter == 'nearby' and query:
+        # lots with a free spot closest to the centroid of the pincode
+        location = pincode_location(query.strip())
+        if not location:
+            flash('Location of this pincode is not known.')
+        nearest = nearest_lots(*location, limit=page_size()) if location else []
+        distances = {lot.id: distance for lot, distance in nearest}
+        page = Page([lot for lot, _ in nearest], None, None)
+    else:
+        page = keyset_page(parkinglots, ParkingLot.id)
+    return render_template('user/user.html',parkinglots=page.items,page=page,parameters=parameters,param=parameter,query=query,distances=distances)
     
 
 #---------------------------------------- Book lot --------------------------------------------
@@ -500,79 +593,125 @@ def user():
 @auth_required
 def book_lot(id):
     parkinglot = ParkingLot.query.get(id)
+    if not parkinglot:
+        flash('Parking lot not found')
+        return redirect(url_for('user'))
     vehicles = Vehicle.query.filter_by(user_id=session['user_id']).all()
-    spot = next((s.id for s in parkinglot.spots if not s.is_occupied), None)
+    spot = allocator.first_free(id)
+    if not spot and first_free_spot_db(id):
+        # another worker released a spot, reload the free list of this lot
+        allocator.invalidate(id)
+        spot = allocator.first_free(id)
     if not spot:
         flash('No vacant spots available in this lot.')
         return redirect(url_for('user'))
     if not vehicles:
         flash('No vehicles found. Please add a vehicle first.')
         return redirect(url_for('vehicle'))
-    if not parkinglot:
-        flash('Parking lot not found')
-        return redirect(url_for('user'))
     return render_template('lot/booklot.html', parkinglot=parkinglot,vehicles=vehicles, spot=spot)
 
 @app.route('/lot/<int:id>/book', methods=['POST'])
 @auth_required
 def book_lot_post(id):
-    lot_id = request.form.get('lot_id')
-    vehicle_id = request.form.get('vehicleid')
-    spot_id= int(request.form.get('spotid'))
-
-    # Validate vehicle 
-    vehicle = Vehicle.query.filter_by(id=vehicle_id, user_id=session['user_id']).first()
-    if not vehicle:
-        flash(f'Vehicle {vehicle_id} not found or not owned by the user.')
-        return redirect(url_for('vehicle')) 
-     
-    # timestamp
-    # timestamp=now.strftime("%H:%M:%S")
-    
-    # Check if the user has already booked for given vehicle
-    existing_reservation = Reservation.query.filter_by(user_id=session['user_id'], lot_id=id,vehicle_id=vehicle.id,leaving_timestamp=None).first()
-    if existing_reservation:
-        flash(f'You have already booked a spot for vehicle : {vehicle.vehicle_number} in this parking lot.')
-        return redirect(url_for('parking_history'))
-
-    #check if given vehicle have already a reserved spot in any lot
-    reservation=Reservation.query.filter_by(vehicle_id=vehicle_id,leaving_timestamp=None).first()
-    if reservation:
-        flash(f'You already booked a spot for vehicle : {vehicle.vehicle_number}')
-        return redirect(url_for('parking_history'))
-    
-    # Create reservation
-    reservation = Reservation(
-        user_id=session['user_id'],
-        lot_id=lot_id,
-        spot_id=spot_id,
-        vehicle_id=vehicle.id,
-        parking_timestamp=datetime.now(),
-        leaving_timestamp=None,
-        total_cost=None
-    )
-    spot=ParkingSpot.query.filter_by(id=spot_id).first()
-    # Mark the spot as occupied
-    spot.is_occupied = True
-    db.session.add(reservation)
-    db.session.commit()
+    vehicle_id = request.form.get('vehicleid', type=int)
+    spot_id = request.form.get('spotid', type=int)
+    try:
+        book(session['user_id'], id, vehicle_id, spot_id)
+    except BookingError as e:
+        flash(str(e))
+        return redirect(url_for(BOOKING_ERROR_REDIRECTS[e.reason]))
 
     flash(f'Spot successfully reserved ')
     return redirect(url_for('user'))
 
 
+#---------------------------------------- Advance bookings ------------------------------------
+
+@app.route('/lot/<int:id>/advance')
+@auth_required
+def advance_lot(id):
+    parkinglot = ParkingLot.query.get(id)
+    if not parkinglot:
+        flash('Parking lot not found')
+        return redirect(url_for('user'))
+    vehicles = Vehicle.query.filter_by(user_id=session['user_id']).all()
+    if not vehicles:
+        flash('No vehicles found. Please add a vehicle first.')
+        return redirect(url_for('vehicle'))
+    start = (datetime.now() + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+    return render_template('lot/advancelot.html', parkinglot=parkinglot, vehicles=vehicles,
+                           start=start.strftime('%Y-%m-%dT%H:%M'), end=(start + timedelta(hours=2)).strftime('%Y-%m-%dT%H:%M'))
+
+@app.route('/lot/<int:id>/advance', methods=['POST'])
+@auth_required
+def advance_lot_post(id):
+    if not db.session.get(ParkingLot, id):
+        flash('Parking lot not found')
+        return redirect(url_for('user'))
+    start = parse_time(request.form.get('start'))
+    end = parse_time(request.form.get('end'))
+    if not start or not end:
+        flash('Please give the start and end of the booking.')
+        return redirect(url_for('advance_lot', id=id))
+    try:
+        booking = book_window(session['user_id'], id, request.form.get('vehicleid', type=int), start, end)
+    except BookingError as e:
+        flash(str(e))
+        if e.reason == 'vehicle':
+            return redirect(url_for('vehicle'))
+        return redirect(url_for('advance_lot', id=id))
+    flash(f'Spot {booking.parkingspot.spot_number} booked from {booking.start_time} until {booking.end_time}')
+    return redirect(url_for('advance_bookings'))
+
+@app.route('/advance')
+@auth_required
+def advance_bookings():
+    bookings = upcoming_windows(session['user_id']).options(
+        joinedload(AdvanceBooking.parkingspot), joinedload(AdvanceBooking.parkinglot), joinedload(AdvanceBooking.vehicle)).all()
+    return render_template('user/advancebookings.html', bookings=bookings)
+
+@app.route('/advance/<int:id>/checkin', methods=['POST'])
+@auth_required
+def check_in_post(id):
+    booking = db.session.get(AdvanceBooking, id)
+    if not booking or booking.user_id != session['user_id']:
+        flash('Booking not found')
+        return redirect(url_for('advance_bookings'))
+    try:
+        reservation = check_in(booking)
+    except BookingError as e:
+        flash(str(e))
+        return redirect(url_for(BOOKING_ERROR_REDIRECTS[e.reason]))
+    flash(f'Checked in on spot {reservation.parkingspot.spot_number}')
+    return redirect(url_for('parking_history'))
+
+@app.route('/advance/<int:id>/cancel', methods=['POST'])
+@auth_required
+def cancel_advance_post(id):
+    booking = db.session.get(AdvanceBooking, id)
+    if not booking or booking.user_id != session['user_id']:
+        flash('Booking not found')
+        return redirect(url_for('advance_bookings'))
+    if cancel_window(booking):
+        db.session.commit()
+        flash('Booking cancelled')
+    else:
+        flash('This booking can not be cancelled.')
+    return redirect(url_for('advance_bookings'))
+
+
 #-------------------------------------- Release lot ---------------------------------------------
 
 @app.route('/spot/<int:id>/release')
 @auth_required
 def release(id):
-    reservation=Reservation.query.get(id)
+    reservation=Reservation.query.options(joinedload(Reservation.vehicle), joinedload(Reservation.parkinglot)).get(id)
+    if not reservation or reservation.user_id != session['user_id'] or reservation.leaving_timestamp:
+        flash('Reservation not found')
+        return redirect(url_for('parking_history'))
     leaving_timestamp = datetime.now()
-    parking_timestamp= reservation.parking_timestamp
-
-    duration = leaving_timestamp - parking_timestamp
-    hrs = duration.total_seconds() / 3600
-    cost = round(hrs * reservation.parkinglot.price_per_hour, 2)
+    # estimate only, the charge is computed again when the spot is released
+    cost = charge(reservation.parking_timestamp, leaving_timestamp, booked_price(reservation))
 
     return render_template('spot/release.html',reservation=reservation,l_timestamp=leaving_timestamp,cost=cost)
 
@@ -580,25 +719,68 @@ def release(id):
 @auth_required
 def release_post(id):
     reservation = Reservation.query.get(id)
-    l_str=request.form.get('l_timestamp') 
-    # converting str to datetime
-    reservation.leaving_timestamp = datetime.fromisoformat(l_str)
-    reservation.total_cost=request.form.get('cost')
-    spot=ParkingSpot.query.filter_by(id=reservation.spot_id).first()
-    # Delete parking lot
-    spot.is_occupied=False
-    db.session.commit()
+    if not reservation or reservation.user_id != session['user_id'] or reservation.leaving_timestamp:
+        flash('Reservation not found')
+        return redirect(url_for('parking_history'))
+    try:
+        release_reservation(reservation)
+    except BookingError as e:
+        flash(str(e))
+        return redirect(url_for(BOOKING_ERROR_REDIRECTS[e.reason]))
     flash('Spot released successfully')
     return redirect(url_for('parking_history'))
 
 
+#------------------------------------------ Availability events -----------------------------------
+
+# where the pages open their availability stream: EVENT_STREAM_URL when the event stream server
+# (eventstream.py) listens on an address of its own, {hostname} being the one of this request,
+# else this path (served by the route below, or by the server behind the same reverse proxy)
+@app.template_global()
+def availability_stream_url(lot_ids):
+    lots = ','.join(str(id) for id in lot_ids)
+    url = app.config['EVENT_STREAM_URL']
+    if url:
+        return url.format(hostname=request.host.rpartition(':')[0] or request.host) + f'?lots={lots}'
+    return url_for('availability_events', lots=lots)
+
+# Server-Sent Events stream of availability changes, ?lots=1,2,3 limits it to some lots. Each
+# stream holds a worker thread, so only SSE_MAX_THREAD_STREAMS are served, the next ones are
+# told to come back later (events.sse_busy)
+@app.route('/events/availability')
+@auth_required
+def availability_events():
+    lot_ids = [int(id) for id in request.args.get('lots', '').split(',') if id.isdigit()]
+    broker = get_broker()
+    if broker.subscriber_count() >= app.config['SSE_MAX_THREAD_STREAMS']:
+        return Response(sse_busy(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    subscription = broker.subscribe(lot_ids)
+
+    # runs after the request context is gone, it only reads the subscription queue
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                event = subscription.get(timeout=SSE_KEEPALIVE)
+                yield sse_format(event) if event else ': keepalive\n\n'
+        finally:
+            subscription.close()
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 #------------------------------------------- parking history -------------------------------------
 
 @app.route('/parking/history')
 @auth_required
 def parking_history():
-    reservations=Reservation.query.filter_by(user_id=session['user_id']).all()
-    return render_template('user/parkinghistory.html',reservations=reservations)
+    # newest reservations first, active and past ones (history.py)
+    history = reservation_history('user_id')
+    reservations = (db.session.query(history).params(user_id=session['user_id'])
+                    .options(joinedload(history.parkingspot), joinedload(history.parkinglot), joinedload(history.vehicle)))
+    page = keyset_page(reservations, history.id, descending=True)
+    return render_template('user/parkinghistory.html',reservations=page.items,page=page)
 
 
 
@@ -664,6 +846,12 @@ def delete_vehicle_post(id):
     if reservation:
         flash(f"You can't delete vehicle : {vehicle.vehicle_number} as it reserved a spot")
         return redirect(url_for('parking_history'))
+    if upcoming_windows(session['user_id']).filter(AdvanceBooking.vehicle_id == id, AdvanceBooking.status == 'booked').first():
+        flash(f"You can't delete vehicle : {vehicle.vehicle_number} as it is booked ahead")
+        return redirect(url_for('advance_bookings'))
+    # the ORM cascade only reaches the active reservations, its past ones (and their revenue)
+    # go to reservation_archive
+    archive_reservations(lambda t: [t.c.vehicle_id == id])
     db.session.delete(vehicle)
     db.session.commit()
     flash('Deleted successfully')
@@ -675,31 +863,32 @@ def delete_vehicle_post(id):
 @app.route('/user/<int:id>/summary')
 @auth_required
 def user_summary(id):
-    lots = ParkingLot.query.all()
-    # count = defaultdict(int)
-    count={}
-    for lot in lots:
-        count[lot.name] = 0
-    reservations = Reservation.query.filter_by(user_id=id).all()
-    for r in reservations:
-        lot = ParkingLot.query.get(r.lot_id)
-        if lot:
-            count[lot.name] += 1
-    lot_names = list(count.keys())
-    counts = list(count.values())
-
-    plt.figure(figsize=(8, 5))
-    plt.bar(lot_names, counts, color='green')
-    plt.xlabel('Parking Lots')
-    plt.ylabel('No. of Used Spots')
-    plt.title('Summary of Used Parking Spots')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    image_path = os.path.join('static', 'summary_plot.png')
-    plt.savefig(image_path)
-    plt.close()
-
-    return render_template('user/usersummary.html', image_file='summary_plot.png')
-
-   
+    usage = user_lot_usage(id)
+    lot_names = [name for _, name, _ in usage]
+    counts = [count for _, _, count in usage]
+
+    chart = request_chart('user_usage_bar', {'labels': lot_names, 'values': counts})
+
+    return render_template('user/usersummary.html', chart=chart)
 
+
+#--------------------------------------------------- Charts ------------------------------------------
+
+@app.route('/chart/<key>.<fmt>')
+@auth_required
+def chart(key, fmt):
+    if fmt not in FORMATS or not re.fullmatch(r'[0-9a-f]{64}', key):
+        abort(404)
+    response = Response(mimetype=FORMATS[fmt])
+    response.set_etag(key)
+    # the key is a hash of the chart data, so a cached chart never goes stale
+    response.cache_control.private = True
+    response.cache_control.max_age = 86400
+    if key in request.if_none_match:
+        response.status_code = 304
+        return response
+    content = get_chart(key, fmt)
+    if content is None:
+        abort(404)
+    response.set_data(content)
+    return response
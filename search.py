@@ -0,0 +1,53 @@
+from models import db, User, ParkingLot
+from pagination import Page, page_size
+from flask import request
+from sqlalchemy import text
+
+
+#--------------------------------------------- Search ----------------------------------------------
+# Name and address searches of lots and users go through the FTS5 tables created in
+# migrations.py (parkinglot_fts, user_fts). They use the trigram tokenizer, so a query still
+# matches anywhere inside the text (like ilike('%query%')) and is case insensitive, but is
+# answered from the index and ranked with bm25 instead of scanning the table.
+
+FTS_TABLES = {ParkingLot: 'parkinglot_fts', User: 'user_fts'}
+SEARCH_FIELDS = ('name', 'address')
+SEARCH_LIMIT = 1000         # most matches a search ever returns
+MIN_TRIGRAM_LENGTH = 3      # trigram index can't answer shorter queries
+
+
+def _fts_phrase(query):
+    return '"' + query.replace('"', '""') + '"'
+
+# ids of the rows of `model` whose `field` contains `query`, best match first
+def ranked_ids(model, field, query, limit=SEARCH_LIMIT):
+    if field not in SEARCH_FIELDS:
+        raise ValueError(f'{field} is not searchable')
+    query = query.strip()
+    if not query:
+        return []
+    if len(query) < MIN_TRIGRAM_LENGTH:
+        column = getattr(model, field)
+        return db.session.execute(
+            db.select(model.id).where(column.ilike(f'%{query}%')).order_by(model.id).limit(limit)
+        ).scalars().all()
+    fts_table = FTS_TABLES[model]
+    return db.session.execute(
+        text(f'SELECT rowid FROM {fts_table} WHERE {field} MATCH :phrase ORDER BY rank LIMIT :limit'),
+        {'phrase': _fts_phrase(query), 'limit': limit}
+    ).scalars().all()
+
+# one page of ranked search results, `after` is the id of the last row of the previous page
+def search_page(model, field, query, base_query=None):
+    ids = ranked_ids(model, field, query)
+    after = request.args.get('after', type=int)
+    start = ids.index(after) + 1 if after in ids else 0
+    size = page_size()
+    page_ids = ids[start:start + size]
+    if base_query is None:
+        base_query = model.query
+    rows = base_query.filter(model.id.in_(page_ids)).all() if page_ids else []
+    position = {id: index for index, id in enumerate(page_ids)}
+    rows.sort(key=lambda row: position[row.id])
+    next_after = page_ids[-1] if start + size < len(ids) else None
+    return Page(rows, next_after, after if start else None)
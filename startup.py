@@ -0,0 +1,50 @@
+from app import app
+import click
+import subprocess
+import sys
+
+
+#------------------------------------------ Startup time -------------------------------------------
+# Importing the app must stay cheap: no database work and no heavy libraries at import time
+# (tables and migrations are done by `flask init-db`, matplotlib/numpy are imported where they
+# are used). `flask check-import-time` imports the app in a fresh interpreter with
+# `python -X importtime` and fails when it gets slow or pulls in one of HEAVY_MODULES.
+
+IMPORT_TIME_BUDGET = 1.5    # seconds for `import app`
+HEAVY_MODULES = ('matplotlib', 'numpy', 'pyarrow', 'pandas')
+
+
+# [(depth, module, cumulative seconds)] of a fresh `import app`, depth 0 = top level imports
+def import_times():
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=app.root_path, capture_output=True, text=True)
+    if result.returncode:
+        raise click.ClickException(result.stderr.strip().splitlines()[-1])
+    times = []
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nested imports indented by 2
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((depth, name.strip(), int(cumulative) / 1e6))
+    return times
+
+@app.cli.command('check-import-time')
+@click.option('--budget', type=float, default=IMPORT_TIME_BUDGET, show_default=True,
+              help='Maximum seconds for importing the app.')
+@click.option('--top', type=int, default=10, show_default=True, help='Slowest imports to list.')
+def check_import_time_command(budget, top):
+    """Measure `import app` in a fresh interpreter and fail when it is too slow."""
+    times = import_times()
+    total = sum(seconds for depth, name, seconds in times if depth == 0 and name == 'app')
+    # modules imported by app and its own modules, slowest first
+    direct = sorted((seconds, name) for depth, name, seconds in times if depth == 1)
+    for seconds, name in direct[::-1][:top]:
+        click.echo(f'{seconds * 1000:8.1f} ms  {name}')
+    heavy = sorted({name.split('.')[0] for depth, name, seconds in times} & set(HEAVY_MODULES))
+    click.echo(f'import app: {total:.2f}s (budget {budget:.2f}s)')
+    if heavy:
+        click.echo(f'Imported at startup, should be lazy: {", ".join(heavy)}')
+    if heavy or total > budget:
+        raise SystemExit(1)
@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+
+# the app creates its engine on import, point it at a scratch database first
+DATABASE = os.path.join(tempfile.mkdtemp(prefix='parking-tests-'), 'test.db')
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DATABASE
+os.environ['SECRET_KEY'] = 'test'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app
+from models import db
+from allocator import allocator
+import history
+import geo
+import migrations
+import usercache
+import pytest
+
+
+# in-process state that would outlive the database of the previous test
+def _reset_caches():
+    history._partitions.clear()
+    history._entities.clear()
+    allocator._free.clear()
+    allocator._heap.clear()
+    geo._pincode_cache.clear()
+    usercache._cache.clear()
+
+
+# an empty database file, nothing created yet
+@pytest.fixture
+def empty_app():
+    with flask_app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(DATABASE + suffix):
+                os.remove(DATABASE + suffix)
+        _reset_caches()
+        yield flask_app
+        db.session.remove()
+
+# a fresh, migrated database (with the default admin) for every test
+@pytest.fixture
+def app(empty_app):
+    migrations.init_db()
+    return empty_app
+
+
+# a user with one vehicle, returns (user id, vehicle id)
+@pytest.fixture
+def make_user(app):
+    from models import User, Vehicle
+    def make(name='driver'):
+        user = User(name=name, address='Address', pincode='600001', username=f'{name}@example.com', passhash='-')
+        db.session.add(user)
+        db.session.flush()
+        vehicle = Vehicle(user_id=user.id, vehicle_number=f'TN-{user.id:04d}', vehicle_type='car')
+        db.session.add(vehicle)
+        db.session.commit()
+        return user.id, vehicle.id
+    return make
+
+# a lot with `spots` free spots, returns its id
+@pytest.fixture
+def make_lot(app):
+    from provisioning import create_lot
+    def make(spots=3, price=20):
+        lot = create_lot('Lot', 'Street', '600001', price, spots)
+        db.session.commit()
+        return lot.id
+    return make
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
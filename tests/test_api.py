@@ -0,0 +1,80 @@
+from models import db, Reservation
+from bookings import book
+from app import app as flask_app
+import pytest
+
+
+# a request in an application context of its own, as in test_query_budget
+def send(client, method, url, **kwargs):
+    with flask_app.app_context():
+        return client.open(url, method=method, **kwargs)
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+def test_login_required(make_lot, client):
+    response = send(client, 'GET', f'/api/v1/lots/{make_lot()}')
+    assert response.status_code == 401 and response.json['message'] == 'Login required.'
+
+def test_etag_until_a_booking(make_user, make_lot, client):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    login(client, user_id)
+    first = send(client, 'GET', f'/api/v1/lots/{lot_id}')
+    assert first.status_code == 200 and first.json['free_spots'] == 3
+    etag = first.headers['ETag']
+    unchanged = send(client, 'GET', f'/api/v1/lots/{lot_id}', headers={'If-None-Match': etag})
+    assert unchanged.status_code == 304 and unchanged.data == b''
+
+    assert send(client, 'POST', f'/api/v1/lots/{lot_id}/bookings', json={'vehicle_id': vehicle_id}).status_code == 201
+    changed = send(client, 'GET', f'/api/v1/lots/{lot_id}', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.json['free_spots'] == 2
+    assert changed.headers['ETag'] != etag
+
+def test_batch_availability(make_user, make_lot, client):
+    user_id, vehicle_id = make_user()
+    first, second = make_lot(spots=3), make_lot(spots=5)
+    book(user_id, first, vehicle_id)
+    login(client, user_id)
+    # unknown ids are left out, the lots come in id order
+    response = send(client, 'GET', f'/api/v1/availability?ids={second},{first},999')
+    assert response.status_code == 200 and 'ETag' in response.headers
+    lots = response.json['lots']
+    assert [(lot['lot_id'], lot['total_spots'], lot['free_spots']) for lot in lots] == [(first, 3, 2), (second, 5, 5)]
+    assert all(set(lot) == {'lot_id', 'total_spots', 'free_spots', 'version'} for lot in lots)
+    assert lots[0]['version'] > lots[1]['version']
+    assert send(client, 'POST', '/api/v1/availability', json={'ids': [second, first]}).json == response.json
+    assert send(client, 'GET', '/api/v1/availability?ids=a').status_code == 400
+    assert send(client, 'POST', '/api/v1/availability', json={'ids': list(range(1, 102))}).status_code == 400
+
+@pytest.mark.parametrize('method, url', [
+    ('GET', '/api/v1/lots/999'),
+    ('GET', '/api/v1/lots/999/availability'),
+    ('POST', '/api/v1/lots/999/bookings'),
+    ('POST', '/api/v1/reservations/999/release'),
+])
+def test_unknown_is_404(make_user, client, method, url):
+    user_id, vehicle_id = make_user()
+    login(client, user_id)
+    response = send(client, method, url, json={'vehicle_id': vehicle_id})
+    assert response.status_code == 404 and '999' in response.json['message']
+
+def test_reservation_of_another_user_is_403(make_user, make_lot, client):
+    owner, vehicle_id = make_user('owner')
+    reservation_id = book(owner, make_lot(), vehicle_id).id
+    login(client, make_user('other')[0])
+    response = send(client, 'POST', f'/api/v1/reservations/{reservation_id}/release')
+    assert response.status_code == 403
+    db.session.expire_all()
+    assert db.session.get(Reservation, reservation_id).leaving_timestamp is None
+
+def test_full_lot(make_user, make_lot, client):
+    lot_id = make_lot(spots=1)
+    owner, owner_vehicle = make_user('owner')
+    book(owner, lot_id, owner_vehicle)
+    user_id, vehicle_id = make_user('other')
+    login(client, user_id)
+    response = send(client, 'POST', f'/api/v1/lots/{lot_id}/bookings', json={'vehicle_id': vehicle_id})
+    assert response.status_code == 409
+    assert response.json == {'message': 'No vacant spots available in this lot.', 'reason': 'full'}
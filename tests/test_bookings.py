@@ -0,0 +1,72 @@
+from models import db, Reservation, ParkingSpot, ParkingLot
+from bookings import book, release, BookingError
+from allocator import allocator, claim_spot
+from app import app as flask_app
+import threading
+import pytest
+
+
+def test_book_claims_the_first_free_spot(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    reservation = book(user_id, lot_id, vehicle_id)
+    spot = db.session.get(ParkingSpot, reservation.spot_id)
+    assert spot.lot_id == lot_id and spot.is_occupied
+
+def test_vehicle_parked_twice_is_refused(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    first, second = make_lot(), make_lot()
+    book(user_id, first, vehicle_id)
+    with pytest.raises(BookingError) as refused:
+        book(user_id, second, vehicle_id)
+    assert refused.value.reason == 'booked'
+
+# concurrent bookings of one vehicle in different lots: the unique index lets only one through
+def test_concurrent_bookings_of_a_vehicle(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lots = [make_lot() for _ in range(6)]
+    barrier = threading.Barrier(len(lots))
+    outcomes = []
+
+    def attempt(lot_id):
+        with flask_app.app_context():
+            barrier.wait()
+            try:
+                book(user_id, lot_id, vehicle_id)
+                outcomes.append('parked')
+            except BookingError as e:
+                outcomes.append(e.reason)
+
+    threads = [threading.Thread(target=attempt, args=(lot_id,)) for lot_id in lots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(outcomes) == ['booked'] * (len(lots) - 1) + ['parked']
+    assert Reservation.query.filter_by(vehicle_id=vehicle_id).count() == 1
+    assert ParkingSpot.query.filter_by(is_occupied=True).count() == 1
+
+# spots taken by another worker are still in this worker's free list
+def test_stale_free_list_does_not_look_full(make_lot):
+    lot_id = make_lot(spots=15)
+    assert allocator.free_count(lot_id) == 15
+    last = db.session.execute(db.select(db.func.max(ParkingSpot.id))).scalar()
+    db.session.execute(db.update(ParkingSpot).where(ParkingSpot.id != last).values(is_occupied=True))
+    db.session.commit()
+    assert claim_spot(lot_id) == last
+    db.session.rollback()
+
+# a double submitted release form: both requests loaded the reservation while it was active
+def test_release_twice(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    reservation_id = book(user_id, lot_id, vehicle_id).id
+    with flask_app.app_context():
+        first = db.session.get(Reservation, reservation_id)
+        with flask_app.app_context():
+            release(db.session.get(Reservation, reservation_id))
+        with pytest.raises(BookingError) as refused:
+            release(first)
+    assert refused.value.reason == 'released'
+    assert db.session.get(ParkingLot, lot_id).occupied_count == 0
+    assert ParkingSpot.query.filter_by(is_occupied=True).count() == 0
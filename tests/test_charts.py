@@ -0,0 +1,28 @@
+from decimal import Decimal
+import charts
+import pytest
+
+
+@pytest.fixture
+def chart_dir(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(charts, 'CHART_DIR', str(tmp_path))
+    charts._memory.clear()
+    return tmp_path
+
+def test_chart_is_rendered_once(chart_dir):
+    data = {'labels': ['A', 'B'], 'values': [Decimal('10.50'), Decimal('4')]}
+    key = charts.request_chart('revenue_donut', data)
+    assert charts.request_chart('revenue_donut', data) == key
+    assert charts.get_chart(key).startswith(b'\x89PNG')
+    assert (chart_dir / f'{key}.png').exists()
+
+# another worker process shares CHART_DIR but neither the memory cache nor the pending renders
+def test_chart_requested_by_another_worker(chart_dir):
+    key = charts.request_chart('revenue_donut', {'labels': ['A', 'B'], 'values': [Decimal('10.50'), Decimal('4')]})
+    charts.get_chart(key)
+    charts._memory.clear()
+    (chart_dir / f'{key}.png').unlink()
+    assert charts.get_chart(key).startswith(b'\x89PNG')
+
+def test_unknown_chart(chart_dir):
+    assert charts.get_chart('0' * 64) is None
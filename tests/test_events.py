@@ -0,0 +1,101 @@
+from models import db
+from bookings import book, release
+from events import get_broker
+from app import app as flask_app
+import eventstream
+import json
+import socket
+import time
+
+
+# a dashboard of the user with the stream of availability events, after its first chunk
+def open_stream(client, lot_id=None):
+    response = client.get('/events/availability' + (f'?lots={lot_id}' if lot_id else ''), buffered=False)
+    first = next(response.response)
+    return response, first
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+def test_streams_leave_threads_for_requests(make_user, client):
+    login(client, make_user()[0])
+    limit = flask_app.config['SSE_MAX_THREAD_STREAMS']
+    streams = [open_stream(client) for _ in range(limit)]
+    assert [first for _, first in streams] == [b'retry: 5000\n\n'] * limit
+    refused, first = open_stream(client)
+    assert refused.status_code == 200 and b'event: busy' in first and b'retry: 30000' in first
+    refused.close()
+    streams.pop()[0].close()
+    streams.append(open_stream(client))
+    assert streams[-1][1] == b'retry: 5000\n\n'
+    for stream, _ in streams:
+        stream.close()
+
+def test_booking_reaches_the_stream(make_user, make_lot, client):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    login(client, user_id)
+    stream, _ = open_stream(client, lot_id)
+    book(user_id, lot_id, vehicle_id)
+    chunk = next(stream.response).decode()
+    stream.close()
+    event = json.loads(chunk.split('data: ')[1])
+    assert event['lot_id'] == lot_id and event['free_spots'] == 2 and event['occupied']
+
+
+#---------------------------------------- Event stream server --------------------------------------
+
+# a raw HTTP connection to the stream server with the session cookie of `user_id`
+def connect(user_id, lot_id):
+    port = eventstream.start_server_thread()
+    cookie = flask_app.session_interface.get_signing_serializer(flask_app).dumps({'user_id': user_id})
+    connection = socket.create_connection(('127.0.0.1', port), timeout=5)
+    connection.sendall(f'GET /events/availability?lots={lot_id} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n'
+                       f'Cookie: session={cookie}\r\n\r\n'.encode())
+    return connection.makefile('rb')
+
+# the next `event:` of a stream with its data
+def next_event(stream):
+    name = None
+    for line in stream:
+        line = line.decode().strip()
+        if line.startswith('event: '):
+            name = line[len('event: '):]
+        elif line.startswith('data: ') and name:
+            return name, json.loads(line[len('data: '):])
+
+def test_release_reaches_the_stream_server(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    reservation = book(user_id, lot_id, vehicle_id)
+    stream = connect(user_id, lot_id)
+    assert stream.readline() == b'HTTP/1.1 200 OK\r\n'
+    assert b'retry: 5000\n' in iter(stream.readline, b'')
+    release(reservation)
+    name, event = next_event(stream)
+    stream.close()
+    assert name == 'availability'
+    assert event['lot_id'] == lot_id and event['free_spots'] == 3 and event['occupied'] is False
+
+def test_stream_server_refuses_past_its_limit(make_user, make_lot, monkeypatch):
+    user_id, _ = make_user()
+    lot_id = make_lot()
+    # the server frees the place of a closed stream once it reads the end of the connection
+    for _ in range(500):
+        if not get_broker().subscriber_count():
+            break
+        time.sleep(0.01)
+    monkeypatch.setitem(flask_app.config, 'SSE_MAX_SUBSCRIBERS', 1)
+    first = connect(user_id, lot_id)
+    assert first.readline() == b'HTTP/1.1 200 OK\r\n'
+    assert b'retry: 5000\n' in iter(first.readline, b'')
+    second = connect(user_id, lot_id)
+    assert next_event(second) == ('busy', {})
+    second.close()
+    first.close()
+
+def test_stream_server_needs_a_session(make_lot):
+    stream = connect(None, make_lot())
+    assert stream.readline() == b'HTTP/1.1 401 Unauthorized\r\n'
+    stream.close()
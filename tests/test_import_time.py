@@ -0,0 +1,9 @@
+from startup import import_times, IMPORT_TIME_BUDGET, HEAVY_MODULES
+
+
+def test_app_imports_fast_and_light():
+    times = import_times()
+    total = sum(seconds for depth, name, seconds in times if depth == 0 and name == 'app')
+    assert 0 < total <= IMPORT_TIME_BUDGET
+    heavy = {name.split('.')[0] for depth, name, seconds in times} & set(HEAVY_MODULES)
+    assert not heavy
@@ -0,0 +1,75 @@
+from models import db, Job, ParkingLot, ParkingSpot, ReservationArchive
+from bookings import book, release
+from jobs import enqueue, run_pending, claim_next, JOB_LEASE, _wakeup
+from datetime import timedelta
+import json
+
+
+def spot_count(lot_id):
+    return ParkingSpot.query.filter_by(lot_id=lot_id).count()
+
+def test_delete_lot_job(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    release(book(user_id, lot_id, vehicle_id))
+    job_id = enqueue('delete_lot', {'lot_id': lot_id}).id
+    db.session.commit()
+    assert run_pending() == 1
+    job = db.session.get(Job, job_id)
+    assert job.status == 'done'
+    assert json.loads(job.result) == {'lot_id': lot_id, 'deleted': True, 'archived_reservations': 1}
+    assert db.session.get(ParkingLot, lot_id) is None and spot_count(lot_id) == 0
+    assert ReservationArchive.query.filter_by(lot_id=lot_id).count() == 1
+
+def test_delete_occupied_lot_job_fails(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    book(user_id, lot_id, vehicle_id)
+    job_id = enqueue('delete_lot', {'lot_id': lot_id}).id
+    db.session.commit()
+    assert run_pending() == 1
+    job = db.session.get(Job, job_id)
+    assert job.status == 'failed' and job.attempts == 1
+    assert db.session.get(ParkingLot, lot_id) is not None
+
+def test_resize_lot_jobs(make_lot):
+    lot_id = make_lot(spots=3)
+    enqueue('resize_lot', {'lot_id': lot_id, 'total_spots': 250})
+    db.session.commit()
+    assert run_pending() == 1
+    assert spot_count(lot_id) == 250 and db.session.get(ParkingLot, lot_id).total_spots == 250
+    enqueue('resize_lot', {'lot_id': lot_id, 'total_spots': 10})
+    db.session.commit()
+    assert run_pending() == 1
+    assert spot_count(lot_id) == 10
+    assert Job.query.filter_by(status='done').count() == 2
+
+# the in-process worker is woken once the job is visible to it, not when it is queued
+def test_worker_woken_after_commit(make_lot):
+    lot_id = make_lot()
+    _wakeup.clear()
+    enqueue('resize_lot', {'lot_id': lot_id, 'total_spots': 5})
+    assert not _wakeup.is_set()
+    db.session.rollback()
+    db.session.commit()
+    assert not _wakeup.is_set()
+    enqueue('resize_lot', {'lot_id': lot_id, 'total_spots': 5})
+    db.session.commit()
+    assert _wakeup.is_set()
+
+# a job whose worker died is claimed again after its lease, until its attempts are used up
+def test_expired_lease(make_lot):
+    lot_id = make_lot()
+    job_id = enqueue('resize_lot', {'lot_id': lot_id, 'total_spots': 5}, max_attempts=2).id
+    db.session.commit()
+    for attempts in (1, 2):
+        assert claim_next('crashed').id == job_id
+        job = db.session.get(Job, job_id)
+        assert job.attempts == attempts
+        job.locked_at -= JOB_LEASE + timedelta(seconds=1)
+        db.session.commit()
+    assert claim_next('worker') is None
+    db.session.expire_all()
+    job = db.session.get(Job, job_id)
+    assert job.status == 'failed' and job.attempts == 2 and job.finished_at and job.error
+    assert spot_count(lot_id) == 3
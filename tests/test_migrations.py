@@ -0,0 +1,52 @@
+from models import db
+from migrations import init_db, migrate, schema_version, MIGRATIONS
+from sqlalchemy import text
+import click
+import pytest
+
+
+# the tables of the first release (before any migration), user_version 0
+BASELINE_SCHEMA = [
+    "CREATE TABLE user (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(32) NOT NULL, address VARCHAR(100) NOT NULL, "
+    "pincode VARCHAR(10) NOT NULL, username VARCHAR(32) NOT NULL UNIQUE, passhash VARCHAR(256) NOT NULL, is_admin BOOLEAN)",
+    "CREATE TABLE vehicle (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES user (id), "
+    "vehicle_number VARCHAR(25) NOT NULL UNIQUE, vehicle_type VARCHAR(20))",
+    "CREATE TABLE parkinglot (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(50) NOT NULL, address VARCHAR(100) NOT NULL, "
+    "pincode VARCHAR(10) NOT NULL, total_spots INTEGER NOT NULL, price_per_hour FLOAT NOT NULL)",
+    "CREATE TABLE parkingspot (id INTEGER NOT NULL PRIMARY KEY, lot_id INTEGER NOT NULL REFERENCES parkinglot (id), "
+    "spot_number INTEGER NOT NULL, is_occupied BOOLEAN)",
+    "CREATE TABLE reservation (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES user (id), "
+    "lot_id INTEGER NOT NULL REFERENCES parkinglot (id), spot_id INTEGER NOT NULL REFERENCES parkingspot (id), "
+    "vehicle_id INTEGER NOT NULL REFERENCES vehicle (id), parking_timestamp DATETIME NOT NULL, "
+    "leaving_timestamp DATETIME, total_cost FLOAT)",
+    "INSERT INTO user VALUES (1, 'Driver', 'Address', '600001', 'driver@example.com', '-', 0)",
+    "INSERT INTO vehicle VALUES (1, 1, 'TN-0001', 'car')",
+    "INSERT INTO parkinglot VALUES (1, 'Lot', 'Street', '600001', 2, 20)",
+    "INSERT INTO parkingspot VALUES (1, 1, 1, 1), (2, 1, 2, 1)",
+]
+
+# a vehicle parked on both spots at once, which the first release allowed
+DUPLICATE_ACTIVE = ("INSERT INTO reservation VALUES (1, 1, 1, 1, 1, '2024-01-01 10:00:00', NULL, NULL), "
+                    "(2, 1, 1, 2, 1, '2024-01-01 10:05:00', NULL, NULL)")
+
+@pytest.fixture
+def baseline(empty_app):
+    for statement in BASELINE_SCHEMA + [DUPLICATE_ACTIVE]:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+def test_duplicate_active_reservations_stop_the_unique_index(baseline):
+    with pytest.raises(click.ClickException) as refused:
+        init_db()
+    assert 'reservation.vehicle_id has duplicates' in refused.value.message
+    assert schema_version() == 11
+
+    db.session.execute(text("UPDATE reservation SET leaving_timestamp = '2024-01-01 11:00:00', total_cost = 20 WHERE id = 2"))
+    db.session.commit()
+    assert migrate() == len(MIGRATIONS) - 11
+    assert schema_version() == len(MIGRATIONS)
+    unique = db.session.execute(text(
+        "SELECT \"unique\" FROM pragma_index_list('reservation') WHERE name = 'ix_reservation_active_vehicle'")).scalar()
+    assert unique == 1
+    # the car still parked is charged today's price when it leaves
+    assert db.session.execute(text('SELECT price_per_hour FROM reservation WHERE id = 1')).scalar() == 20
@@ -0,0 +1,52 @@
+from models import db, ParkingLot, ReservationArchive, Vehicle
+from bookings import book, release
+from provisioning import delete_spot
+from occupancy import check_counters, repair_counters
+from datetime import timedelta
+
+
+# park for two hours and leave
+def park(user_id, lot_id, vehicle_id):
+    reservation = book(user_id, lot_id, vehicle_id)
+    reservation.parking_timestamp -= timedelta(hours=2)
+    spot_id = reservation.spot_id
+    release(reservation)
+    return spot_id
+
+def test_counters_follow_bookings(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    park(user_id, lot_id, vehicle_id)
+    book(user_id, lot_id, vehicle_id)
+    lot = db.session.get(ParkingLot, lot_id)
+    assert lot.occupied_count == 1 and lot.revenue > 0
+    assert check_counters() == []
+
+# the reservations of a deleted spot move to reservation_archive, their revenue stays with the lot
+def test_repair_keeps_archived_revenue(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    spot_id = park(user_id, lot_id, vehicle_id)
+    revenue = db.session.get(ParkingLot, lot_id).revenue
+    assert delete_spot(spot_id)
+    db.session.commit()
+    assert ReservationArchive.query.filter_by(spot_id=spot_id).count() == 1
+    assert check_counters() == []
+    repair_counters()
+    db.session.commit()
+    db.session.expire_all()
+    assert revenue > 0 and db.session.get(ParkingLot, lot_id).revenue == revenue
+
+# a deleted vehicle's reservations are archived too, its revenue stays with the lot
+def test_vehicle_deletion_keeps_revenue(make_user, make_lot, client):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    park(user_id, lot_id, vehicle_id)
+    db.session.commit()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    assert client.post(f'/vehicle/{vehicle_id}/delete').status_code == 302
+    db.session.expire_all()
+    assert db.session.get(Vehicle, vehicle_id) is None
+    assert ReservationArchive.query.filter_by(vehicle_id=vehicle_id).count() == 1
+    assert check_counters() == []
@@ -0,0 +1,52 @@
+from models import db, Reservation, ParkingSpot, ParkingLot
+from bookings import book, BookingError
+from provisioning import delete_lot, remove_spots
+from app import app as flask_app
+import provisioning
+import threading
+
+
+def test_occupied_lot_is_not_deleted(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    book(user_id, lot_id, vehicle_id)
+    assert delete_lot(lot_id) is None
+    db.session.rollback()
+    assert db.session.get(ParkingLot, lot_id) and ParkingSpot.query.filter_by(lot_id=lot_id).count() == 3
+
+def test_occupied_spot_is_not_removed(make_user, make_lot):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot(spots=1)
+    book(user_id, lot_id, vehicle_id)
+    assert not remove_spots(lot_id, 1)
+    db.session.rollback()
+    assert ParkingSpot.query.filter_by(lot_id=lot_id).count() == 1
+
+# a booking arriving once delete_lot has found the lot free waits for the deletion to commit
+# instead of parking on a spot that is about to be deleted
+def test_booking_during_lot_deletion(make_user, make_lot, monkeypatch):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot(spots=1)
+    outcomes, threads = [], []
+
+    def attempt():
+        with flask_app.app_context():
+            try:
+                book(user_id, lot_id, vehicle_id)
+                outcomes.append('parked')
+            except BookingError as e:
+                outcomes.append(e.reason)
+
+    archive_reservations = provisioning.archive_reservations
+    def archive_during_booking(where):
+        threads.append(threading.Thread(target=attempt))
+        threads[0].start()
+        threads[0].join(timeout=0.5)
+        return archive_reservations(where)
+    monkeypatch.setattr(provisioning, 'archive_reservations', archive_during_booking)
+
+    assert delete_lot(lot_id) == 0
+    db.session.commit()
+    threads[0].join()
+    assert outcomes == ['full']
+    assert Reservation.query.count() == 0
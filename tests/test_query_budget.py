@@ -0,0 +1,77 @@
+from models import db, User, ParkingSpot, Reservation
+from bookings import book, release
+from app import app as flask_app
+from datetime import timedelta
+import pytest
+
+
+@pytest.fixture
+def strict(app):
+    app.config['QUERY_BUDGET_STRICT'] = True
+    yield
+    app.config['QUERY_BUDGET_STRICT'] = False
+
+# a request in an application context of its own, the statement count (flask.g) of the test's
+# context would carry over from one request to the next
+def send(client, method, url, **kwargs):
+    with flask_app.app_context():
+        response = client.open(url, method=method, **kwargs)
+    assert response.status_code < 400, url
+    return response
+
+def login(client, user_id, admin=False):
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['is_admin'] = admin
+
+# a two hour reservation, released
+def park(user_id, vehicle_id, lot_id):
+    reservation = book(user_id, lot_id, vehicle_id)
+    reservation.parking_timestamp -= timedelta(hours=2)
+    release(reservation)
+
+def test_user_pages(strict, make_user, make_lot, client):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    park(user_id, vehicle_id, lot_id)
+    login(client, user_id)
+    for url in ('/user', '/userdata', '/parking/history', '/profile', '/vehicle', '/advance',
+                f'/lot/{lot_id}/book', f'/lot/{lot_id}/advance', f'/user/{user_id}/summary',
+                '/api/v1/lots', f'/api/v1/lots/{lot_id}', f'/api/v1/lots/{lot_id}/availability',
+                '/api/v1/availability', '/api/v1/reservations', '/api/v1/advance-bookings'):
+        send(client, 'GET', url)
+
+def test_admin_pages(strict, make_user, make_lot, client):
+    lot_id = make_lot()
+    park(*make_user(), lot_id)
+    spot_id = ParkingSpot.query.filter_by(lot_id=lot_id).first().id
+    login(client, User.query.filter_by(is_admin=True).one().id, admin=True)
+    for url in ('/admin', '/admin/summary', '/admin/trends', '/admin/jobs', f'/lot/{lot_id}/edit',
+                f'/lot/{lot_id}/delete', f'/admin/deletespot/{spot_id}'):
+        send(client, 'GET', url)
+    send(client, 'POST', f'/admin/deletespot/{spot_id}')
+    assert db.session.get(ParkingSpot, spot_id) is None
+
+# the first release of a month creates the history partition of the month
+def test_first_release_of_a_month(strict, make_user, make_lot, client):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    login(client, user_id)
+    send(client, 'POST', f'/lot/{lot_id}/book', data={'vehicleid': vehicle_id})
+    reservation = Reservation.query.filter_by(vehicle_id=vehicle_id).one()
+    send(client, 'GET', f'/spot/{reservation.id}/release')
+    reservation.parking_timestamp -= timedelta(hours=2)
+    db.session.commit()
+    send(client, 'POST', f'/spot/{reservation.id}/release')
+    assert Reservation.query.count() == 0
+
+def test_first_api_release_of_a_month(strict, make_user, make_lot, client):
+    user_id, vehicle_id = make_user()
+    lot_id = make_lot()
+    login(client, user_id)
+    reservation_id = send(client, 'POST', f'/api/v1/lots/{lot_id}/bookings', json={'vehicle_id': vehicle_id}).json['id']
+    reservation = db.session.get(Reservation, reservation_id)
+    reservation.parking_timestamp -= timedelta(hours=2)
+    db.session.commit()
+    send(client, 'POST', f'/api/v1/reservations/{reservation_id}/release')
+    assert Reservation.query.count() == 0
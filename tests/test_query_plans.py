@@ -0,0 +1,8 @@
+from migrations import table_scans, schema_version, MIGRATIONS
+
+
+def test_migrations_applied(app):
+    assert schema_version() == len(MIGRATIONS)
+
+def test_hot_queries_use_an_index(app):
+    assert table_scans() == {}
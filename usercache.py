@@ -0,0 +1,45 @@
+from models import User
+from flask import g, session
+from collections import namedtuple
+import threading
+import time
+
+
+#------------------------------------------ Current user -------------------------------------------
+# The logged in user is loaded at most once per request (cached on flask.g) and kept in a short
+# lived in-process cache keyed by user id, so the auth decorators usually cost no query at all.
+# Only the profile fields are cached; code that changes the user row loads it with a query and
+# calls forget_user() afterwards.
+
+USER_CACHE_TTL = 30     # seconds
+CachedUser = namedtuple('CachedUser', 'id name address pincode username is_admin')
+
+_lock = threading.Lock()
+_cache = {}             # user_id -> (expires_at, CachedUser)
+
+
+def _load_user(user_id):
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(user_id)
+    if entry and entry[0] > now:
+        return entry[1]
+    user = User.query.get(user_id)
+    if not user:
+        return None
+    cached = CachedUser(user.id, user.name, user.address, user.pincode, user.username, bool(user.is_admin))
+    with _lock:
+        _cache[user_id] = (now + USER_CACHE_TTL, cached)
+    return cached
+
+# the logged in user (a CachedUser), or None
+def current_user():
+    if 'current_user' not in g:
+        user_id = session.get('user_id')
+        g.current_user = _load_user(user_id) if user_id is not None else None
+    return g.current_user
+
+def forget_user(user_id):
+    with _lock:
+        _cache.pop(user_id, None)
+    g.pop('current_user', None)
@@ -0,0 +1,18 @@
+import os
+
+
+#---------------------------------------- Production entry point ------------------------------------
+#   gunicorn --workers 4 --threads 4 'wsgi:create_app()'
+#   python wsgi.py            (waitress, e.g. on Windows)
+# Each worker process imports the app once; database tuning (pool options, SQLite WAL and
+# pragmas) comes from config.py and its environment variables.
+
+def create_app():
+    from app import app
+    return app
+
+
+if __name__ == "__main__":
+    from waitress import serve
+    serve(create_app(), host=os.getenv('HOST', '0.0.0.0'), port=int(os.getenv('PORT', 8000)),
+          threads=int(os.getenv('WAITRESS_THREADS', 8)))